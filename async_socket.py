@@ -1,14 +1,41 @@
+import collections
 import errno
+import ipaddress
+import itertools
+import os
 # селекторы - высокоуровневая облочка для мультиплексирования
 import selectors
 import socket
+import struct
+from functools import partial
 
 
+from consts import MS
 from facade import Context
 from promise import Promise
 from log import get_console
 
-console = get_console(format='<light-green>async_socket</light-green>{message}')
+console = get_console(format='<light-green>async_socket</light-green>{message}', name='async_socket')
+
+FRAME_HEADER = struct.Struct('!I')
+
+# больше буферов за один sendmsg ядро не примет
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+class IncompleteReadError(EOFError):
+    """Соединение закрылось раньше, чем пришли нужные данные; partial - то, что успело прийти"""
+    def __init__(self, partial, expected=None):
+        super().__init__(f'{len(partial)} bytes read, {expected or "more"} expected')
+        self.partial = partial
+        self.expected = expected
+
+
+class LimitOverrunError(Exception):
+    """Разделитель не найден в пределах limit байт"""
 
 
 class async_socket(Context):
@@ -18,17 +45,132 @@ class async_socket(Context):
     all data writen
     error occured
     -> el будет вызывать соответствующий callback
+
+    В селекторе сокет отслеживает только события, нужные ожидающим колбекам (см. _EVENTS):
+    простаивающий сокет не будит цикл.
     """
-    def __init__(self, *args):
-        self._sock = socket.socket(*args)
+    _EVENTS = {
+        'conn': selectors.EVENT_WRITE,
+        'recv': selectors.EVENT_READ,
+        'sent': selectors.EVENT_WRITE,
+        'accept': selectors.EVENT_READ,
+    }
+
+    # сколько читать за один recv при буферизованном чтении и максимальная длина строки/кадра
+    read_size = 64 * 1024
+    limit = 2 ** 20
+    # общий для всех сокетов буфер _fill: recv_into пишет в него, и в том же колбеке данные уходят в _rbuf
+    _scratch = memoryview(bytearray(read_size))
+    # буфер записи: выше high_water drain() ждет, пока в нем не останется low_water байт
+    high_water = 64 * 1024
+    low_water = 16 * 1024
+    # записи короче копируются в общий хвост буфера (до read_size байт), длинные ставятся в очередь как есть
+    coalesce_size = 16 * 1024
+    # мс на каждое ожидание (connect, recv, accept, отправка буфера), None - ждать сколько угодно; см. settimeout
+    timeout = None
+
+    def __init__(self, *args, sock=None):
+        """sock - уже подключенный сокет (например из accept), иначе создается новый из args (EventLoop.socket)"""
+        self._sock = sock or self.event_loop.socket(*args)
         self._sock.setblocking(False)
         self.event_loop.register_fileobj(self._sock, self._on_event)
-        self._state = self.states.INITIAL
+        self._state = self.states.CONNECTED if sock else self.states.INITIAL
         self._callbacks = {}
+        self._dispatching = False
+        # прочитанные наперед данные для readline/readuntil/readexactly/readframe
+        self._rbuf = bytearray()
+        # буфер записи (см. write): неотправленные буферы и счетчики байт, поставленных в него и отправленных
+        self._wbuf = collections.deque()
+        self._queued = 0
+        self._sent = 0
+        self._flush_waiters = collections.deque()  # (сколько байт должно быть отправлено, promise)
+        self._drain_waiters = []
+        self._paused = False
+
+    def bind(self, addr, reuse_address=True, reuse_port=False):
+        """reuse_port - SO_REUSEPORT: несколько процессов слушают один порт, ядро раздает им соединения"""
+        if self._state != self.states.INITIAL:
+            raise Exception(f'state {self.states.INITIAL} expected, but is {self._state}')
+
+        if reuse_address:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sock.bind(addr)
+
+    def listen(self, backlog=128):
+        if self._state != self.states.INITIAL:
+            raise Exception(f'state {self.states.INITIAL} expected, but is {self._state}')
+
+        self._sock.listen(backlog)
+        self._state = self.states.LISTENING
+
+    def getsockname(self):
+        return self._sock.getsockname()
+
+    def settimeout(self, timeout):
+        """Таймаут операций этого сокета, мс (None - без таймаута), действует на операции, начатые после вызова
+
+        Промис операции, не выполненный за timeout, отклоняется TimeoutError, а сокет закрывается: что успело
+        уйти или прийти - неизвестно, и ответ на просроченный запрос не должен достаться следующему.
+        Исключение - accept(): слушающий сокет просто перестает ждать соединение.
+        Таймаут - на каждое ожидание, а не на весь readline() или sendall() большого буфера по частям: общий срок
+        задает utils.with_timeout.
+        """
+        if timeout is not None and timeout < 0:
+            raise ValueError(f'timeout >= 0 or None expected, but is {timeout}')
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def accept(self):
+        """Промис -> (async_socket, addr) следующего входящего соединения"""
+        if console.tracing:
+            console.trace('.accept()')
+
+        if self._state != self.states.LISTENING:
+            raise Exception(f'async_socket.accept(): state {self.states.LISTENING} expected, but is {self._state}')
+
+        if 'accept' in self._callbacks:
+            raise Exception('async_socket.accept(): accept in self._callbacks')
+
+        p = Promise()
+
+        def _on_accept_ready(error):
+            if error:
+                return p._reject(error)
+            try:
+                sock, addr = self._sock.accept()
+            except BlockingIOError:
+                # соединение уже забрали или клиент отвалился до accept - ждем следующего
+                self._callbacks['accept'] = _on_accept_ready
+                return
+            except OSError as exc:
+                return p._reject(exc)
+            p._resolve((async_socket(sock=sock), addr))
+
+        # под нагрузкой в очереди listen почти всегда кто-то есть - пробуем сразу, без похода в селектор
+        _on_accept_ready(None)
+        self._update_interest()
+        if not (p._resolved or p._rejected):
+            p._canceller = partial(self._cancel, 'accept')
+            self._deadline(p, 'accept', close=False)
+        return p
+
+    def accept_nowait(self):
+        """(async_socket, addr) соединения, уже ждущего в очереди listen, или None, если очередь пуста"""
+        try:
+            sock, addr = self._sock.accept()
+        except BlockingIOError:
+            return None
+        return async_socket(sock=sock), addr
 
     # аналогичено коллбекам, но не требует передачи колбека и возвращает промис
     def connect(self, addr):
-        console(f'.connect(addr={addr})')
+        """Промис подключения к addr; имя хоста (не IP) сначала резолвится в пуле потоков цикла"""
+        if console.tracing:
+            console.trace('.connect(addr={})', addr)
 
         if self._state != self.states.INITIAL:
             raise Exception(f'state {self.states.INITIAL} expected, but is {self._state}')
@@ -36,6 +178,25 @@ class async_socket(Context):
         self._state = self.states.CONNECTING
 
         p = Promise()
+        # полуоткрытое соединение не продолжить - отмена и таймаут его закрывают
+        p._canceller = partial(self._cancel, 'conn', close=True)
+        self._deadline(p, 'conn')
+        host, port = addr[:2]
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            # getaddrinfo блокирует поток на время DNS-запроса - не в цикле событий
+            resolving = self.event_loop.run_in_executor(
+                socket.getaddrinfo, host, port, self._sock.family, self._sock.type)
+            resolving.then(lambda infos: self._connect(infos[0][4], p)).catch(p._reject)
+        else:
+            self._connect(addr, p)
+        return p
+
+    def _connect(self, addr, p):
+        if self._state != self.states.CONNECTING:
+            # закрыли, пока резолвился адрес
+            return p._reject(ConnectionError(f'socket is closed before connecting to {addr}'))
 
         def _on_conn(error):
             if error:
@@ -44,13 +205,16 @@ class async_socket(Context):
                 p._resolve()
 
         self._callbacks['conn'] = _on_conn
+        self._update_interest()
 
         # ~ connect, но -> код ошибки вместо возбуждения исключения
         error_code = self._sock.connect_ex(addr)
 
-        if error_code != errno.EINPROGRESS:
-            raise Exception('error code is not EINPROGRESS')
-        return p
+        # 0 - подключились сразу (например unix-сокет): готовность к записи все равно придет в _on_event
+        if error_code not in (0, errno.EINPROGRESS):
+            del self._callbacks['conn']
+            self._update_interest()
+            p._reject(ConnectionError(error_code, os.strerror(error_code)))
 
     def recv(self, n):
         """
@@ -61,60 +225,393 @@ class async_socket(Context):
 
         Returns: None
         """
-        console(f'.recv(n={n})')
+        if console.tracing:
+            console.trace('.recv(n={})', n)
 
         if self._state != self.states.CONNECTED:
             raise Exception(f'async_socket.recv(): self._state expected 2 but actual is {self._state}')
 
+        if self._rbuf:
+            # сначала отдаем то, что осталось в буфере после readline/readexactly
+            p = Promise()
+            data = bytes(self._rbuf[:n])
+            del self._rbuf[:n]
+            p._resolve(data)
+            return p
+
+        return self._read(partial(self._sock.recv, n))
+
+    def recv_into(self, buffer, nbytes=0):
+        """Промис -> число байт, записанных в buffer (не больше nbytes, если задано); 0 - соединение закрыто
+
+        Данные пишутся прямо в buffer, без промежуточного bytes на каждый вызов.
+        """
+        if console.tracing:
+            console.trace('.recv_into(nbytes={})', nbytes)
+
+        if self._state != self.states.CONNECTED:
+            raise Exception(f'async_socket.recv_into(): self._state expected 2 but actual is {self._state}')
+
+        if self._rbuf:
+            view = memoryview(buffer).cast('B')
+            n = min(len(self._rbuf), nbytes or len(view))
+            view[:n] = self._rbuf[:n]
+            del self._rbuf[:n]
+            p = Promise()
+            p._resolve(n)
+            return p
+
+        return self._read(partial(self._sock.recv_into, buffer, nbytes))
+
+    def _read(self, reader):
+        """Промис -> reader(), вызванный когда сокет готов к чтению; OSError из reader отклоняет промис"""
         if 'recv' in self._callbacks:
             raise Exception('async_socket.recv(): recv in self._callbacks')
 
         p = Promise()
+        timer = None
+
         def _on_read_ready(error):
+            # чтение - самая частая операция: таймер снимается здесь, а не подпиской на промис
+            if timer is not None:
+                timer.cancel()
             if error:
-                p._reject(error)
-            else:
-                data = self._sock.recv(n)
-                p._resolve(data)
+                return p._reject(error)
+            try:
+                result = reader()
+            except OSError as exc:
+                return p._reject(exc)
+            p._resolve(result)
 
         self._callbacks['recv'] = _on_read_ready
+        self._update_interest()
+        timer = self._arm(p, 'recv')
+        # отмена снимает интерес к чтению: простаивающий сокет уходит из селектора
+        p._canceller = partial(self._cancel, 'recv', timer)
         return p
 
+    def _fill(self):
+        """Генератор: дочитывает данные в буфер, -> число прочитанных байт (0 - соединение закрыто)"""
+        if self._state != self.states.CONNECTED:
+            raise Exception(f'async_socket._fill(): self._state expected 2 but actual is {self._state}')
+
+        return (yield self._read(self._recv_to_rbuf))
+
+    def _recv_to_rbuf(self):
+        n = self._sock.recv_into(self._scratch)
+        self._rbuf += self._scratch[:n]
+        return n
+
+    def readuntil(self, separator=b'\n', limit=None):
+        """Генератор -> данные до separator включительно
+
+        Raises:
+            IncompleteReadError: соединение закрылось до separator
+            LimitOverrunError: separator не встретился в первых limit байтах
+        """
+        limit = limit or self.limit
+        buf = self._rbuf
+        start = 0
+        while True:
+            end = buf.find(separator, start)
+            if end >= 0:
+                end += len(separator)
+                if end > limit:
+                    raise LimitOverrunError(f'separator is found, but chunk is longer than limit {limit}')
+                data = bytes(buf[:end])
+                del buf[:end]
+                return data
+
+            if len(buf) > limit:
+                raise LimitOverrunError(f'separator is not found in first {limit} bytes')
+
+            # разделитель мог прийти наполовину - ищем с хвоста прошлого куска
+            start = max(0, len(buf) - len(separator) + 1)
+            if not (yield self._fill()):
+                partial = bytes(buf)
+                buf.clear()
+                raise IncompleteReadError(partial)
+
+    def readline(self, limit=None):
+        """Генератор -> строка с '\n'; при закрытии соединения - остаток без '\n' (b'' - данных нет)"""
+        try:
+            return (yield self.readuntil(b'\n', limit))
+        except IncompleteReadError as exc:
+            return exc.partial
+
+    def readexactly(self, n):
+        """Генератор -> ровно n байт, IncompleteReadError если соединение закрылось раньше"""
+        buf = self._rbuf
+        while len(buf) < n:
+            if not (yield self._fill()):
+                partial = bytes(buf)
+                buf.clear()
+                raise IncompleteReadError(partial, n)
+        data = bytes(buf[:n])
+        del buf[:n]
+        return data
+
+    def readframe(self, limit=None):
+        """Генератор -> тело кадра с 4-байтовым заголовком длины (network order)"""
+        header = yield self.readexactly(FRAME_HEADER.size)
+        size, = FRAME_HEADER.unpack(header)
+        if size > (limit or self.limit):
+            raise LimitOverrunError(f'frame of {size} bytes is longer than limit {limit or self.limit}')
+        return (yield self.readexactly(size))
+
+    def sendframe(self, data):
+        return self.sendmsg((FRAME_HEADER.pack(len(data)), data))
+
+    def write(self, data):
+        """Ставит data в буфер записи и сразу возвращается, ожидать отправки не нужно
+
+        Пустой буфер пробует отправить сразу; пока сокет не готов к записи, записи копятся и уходят вместе, одним
+        sendmsg на до IOV_MAX буферов, а мелкие еще и склеиваются. Изменяемые data копируются (неотправленная
+        часть). Быстрый производитель ждет drain(), чтобы буфер не рос при медленном получателе.
+        Ошибка отправки закрывает сокет и отклоняет ожидающие flush(), drain() и sendall().
+        """
+        self._write_buffers((data,), copy=True)
+
+    def writelines(self, buffers):
+        """write() нескольких буферов: пустой буфер отправляет их одним sendmsg"""
+        self._write_buffers(buffers, copy=True)
+
     def sendall(self, data):
-        console(f'.sendall(data={data})')
+        """Промис, выполняемый когда data отправлены
 
-        if self._state != self.states.CONNECTED:
-            raise Exception(f'async_socket.sendall(), self._state expected 2 but actual is {self._state}')
+        Запись через буфер (см. write), но без копии: data нельзя менять, пока промис не выполнен. Несколько
+        sendall подряд не ждут друг друга - данные уходят в порядке вызовов.
+        """
+        if console.tracing:
+            console.trace('.sendall(data={})', data)
+
+        self._write_buffers((data,), copy=False)
+        return self.flush()
+
+    def sendmsg(self, buffers):
+        """Промис, выполняемый когда все buffers отправлены; как sendall, только буферов несколько
+
+        Длинные буферы не склеиваются: за один системный вызов sendmsg уходит до IOV_MAX буферов.
+        """
+        if console.tracing:
+            console.trace('.sendmsg(buffers={})', buffers)
 
-        if 'sent' in self._callbacks:
-            raise Exception('async_socket.sendall(), sent in self._callbacks')
+        self._write_buffers(buffers, copy=False)
+        return self.flush()
 
+    def flush(self):
+        """Промис, выполняемый когда отправлено все, что было в буфере записи на момент вызова"""
         p = Promise()
+        if self._sent >= self._queued:
+            p._resolve(None)
+        else:
+            self._flush_waiters.append((self._queued, p))
+            self._deadline(p, 'flush')
+        return p
 
-        def _on_write_ready(error):
-            nonlocal data
-            if error:
-                return p._reject(error)
+    def drain(self):
+        """Промис: сразу, если в буфере записи не больше high_water байт, иначе когда останется low_water"""
+        p = Promise()
+        if self._paused:
+            self._drain_waiters.append(p)
+            self._deadline(p, 'drain')
+        else:
+            p._resolve(None)
+        return p
 
-            n = self._sock.send(data)
-            if n < len(data):
-                data = data[n:]
-                self._callbacks['sent'] = _on_write_ready
+    def set_write_buffer_limits(self, high=None, low=None):
+        """Водяные знаки буфера записи этого сокета; low по умолчанию - четверть high"""
+        if high is not None:
+            self.high_water = high
+            self.low_water = high // 4 if low is None else low
+        elif low is not None:
+            self.low_water = low
+        if not 0 <= self.low_water <= self.high_water:
+            raise ValueError(f'0 <= low ({self.low_water}) <= high ({self.high_water}) expected')
+
+    def get_write_buffer_size(self):
+        return self._queued - self._sent
+
+    def _cancel(self, name, timer=None, close=False):
+        if timer is not None:
+            timer.cancel()
+        # колбек снимается до close(): иначе промис операции отклонился бы ConnectionError, а не отменой
+        if self._callbacks.pop(name, None) is not None:
+            self._update_interest()
+        if close:
+            self.close()
+
+    def _deadline(self, p, name, close=True):
+        """_arm() с таймером, который снимается, когда p выполнен или отклонен"""
+        timer = self._arm(p, name, close)
+        if timer is not None:
+            # выполненная вовремя операция снимает таймер, чтобы он не держал цикл событий
+            p.then(lambda *_: timer.cancel()).catch(lambda _: timer.cancel())
+        return p
+
+    def _arm(self, p, name, close=True):
+        """Таймер таймаута операции name ('conn', 'recv', 'accept', 'flush', 'drain') с промисом p, см. settimeout
+
+        Сокет закрывается раньше, чем ожидающие продолжат работу, и TimeoutError получают все операции, ждавшие
+        на нем (в том числе отправку общего буфера записи), а не только просроченная.
+
+        Returns: Timer - снять его, когда операция выполнится, должен вызывающий; None - таймаута нет
+        """
+        timeout = self.timeout
+        if timeout is None:
+            return None
+
+        def _expired(_):
+            if p._resolved or p._rejected:
+                return
+            if console.enabled:
+                console('._deadline: {} timed out after {} ms', name, timeout)
+            error = TimeoutError(f'async_socket: {name} timed out after {timeout} ms')
+            if close:
+                self._close(error)
+            else:
+                self._cancel(name)
+            # connect, еще ждущий резолва адреса, колбека в сокете не имеет
+            p._reject(error)
+
+        return self.event_loop.call_later(timeout * MS, _expired)
+
+    def _check_send(self):
+        if self._state != self.states.CONNECTED:
+            raise Exception(f'async_socket.sendall(), self._state expected 2 but actual is {self._state}')
+
+    def _write_buffers(self, buffers, copy):
+        self._check_send()
+        views = [view for view in (memoryview(data).cast('B') for data in buffers) if view]
+        if not views:
+            return
+        self._queued += sum(len(view) for view in views)
+
+        if not self._wbuf:
+            # буфер пуст - отправляем прямо из буферов вызывающего, в очередь попадает только неотправленное
+            try:
+                n = self._sock.send(views[0]) if len(views) == 1 else self._sock.sendmsg(views[:IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            except OSError as exc:
+                return self._fail(exc)
+            self._sent += n
+
+            i = 0
+            while i < len(views) and n >= len(views[i]):
+                n -= len(views[i])
+                i += 1
+            if i == len(views):
+                return
+            views = views[i:]
+            views[0] = views[0][n:]
+            self._callbacks['sent'] = self._on_write_ready
+            self._update_interest()
+
+        for view in views:
+            self._enqueue(view, copy)
+        if not self._paused and self._queued - self._sent > self.high_water:
+            self._paused = True
+
+    def _enqueue(self, view, copy):
+        buffers = self._wbuf
+        if len(view) < self.coalesce_size:
+            tail = buffers[-1] if buffers else None
+            # частично отправленная голова очереди - memoryview, к ней не дописываем
+            if type(tail) is bytearray and len(tail) + len(view) <= self.read_size:
+                tail += view
             else:
+                buffers.append(bytearray(view))
+        elif copy and not view.readonly:
+            buffers.append(bytes(view))
+        else:
+            buffers.append(view)
+
+    def _on_write_ready(self, error):
+        if error:
+            return self._fail(error)
+
+        buffers = self._wbuf
+        try:
+            if len(buffers) == 1:
+                n = self._sock.send(buffers[0])
+            else:
+                n = self._sock.sendmsg(itertools.islice(buffers, IOV_MAX))
+        except (BlockingIOError, InterruptedError):
+            n = 0
+        except OSError as exc:
+            return self._fail(exc)
+
+        self._sent += n
+        while buffers and n >= len(buffers[0]):
+            n -= len(buffers.popleft())
+        if n:
+            buffers[0] = memoryview(buffers[0]).cast('B')[n:]
+        if buffers:
+            self._callbacks['sent'] = self._on_write_ready
+
+        # колбеки ожидающих могут сразу писать снова - очередь к этому моменту уже в порядке
+        waiters = self._flush_waiters
+        while waiters and waiters[0][0] <= self._sent:
+            waiters.popleft()[1]._resolve(None)
+        if self._paused and self._queued - self._sent <= self.low_water:
+            self._paused = False
+            drain_waiters, self._drain_waiters = self._drain_waiters, []
+            for p in drain_waiters:
                 p._resolve(None)
 
-        self._callbacks['sent'] = _on_write_ready
-        return p
+    def _fail(self, error):
+        # соединение с ошибкой записи не восстановить: данные в буфере пропадают, ждущие получают ошибку
+        self._wbuf.clear()
+        self._sent = self._queued
+        waiters = [p for _, p in self._flush_waiters] + self._drain_waiters
+        self._flush_waiters.clear()
+        self._drain_waiters = []
+        self._paused = False
+        for p in waiters:
+            p._reject(error)
+        self.close()
 
     def close(self):
+        self._close(ConnectionError('socket is closed'))
+
+    def _close(self, error):
+        # неудачный connect закрывает сокет сам, а вызывающий обычно закрывает еще раз в finally
+        if self._state == self.states.CLOSED:
+            return
+
         self.event_loop.unregister_fileobj(self._sock)
-        self._callbacks.clear()
         self._state = self.states.CLOSED
         self._sock.close()
 
+        # ожидающие операции (accept, recv, sendall) отклоняются, а не висят вечно
+        callbacks = list(self._callbacks.values())
+        self._callbacks.clear()
+        for callback in callbacks:
+            callback(error)
+
+    def _update_interest(self):
+        # во время _on_event маска пересчитывается один раз в конце
+        if self._dispatching or self._state == self.states.CLOSED:
+            return
+
+        events = 0
+        for name in self._callbacks:
+            events |= self._EVENTS[name]
+        self.event_loop.modify_fileobj(self._sock, events)
+
     def _on_event(self, mask):
+        self._dispatching = True
+        try:
+            self._dispatch(mask)
+        finally:
+            self._dispatching = False
+        self._update_interest()
+
+    def _dispatch(self, mask):
         if self._state == self.states.CONNECTING:
-            console('._on_event: CONNECTING')
+            if console.tracing:
+                console.trace('._on_event: CONNECTING')
 
             if mask != selectors.EVENT_WRITE:
                 raise Exception(
@@ -131,9 +628,8 @@ class async_socket(Context):
             callback(error)
 
         if mask & selectors.EVENT_READ:
-            callback = self._callbacks.get('recv')
+            callback = self._callbacks.pop('recv', None) or self._callbacks.pop('accept', None)
             if callback:
-                del self._callbacks['recv']
                 error = self._get_sock_error()
                 callback(error)
 
@@ -158,7 +654,8 @@ class async_socket(Context):
         Returns: ConnectionError | None
 
         """
-        console('._get_sock_error()')
+        if console.tracing:
+            console.trace('._get_sock_error()')
 
         errorno = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
         if errorno:
@@ -0,0 +1,63 @@
+from facade import Context
+from promise import Promise
+from utils import sleep
+
+from log import get_console
+
+console = get_console(format='<bold>Batcher</bold>{message}', name='Batcher')
+
+
+class Batcher(Context):
+    """Собирает одиночные запросы за window мс в пакетные
+
+    get(kind, id) возвращает промис, а запрос откладывается: по истечении окна (или набрав max_size id одного
+    вида) все отложенные id уходят одним fetch(kind, ids). Повторный id в том же окне ждет тот же промис.
+    window=0 - пакет из всех запросов, сделанных на текущей итерации цикла событий.
+    """
+    def __init__(self, fetch, window=1, max_size=1000):
+        """fetch(kind, ids) -> генератор или промис списка результатов в порядке ids"""
+        self._fetch = fetch
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}  # kind -> {id: Promise}
+        self._timer = None
+        self.requests = 0
+        self.batches = 0
+
+    def get(self, kind, entity_id):
+        self.requests += 1
+        pending = self._pending.setdefault(kind, {})
+        p = pending.get(entity_id)
+        # промис отменяется, когда отменили задачу, ждавшую его одной, - следующим нужен новый
+        if p is None or p._rejected:
+            p = pending[entity_id] = Promise()
+
+        if len(pending) >= self.max_size:
+            self._send(kind)
+        elif self._timer is None:
+            self._timer = sleep(self.window)
+            self._timer.then(self._flush)
+        return p
+
+    def _flush(self, *_):
+        self._timer = None
+        for kind in list(self._pending):
+            self._send(kind)
+
+    def _send(self, kind):
+        promises = self._pending.pop(kind)
+        self.batches += 1
+        if console.enabled:
+            console('._send: {} x{}', kind, len(promises))
+        self.event_loop.spawn(self._run(kind, promises))
+
+    def _run(self, kind, promises):
+        try:
+            records = yield self._fetch(kind, list(promises))
+        except Exception as exc:
+            for p in promises.values():
+                p._reject(exc)
+            return
+
+        for p, record in zip(promises.values(), records):
+            p._resolve(record)
@@ -0,0 +1,1385 @@
+"""Бенчмарки цикла событий
+
+    python bench.py              # все
+    python bench.py tracing ...  # выбранные
+"""
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import resource
+import selectors
+import socket
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import loadgen
+import log
+from async_socket import FRAME_HEADER, async_socket
+from event_loop import EventLoop
+from facade import Context
+from consts import KB, MS, SECOND
+from main import Client, get_user_balance
+from pollers import POLLERS, make_poller
+from memory import MemoryNetwork
+from metrics import format_slow_report
+from prefork import Supervisor
+from promise import CancelledError, Promise
+from promise import console as promise_console
+from server import AsyncHandler, Handler, KeepAliveHandler, KeepAliveServer, Server, TCPServer, serve
+from timers import Timer, TimerWheel
+from utils import gather, hrtime, is_generator, sleep, with_timeout
+import wire
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def run_loop(entry_point, *args, virtual=False):
+    """Запускает entry_point на новом цикле событий, возвращает время выполнения в секундах
+
+    virtual - цикл с виртуальными часами: таймеры срабатывают без ожидания, в замер попадает только работа
+    """
+    event_loop = EventLoop(virtual=virtual)
+    Context.set_event_loop(event_loop)
+    start = time.perf_counter()
+    event_loop.run(entry_point, *args)
+    return time.perf_counter() - start
+
+
+def start_slow_server(delay):
+    """Блокирующий сервер в потоке: читает запрос и отвечает через delay секунд. Возвращает адрес"""
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def serve():
+        with listener:
+            conn, _ = listener.accept()
+            with conn:
+                conn.recv(1024)
+                time.sleep(delay)
+                conn.sendall(b'pong\n')
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()
+
+
+def start_silent_server(backlog=KB):
+    """Сервер, который никогда не отвечает: соединения принимает ядро (очередь listen), а читать их некому
+
+    Returns: (addr, listener) - слушающий сокет закрыть после бенчмарка
+    """
+    listener = socket.create_server(('127.0.0.1', 0), backlog=backlog)
+    return listener.getsockname(), listener
+
+
+def start_full_server(backlog=0, pending=5):
+    """Сервер с заполненной очередью listen: SYN новых соединений ядро отбрасывает, и connect к нему висит
+
+    Returns: (addr, sockets) - слушающий сокет и соединения из очереди закрыть после бенчмарка
+    """
+    listener = socket.create_server(('127.0.0.1', 0), backlog=backlog)
+    sockets = [listener]
+    for _ in range(pending):
+        sock = socket.socket()
+        sock.setblocking(False)
+        sock.connect_ex(listener.getsockname())
+        sockets.append(sock)
+    return listener.getsockname(), sockets
+
+
+def quiet_handlers():
+    quiet = lambda self, message: None  # noqa
+    Handler.log = AsyncHandler.log = quiet
+
+
+def _serve(addr_queue, kind):
+    quiet_handlers()
+
+    if kind == 'EventLoop':
+        event_loop = EventLoop()
+        Context.set_event_loop(event_loop)
+        event_loop.run(serve, ('127.0.0.1', 0), AsyncHandler, KB, addr_queue.put)
+        return
+
+    server_cls, handler_cls = {
+        'TCPServer': (TCPServer, Handler),
+        'threads': (KeepAliveServer, KeepAliveHandler),
+    }[kind]
+    with server_cls(('127.0.0.1', 0), handler_cls) as server:
+        addr_queue.put(server.server_address)
+        server.serve_forever()
+
+
+def start_server(kind='EventLoop'):
+    """Сервер в отдельном процессе, чтобы не делить GIL с клиентом
+
+    kind: 'EventLoop' - server.serve, 'threads' - KeepAliveServer, 'TCPServer' - блокирующий однопоточный
+    Returns: (addr, process)
+    """
+    addr_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(addr_queue, kind), daemon=True)
+    process.start()
+    return addr_queue.get(), process
+
+
+@benchmark
+def tracing(tasks=100, steps=200):
+    """callbacks/sec с выключенной и включенной трассировкой (вывод в /dev/null)"""
+    def ticker(n):
+        for _ in range(n):
+            yield sleep(0)
+
+    def main():
+        yield [ticker(steps) for _ in range(tasks)]
+
+    # каждый sleep - колбек таймера (Promise._resolve) и колбек продолжения генератора
+    callbacks = tasks * steps * 2
+
+    with open(os.devnull, 'w') as devnull:
+        log.set_sink(devnull)
+        try:
+            for level in ('OFF', 'DEBUG', 'TRACE'):
+                log.set_level(level)
+                elapsed = run_loop(main)
+                print(f'tracing {level:<5}: {callbacks / elapsed:>12,.0f} callbacks/sec')
+        finally:
+            log.set_level('OFF')
+            log.set_sink(sys.stdout)
+
+
+@benchmark
+def metrics(tasks=100, steps=200, repeat=5):
+    """callbacks/sec с метриками цикла и без них; отчет о медленном колбеке"""
+    def ticker(n):
+        for _ in range(n):
+            yield sleep(0)
+
+    def main():
+        yield [ticker(steps) for _ in range(tasks)]
+
+    callbacks = tasks * steps * 2
+    best = {}
+    # лучший из повторов вперемешку: частота CPU и GC меняются между прогонами сильнее, чем цена метрик
+    for _ in range(repeat):
+        for enabled in (False, True):
+            event_loop = EventLoop(metrics=enabled)
+            Context.set_event_loop(event_loop)
+            start = time.perf_counter()
+            event_loop.run(main)
+            best[enabled] = max(best.get(enabled, 0), callbacks / (time.perf_counter() - start))
+    for enabled, rate in best.items():
+        print(f'metrics={enabled!s:<5}: {rate:>12,.0f} callbacks/sec')
+    # колбеки здесь пустые (sleep(0)): доля - худший случай, абсолютная цена - то, что добавится к настоящим
+    print(f'metrics overhead: {1 - best[True] / best[False]:.1%}, '
+          f'{1e9 / best[True] - 1e9 / best[False]:.0f} ns per callback')
+
+    def stall():
+        time.sleep(0.05)
+        yield sleep(0)
+
+    def slow_main():
+        yield [ticker(10), stall()]
+
+    event_loop = EventLoop(slow_callback_ms=20)
+    Context.set_event_loop(event_loop)
+    event_loop.run(slow_main)
+    snapshot = event_loop.snapshot()
+    for report in snapshot.pop('slow_callback_reports'):
+        print(f'slow callback {format_slow_report(report)}')
+    print(snapshot)
+
+
+@benchmark
+def wakeups(delay=0.5):
+    """Число вызовов async_socket._on_event за один запрос к серверу, отвечающему через delay секунд
+
+    Проверка регрессии: сокет без интереса к событиям не должен будить цикл. connect+send - не больше одного
+    пробуждения (готовность к записи после connect, send проходит сразу), ожидание ответа - ни одного, пока
+    сервер молчит, и одно на сам ответ. Постоянная подписка на EVENT_WRITE дала бы тысячи пробуждений.
+    """
+    addr = start_slow_server(delay)
+    calls = 0
+    phases = {}
+    on_event = async_socket._on_event
+
+    def counting_on_event(self, mask):
+        nonlocal calls
+        calls += 1
+        on_event(self, mask)
+
+    def request():
+        sock = async_socket(socket.AF_INET, socket.SOCK_STREAM)
+        yield sock.connect(addr)
+        try:
+            yield sock.sendall(b'ping\n')
+            phases['connect+send'] = calls
+            yield sleep(delay * 1e3 / 2)
+            phases['idle'] = calls - phases['connect+send']
+            yield sock.recv(1024)
+            phases['recv'] = calls - phases['connect+send'] - phases['idle']
+        finally:
+            sock.close()
+
+    async_socket._on_event = counting_on_event
+    try:
+        elapsed = run_loop(request)
+    finally:
+        async_socket._on_event = on_event
+    print(f'{calls} _on_event calls during {elapsed:.2f}s request: {phases}')
+    assert phases['connect+send'] <= 1, phases
+    assert phases['idle'] == 0, phases
+    assert phases['recv'] == 1, phases
+
+
+class HeapTimers:
+    """Прежняя схема TaskQueue: куча (tick, no, callback) + отмена пометкой (ленивое удаление)"""
+    def __init__(self):
+        self._heap = []
+        self._no = 0
+
+    def add(self, deadline, callback):
+        entry = [deadline, self._no, callback]
+        heapq.heappush(self._heap, entry)
+        self._no += 1
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        entry[2] = None
+
+    def __len__(self):
+        return len(self._heap)
+
+
+@benchmark
+def timers(pending=1_000_000, churn=1_000_000):
+    """Колесо таймеров против кучи: 1M ожидающих таймеров и поток таймаутов, которые почти все отменяются"""
+    deadlines = [random.randrange(SECOND, 60 * SECOND) for _ in range(pending)]
+
+    def wheel_impl():
+        wheel = TimerWheel(resolution=MS)
+        return wheel, wheel.add, Timer.cancel, lambda: wheel.expire(60 * SECOND)
+
+    def heap_impl():
+        heap = HeapTimers()
+
+        def expire():
+            while heap._heap:
+                heapq.heappop(heap._heap)
+        return heap, heap.add, heap.cancel, expire
+
+    for name, impl in (('wheel', wheel_impl), ('heap', heap_impl)):
+        timers, add, cancel, expire = impl()
+        start = time.perf_counter()
+        for deadline in deadlines:
+            add(deadline, None)
+        insert = time.perf_counter() - start
+        start = time.perf_counter()
+        expire()
+        expired = time.perf_counter() - start
+        print(f'{name:<5}: insert {pending / insert:>9,.0f}/s, expire {pending / expired:>11,.0f}/s')
+
+        tracemalloc.start()
+        timers, add, cancel, expire = impl()
+        for deadline in deadlines:
+            add(deadline, None)
+        full = tracemalloc.get_traced_memory()[0]
+        del timers, add, cancel, expire
+        tracemalloc.stop()
+
+        timers, add, cancel, expire = impl()
+        start = time.perf_counter()
+        for i in range(churn):
+            cancel(add(deadlines[i % pending], None))
+        elapsed = time.perf_counter() - start
+        print(f'{name:<5}: {full / 2 ** 20:.0f} MB with {pending:,} pending; '
+              f'{churn:,} add+cancel at {churn / elapsed:,.0f}/s leave {len(timers):,} entries')
+
+
+@benchmark
+def jitter(timers=2000, batch=20, load=20, work_us=100, max_delay_ms=50, bound_ms=1, p99_ms=10, seed=1):
+    """Точность таймеров без нагрузки и под нагрузкой: на виртуальных часах и на настоящих
+
+    Каждую мс запускается batch таймеров со случайной задержкой. Срабатывание раньше дедлайна недопустимо.
+
+    Виртуальные часы: load задач крутятся по sleep() меньше мс - в каждой итерации колеса таймеры делят партию
+    с чужими колбеками. Часы не идут, пока есть готовые колбеки, так что проверяется арифметика дедлайнов и
+    колеса: опоздание не больше bound_ms (тик), и тот же seed дает те же опоздания.
+
+    Настоящие часы: load задач на каждом шаге заняты work_us мкс CPU и уступают через sleep(0), опоздание
+    меряется hrtime(). Дедлайн считается от часов цикла в момент sleep(): устаревшие часы, таймаут селектора,
+    разошедшийся с monotonic_ns, и таймеры, которые колбеки отодвигают больше чем на итерацию, дают опоздание
+    p99 больше p99_ms. Ожидаемое под нагрузкой - до ~6 мс: тик колеса, округление таймаута селектора до мс,
+    итерация, в которую наступил дедлайн, и место таймера среди load колбеков sleep(0) следующей партии
+    (по load * work_us = 2 мс); p99_ms - с запасом на шум машины.
+    """
+    lateness = []
+    done = False
+
+    def churn(rnd):
+        while not done:
+            yield sleep(rnd.uniform(0.1, 1))
+
+    def spin():
+        while not done:
+            deadline = time.perf_counter_ns() + work_us * 1000
+            while time.perf_counter_ns() < deadline:
+                pass
+            yield sleep(0)
+
+    def timer(delay_ms, clock):
+        scheduled = Context.event_loop.time()
+        yield sleep(delay_ms)
+        lateness.append((clock() - scheduled) / MS - delay_ms)
+
+    def main(busy, virtual):
+        nonlocal done
+        rnd = random.Random(seed)
+        clock = Context.event_loop.time if virtual else hrtime
+        busy_tasks = gather((churn(rnd) if virtual else spin()) for _ in range(busy))
+        tasks = []
+        for _ in range(timers // batch):
+            tasks.extend(Context.event_loop.spawn(timer(rnd.uniform(0, max_delay_ms), clock)) for _ in range(batch))
+            yield sleep(1)
+        yield tasks
+        done = True
+        yield busy_tasks
+
+    def run(busy, virtual):
+        nonlocal done
+        lateness.clear()
+        done = False
+        Context.set_event_loop(EventLoop(virtual=virtual, seed=seed if virtual else None))
+        Context.event_loop.run(main, busy, virtual)
+        return sorted(lateness)
+
+    for virtual in (True, False):
+        for busy in (0, load):
+            result = run(busy, virtual)
+            p = lambda q: result[min(len(result) - 1, int(q * len(result)))]  # noqa
+            print(f'{"virtual" if virtual else "real":<7} clock, {len(result)} timers, {busy} busy tasks: '
+                  f'lateness p50 {p(0.5):.3f} ms, p99 {p(0.99):.3f} ms, min {result[0]:.3f} ms, '
+                  f'max {result[-1]:.3f} ms')
+            assert len(result) == timers, len(result)
+            assert result[0] >= 0, f'timer fired {-result[0]:.3f} ms early'
+            if virtual:
+                assert result[-1] <= bound_ms, f'timer fired {result[-1]:.3f} ms late, bound {bound_ms} ms'
+                assert run(busy, virtual) == result, 'lateness differs between runs with the same seed'
+            else:
+                # максимум на настоящих часах - это планировщик ОС, граница - на p99
+                assert p(0.99) <= p99_ms, f'p99 lateness {p(0.99):.3f} ms, bound {p99_ms} ms'
+
+
+@benchmark
+def iteration(pairs=200, duration=2.0, period_ms=1):
+    """callbacks/sec и опоздание периодического таймера при непрерывном i/o на pairs парах сокетов"""
+    lateness = []
+    done = False
+
+    def ping_pong(a, b):
+        message = b'x' * 64
+        while not done:
+            yield a.sendall(message)
+            yield b.recv(64)
+        a.close()
+        b.close()
+
+    def ticker():
+        while not done:
+            scheduled = Context.event_loop.time()
+            yield sleep(period_ms)
+            lateness.append((hrtime() - scheduled) / MS - period_ms)
+
+    def main():
+        nonlocal done
+        socks = [socket.socketpair() for _ in range(pairs)]
+        tasks = gather(ping_pong(async_socket(sock=a), async_socket(sock=b)) for a, b in socks)
+        timer = Context.event_loop.spawn(ticker())
+        yield sleep(duration * 1000)
+        done = True
+        yield [timer, tasks]
+
+    elapsed = run_loop(main)
+    snapshot = Context.event_loop.snapshot()
+    lateness.sort()
+    print(f'{pairs} socket pairs: {snapshot["callbacks"] / elapsed:>10,.0f} callbacks/sec, '
+          f'{snapshot["polls"] / elapsed:>8,.0f} polls/sec; {period_ms} ms timer lateness '
+          f'p50 {lateness[len(lateness) // 2]:.2f} ms, max {lateness[-1]:.2f} ms over {len(lateness)} ticks')
+
+
+def burn(n):
+    """CPU-bound работа на чистом Python - держит GIL все время"""
+    return sum(i * i for i in range(n))
+
+
+@benchmark
+def executor(jobs=8, n=1_000_000, block_ms=50, period_ms=1):
+    """Опоздание таймера с периодом period_ms, пока выполняются jobs блокирующих или CPU-bound задач:
+    прямо в цикле, через run_in_executor в пуле потоков и в пуле процессов"""
+    lateness = []
+    done = False
+    works = {
+        'sleep': partial(time.sleep, block_ms / 1000),
+        'cpu': partial(burn, n),
+    }
+
+    def ticker():
+        while not done:
+            scheduled = Context.event_loop.time()
+            yield sleep(period_ms)
+            lateness.append((hrtime() - scheduled) / MS - period_ms)
+
+    def run(work, mode, processes):
+        if mode == 'inline':
+            return work()
+        return (yield Context.event_loop.run_in_executor(work, executor=processes if mode == 'processes' else None))
+
+    def main(work, mode, processes):
+        nonlocal done
+        timer = Context.event_loop.spawn(ticker())
+        # тикер успевает стартовать до начала работы
+        yield sleep(period_ms * 5)
+        yield [run(work, mode, processes) for _ in range(jobs)]
+        done = True
+        yield timer
+
+    with ProcessPoolExecutor(max_workers=2) as processes:
+        processes.submit(int).result()  # процессы стартуют заранее, а не внутри замера
+        for name, work in works.items():
+            for mode in ('inline', 'threads', 'processes'):
+                if name == 'sleep' and mode == 'processes':
+                    continue
+                lateness.clear()
+                done = False
+                elapsed = run_loop(partial(main, work, mode, processes))
+                lateness.sort()
+                print(f'{jobs} x {name:<5} {mode:<9}: {elapsed:>5.2f}s, {len(lateness):>4} ticks, '
+                      f'lateness p50 {lateness[len(lateness) // 2]:>6.2f} ms, max {lateness[-1]:>7.2f} ms')
+
+
+@benchmark
+def pool(requests=3000, concurrency=5):
+    """requests/sec к локальному серверу: пул keep-alive соединений против соединения на запрос"""
+    addr, server = start_server()
+
+    def main(pooled):
+        client = Client(addr, pool=pooled, max_size=concurrency, cache=False)
+        yield gather((client.get_user(i % 100) for i in range(requests)), max_concurrency=concurrency)
+
+    try:
+        for pooled in (True, False):
+            elapsed = run_loop(partial(main, pooled))
+            print(f'pool={pooled!s:<5}: {requests / elapsed:>8,.0f} requests/sec')
+    finally:
+        server.terminate()
+
+
+@benchmark
+def cache(lookups=20000, keys=10000, s=1.1, concurrency=50):
+    """get_user с Zipf-распределением ключей: без кэша и с ResponseCache
+
+    hits - ответ из кэша, coalesced - ожидание уже идущего запроса того же ключа, misses - запрос в сеть.
+    """
+    addr, server = start_server()
+    ids = random.Random(1).choices(range(1, keys + 1), [1 / k ** s for k in range(1, keys + 1)], k=lookups)
+
+    def main(cached, stats):
+        client = Client(addr, max_size=concurrency, cache=cached)
+        yield gather((client.get_user(i) for i in ids), max_concurrency=concurrency)
+        if cached:
+            stats.update(Client.get_cache(addr).stats())
+
+    try:
+        for cached in (False, True):
+            stats = {'misses': lookups}
+            elapsed = run_loop(partial(main, cached, stats))
+            print(f'cache={cached!s:<5}: {lookups / elapsed:>8,.0f} lookups/sec, '
+                  f'{stats["misses"]:>6} network requests, {stats.get("hits", 0):>6} hits, '
+                  f'{stats.get("coalesced", 0):>5} coalesced')
+    finally:
+        server.terminate()
+
+
+@benchmark
+def mget(lookups=10000, concurrency=10, window_ms=1):
+    """lookups пользователей: по GET на каждого (concurrency соединений), Client.mget одним вызовом и
+    автоматические пакеты - все get_user сразу, Batcher собирает их за window_ms в MGET
+
+    Задержка - от вызова до результата одного поиска; round trips - запросов к серверу.
+    """
+    addr, server = start_server()
+    ids = list(range(1, lookups + 1))
+
+    def timed(lookup, latencies):
+        start = hrtime()
+        yield lookup
+        latencies.append(hrtime() - start)
+
+    def main(mode, latencies, stats):
+        if mode == 'GET':
+            client = Client(addr, max_size=concurrency, cache=False)
+            yield gather((timed(client.get_user(i), latencies) for i in ids), max_concurrency=concurrency)
+            stats['round_trips'] = lookups
+        elif mode == 'mget':
+            client = Client(addr, max_size=concurrency, cache=False)
+            start = hrtime()
+            yield client.mget('user', ids)
+            latencies.extend([hrtime() - start] * lookups)
+            stats['round_trips'] = -(-lookups // client.mget_size)
+        else:
+            client = Client(addr, max_size=concurrency, cache=False, batch_window=window_ms)
+            yield [timed(client.get_user(i), latencies) for i in ids]
+            stats['round_trips'] = Client.get_batcher(addr).batches
+
+    try:
+        for mode in ('GET', 'mget', 'batched'):
+            latencies, stats = [], {}
+            elapsed = run_loop(partial(main, mode, latencies, stats))
+            latencies.sort()
+            p50, p99 = (latencies[int(len(latencies) * q)] / MS for q in (0.5, 0.99))
+            print(f'{mode:<7}: {elapsed * 1000:>7.0f} ms total, {stats["round_trips"]:>6} round trips, '
+                  f'latency p50 {p50:>7.1f} ms, p99 {p99:>7.1f} ms')
+    finally:
+        server.terminate()
+
+
+@benchmark
+def protocol(records=1000, requests=5000, lookups=10000, concurrency=10):
+    """JSON против бинарного протокола wire.py
+
+    Кодирование и разбор записи пользователя (по одной - как ответ на GET, пачкой records - как MGET),
+    затем requests/sec get_user и lookups пользователей через mget с обоими протоколами.
+    """
+    # ответы сервера: разбор запроса, поиск и кодирование - Handler.respond, как в обработчиках
+    ids = range(1, records + 1)
+    Handler.users.update({str(i): {'id': str(i), 'name': f'{i:08x}', 'account_id': str(i)} for i in ids})
+    requests_by_protocol = {
+        'json': (b'GET user 1\n', f'MGET user {" ".join(map(str, ids))}\n'.encode('utf8')),
+        'binary': (wire.encode_request('GET', 'user', [1])[FRAME_HEADER.size:],
+                   wire.encode_request('MGET', 'user', ids)[FRAME_HEADER.size:]),
+    }
+
+    def respond(req, binary):
+        return b''.join(Handler.respond(req, binary))
+
+    def decode_json(data):
+        # кадры JSON, как читает Client._read_records
+        offset, result = 0, []
+        while offset < len(data):
+            size, = FRAME_HEADER.unpack_from(data, offset)
+            offset += FRAME_HEADER.size
+            result.append(json.loads(data[offset:offset + size]))
+            offset += size
+        return result
+
+    def decode_binary(data):
+        return wire.decode_records('user', memoryview(data)[FRAME_HEADER.size:])
+
+    cases = {}
+    for name, binary in (('json', False), ('binary', True)):
+        get, mget = requests_by_protocol[name]
+        get_resp, mget_resp = respond(get, binary), respond(mget, binary)
+        cases[name] = [
+            partial(respond, get, binary),
+            partial(json.loads, get_resp) if not binary else partial(decode_binary, get_resp),
+            partial(respond, mget, binary),
+            partial(decode_json if not binary else decode_binary, mget_resp),
+        ]
+    for i, name in enumerate(('respond 1', 'decode 1', f'respond {records}', f'decode {records}')):
+        json_time, binary_time = (min(timeit.repeat(cases[protocol][i], number=100, repeat=5)) / 100
+                                  for protocol in ('json', 'binary'))
+        print(f'{name:<13}: json {json_time * 1e6:>9.1f} us, binary {binary_time * 1e6:>9.1f} us '
+              f'({json_time / binary_time:.1f}x)')
+
+    addr, server = start_server()
+
+    def main(binary, mode):
+        client = Client(addr, max_size=concurrency, cache=False, binary=binary)
+        if mode == 'get':
+            yield gather((client.get_user(i % 100) for i in range(requests)), max_concurrency=concurrency)
+        else:
+            yield client.mget('user', range(1, lookups + 1))
+
+    def fetch(binary, ids, found):
+        client = Client(addr, cache=False, binary=binary)
+        found[binary] = yield [client.get_user(ids[0]), client.mget('user', ids)]
+
+    try:
+        # id не влезают в uint32: бинарный протокол отвечает то же, что JSON (id в записях wire - целые)
+        found = {}
+        for binary in (False, True):
+            run_loop(fetch, binary, [2 ** 32 + 5, 2 ** 64 - 1], found)
+        user, users = found[True]
+        assert [{key: str(value) for key, value in record.items()} for record in [user, *users]] == \
+            [found[False][0], *found[False][1]], found
+
+        for binary in (False, True):
+            get = requests / run_loop(partial(main, binary, 'get'))
+            mget = lookups / run_loop(partial(main, binary, 'mget'))
+            print(f'{"binary" if binary else "json":<6}: get_user {get:>8,.0f} requests/sec, '
+                  f'mget {mget:>9,.0f} lookups/sec')
+    finally:
+        server.terminate()
+
+
+@benchmark
+def server(clients=1000, requests=3000):
+    """requests/sec при clients одновременных клиентах (соединение на запрос) для разных серверов"""
+    errors = []
+
+    def main(addr):
+        client = Client(addr, pool=False, cache=False)
+        results = yield gather((client.get_user(i % 100) for i in range(requests)),
+                               return_exceptions=True, max_concurrency=clients)
+        errors.extend(r for r in results if isinstance(r, Exception))
+
+    for kind in ('EventLoop', 'threads', 'TCPServer'):
+        errors.clear()
+        addr, process = start_server(kind)
+        try:
+            elapsed = run_loop(partial(main, addr))
+        finally:
+            process.terminate()
+        print(f'{kind:<9}: {requests / elapsed:>8,.0f} requests/sec, {len(errors)} errors')
+
+
+def _load(addr, requests, concurrency, results):
+    errors = []
+
+    def main():
+        client = Client(addr, max_size=concurrency, cache=False)
+        responses = yield gather((client.get_user(i % 100) for i in range(requests)),
+                                 return_exceptions=True, max_concurrency=concurrency)
+        errors.extend(r for r in responses if isinstance(r, Exception))
+
+    run_loop(main)
+    results.put(len(errors))
+
+
+@benchmark
+def prefork(workers=(1, 2, 4), clients=4, requests=5000, concurrency=10):
+    """requests/sec prefork-сервера с разным числом воркеров под нагрузкой clients процессов по concurrency
+    keep-alive соединений; последний прогон - с Supervisor.restart() посреди нагрузки
+
+    Рост почти линейный, пока воркеров и клиентов вместе не больше ядер: на одном ядре они делят его между
+    собой и requests/sec от числа воркеров не зависит.
+    """
+    print(f'{os.cpu_count()} cores')
+    quiet_handlers()
+    runs = [(n, False) for n in workers] + [(workers[-1], True)]
+    for n, restart in runs:
+        supervisor = Supervisor(('127.0.0.1', 0), n, grace=1000)
+        supervisor.start()
+        results = multiprocessing.Queue()
+        loads = [multiprocessing.Process(target=_load, args=(supervisor.addr, requests, concurrency, results))
+                 for _ in range(clients)]
+
+        start = time.perf_counter()
+        for process in loads:
+            process.start()
+        if restart:
+            time.sleep(0.5)
+            supervisor.restart()
+        errors = sum(results.get() for _ in loads)
+        elapsed = time.perf_counter() - start
+        for process in loads:
+            process.join()
+
+        stats = supervisor.stats()
+        supervisor.stop()
+        supervisor.run()
+
+        total = clients * requests
+        shares = ' '.join(f'{worker["requests"] / max(stats["requests"], 1):.0%}' for worker in stats['workers'])
+        print(f'{n} workers{" +restart" if restart else "":<9}: {total / elapsed:>8,.0f} requests/sec, '
+              f'{errors} errors, requests by worker: {shares}')
+        # перезапуск не теряет запросов: старые воркеры отвечают всем, кого уже приняли, новые - остальным
+        assert errors == 0, errors
+
+
+@benchmark
+def load(duration=3.0, concurrency=50):
+    """loadgen.run: сервер на том же цикле и в отдельном процессе, равномерные и zipf-ключи, GET и MGET по 20"""
+    for server, distribution, payload in (('inproc', 'uniform', 1), ('process', 'uniform', 1),
+                                          ('process', 'zipf', 1), ('process', 'zipf', 20)):
+        report = loadgen.run(concurrency, duration, warmup=0.5, distribution=distribution, payload=payload,
+                             server=server)
+        print(f'{server:<7} {distribution:<7} payload={payload:<2}: {loadgen.summary(report)}')
+
+
+@benchmark
+def pollers(sizes=(1000, 10_000), round_trips=20_000, rounds=10):
+    """Бэкенды опроса i/o (pollers.py) при size зарегистрированных сокетах (size // 2 socketpair, на каждом
+    сокете ждет recv)
+
+    idle - одна пара обменивается round_trips сообщениями, остальные молчат: цена опроса от числа fd;
+    busy - все пары обмениваются rounds раз одновременно: партии из тысяч событий;
+    poll(0) - сам опрос бэкенда, когда все size сокетов готовы к чтению: цена превращения событий в партию.
+    select не опрашивает fd >= FD_SETSIZE (1024) - для 10k сокетов его нет.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    need = max(sizes) + KB
+    if soft != resource.RLIM_INFINITY and soft < need:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (need if hard == resource.RLIM_INFINITY else min(need, hard),
+                                                    hard))
+
+    def ping(sock, n):
+        for _ in range(n):
+            yield sock.sendall(b'x')
+            yield sock.recv(1)
+
+    def echo(sock, n):
+        for _ in range(n):
+            yield sock.sendall((yield sock.recv(1)))
+
+    def main(size, busy, result):
+        conns = [async_socket(sock=sock) for pair in (socket.socketpair() for _ in range(size // 2)) for sock in pair]
+        pairs = list(zip(conns[::2], conns[1::2]))
+        if busy:
+            flows = [flow for a, b in pairs for flow in (ping(a, rounds), echo(b, rounds))]
+            result['round_trips'] = len(pairs) * rounds
+        else:
+            idle = [sock.recv(1) for sock in conns[2:]]
+            flows = [ping(pairs[0][0], round_trips), echo(pairs[0][1], round_trips)]
+            result['round_trips'] = round_trips
+            result['fds_polled'] = Context.event_loop.snapshot()['fds_polled']
+
+        start = time.perf_counter()
+        yield flows
+        result['elapsed'] = time.perf_counter() - start
+        if not busy:
+            for p in idle:
+                p.cancel()
+        for sock in conns:
+            sock.close()
+
+    def ready_poll(name, size):
+        poller = make_poller(name)
+        socks = [socket.socketpair() for _ in range(size // 2)]
+        try:
+            for a, b in socks:
+                a.send(b'x')
+                b.send(b'x')
+                poller.register(a.fileno(), selectors.EVENT_READ, None)
+                poller.register(b.fileno(), selectors.EVENT_READ, None)
+            assert len(poller.poll(0)) == size
+            return min(timeit.repeat(partial(poller.poll, 0), number=20, repeat=5)) / 20
+        finally:
+            poller.close()
+            for pair in socks:
+                for sock in pair:
+                    sock.close()
+
+    for size in sizes:
+        for busy in (False, True):
+            for name in sorted(POLLERS):
+                label = f'{size:>6} sockets, {"busy" if busy else "idle"}, {name:<9}'
+                if name == 'select' and size > 1000:
+                    print(f'{label}: n/a, fd >= FD_SETSIZE')
+                    continue
+                result = {}
+                event_loop = EventLoop(poller=name)
+                Context.set_event_loop(event_loop)
+                event_loop.run(main, size, busy, result)
+                print(f'{label}: {result["round_trips"] / result["elapsed"]:>9,.0f} round trips/sec'
+                      + (f' ({result["fds_polled"]} fds polled)' if not busy else ''))
+        for name in sorted(POLLERS):
+            if name == 'select' and size > 1000:
+                continue
+            elapsed = ready_poll(name, size)
+            print(f'{size:>6} sockets, poll(0), {name:<9}: {elapsed * 1e3:>7.2f} ms, '
+                  f'{elapsed / size * 1e9:>5.0f} ns per ready fd')
+
+
+def legacy_unwind(generator, on_success, on_exceptions, to_generator=None, method='send'):
+    """Прежний рекурсивный utils.unwind (без трассировки и списков) - эталон для сравнения с Task"""
+    try:
+        returned = getattr(generator, method)(to_generator)
+    except StopIteration as stop:
+        return on_success(to_generator=stop.value) if on_success else None
+    except Exception as exc:
+        return on_exceptions(to_generator=exc)
+
+    if is_generator(returned):
+        legacy_unwind(
+            returned,
+            on_success=partial(legacy_unwind, generator, on_success, on_exceptions),
+            on_exceptions=partial(legacy_unwind, generator, on_success, on_exceptions, method='throw'),
+        )
+    else:
+        returned.then(
+            partial(legacy_unwind, generator, on_success, on_exceptions)
+        ).catch(
+            partial(legacy_unwind, generator, on_success, on_exceptions, method='throw')
+        )
+
+
+@benchmark
+def timeouts(requests=500, timeout_ms=200, round_trips=30000):
+    """Зависший сервер: запросы с таймаутом завершаются TimeoutError в срок и освобождают fd и таймеры;
+    цена таймаута на каждой операции - обмен строками по socketpair с ним и без
+
+    Проверки: recv сервера, который не отвечает, и connect к серверу с заполненной очередью listen под
+    settimeout и под with_timeout бросают TimeoutError не раньше срока, а после прогона на цикле не остается
+    ни зарегистрированных fd, ни таймеров колеса. Срок with_timeout на общем промисе не отменяет его для
+    второго ожидающего.
+    """
+    addr, listener = start_silent_server()
+    full_addr, backlog = start_full_server()
+    result = {}
+
+    def request(client, user_id):
+        try:
+            yield client.get_user(user_id)
+        except TimeoutError:
+            return 'timeout'
+
+    def main():
+        client = Client(addr, pool=False, cache=False, binary=False, timeout=timeout_ms)
+        outcomes = yield [request(client, i) for i in range(requests)]
+        result['timeouts'] = outcomes.count('timeout')
+
+    def deadline():
+        # без таймаута сокета: общий срок на генератор, recv снимается с селектора отменой
+        sock = async_socket(socket.AF_INET, socket.SOCK_STREAM)
+        yield sock.connect(addr)
+        try:
+            yield with_timeout(sock.recv(1024), timeout_ms)
+        except TimeoutError as exc:
+            result['with_timeout'] = exc
+            result['fds_polled'] = Context.event_loop.snapshot()['fds_polled']
+        finally:
+            sock.close()
+
+    def connects():
+        # SYN не принимается: connect обрывает таймаут сокета, затем общий срок with_timeout
+        for name in ('settimeout', 'with_timeout'):
+            sock = async_socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                if name == 'settimeout':
+                    sock.settimeout(timeout_ms)
+                    yield sock.connect(full_addr)
+                else:
+                    yield with_timeout(sock.connect(full_addr), timeout_ms)
+            except TimeoutError as exc:
+                result[f'connect {name}'] = exc
+            finally:
+                sock.close()
+
+    def shared():
+        # срок одного из ожидающих общего промиса не отменяет его для второго
+        p = sleep(2 * timeout_ms)
+
+        def impatient():
+            try:
+                yield with_timeout(p, timeout_ms)
+            except TimeoutError as exc:
+                result['shared with_timeout'] = exc
+
+        def patient():
+            yield p
+            result['shared waited'] = True
+
+        yield [impatient(), patient()]
+
+    def check(name, elapsed, min_elapsed):
+        stats = Context.event_loop.snapshot()
+        print(f'{name}: {elapsed:.2f}s; left: {stats["fds"]} fds, {stats["timers"]} timers')
+        assert elapsed >= min_elapsed, f'{name}: finished in {elapsed:.3f}s, before the {timeout_ms} ms timeout'
+        assert stats['fds'] == 0 and stats['timers'] == 0, \
+            f'{name}: {stats["fds"]} fds and {stats["timers"]} timers left after the run'
+
+    try:
+        elapsed = run_loop(main)
+        print(f'{result["timeouts"]} of {requests} requests to a silent server timed out after {timeout_ms} ms')
+        assert result['timeouts'] == requests, result['timeouts']
+        check('recv settimeout', elapsed, timeout_ms / 1e3)
+
+        elapsed = run_loop(deadline)
+        print(f'with_timeout(recv): {result["with_timeout"]!r}, {result["fds_polled"]} fds polled after cancel')
+        assert isinstance(result.get('with_timeout'), TimeoutError), result.get('with_timeout')
+        assert result['fds_polled'] == 0, result['fds_polled']
+        check('recv with_timeout', elapsed, timeout_ms / 1e3)
+
+        elapsed = run_loop(connects)
+        for name in ('settimeout', 'with_timeout'):
+            print(f'connect {name}: {result.get(f"connect {name}")!r}')
+            assert isinstance(result.get(f'connect {name}'), TimeoutError), result.get(f'connect {name}')
+        check('connect', elapsed, 2 * timeout_ms / 1e3)
+
+        elapsed = run_loop(shared)
+        print(f'shared promise: {result.get("shared with_timeout")!r} for one waiter, '
+              f'the other resumed: {"shared waited" in result}')
+        assert isinstance(result.get('shared with_timeout'), TimeoutError), result.get('shared with_timeout')
+        assert 'shared waited' in result, 'with_timeout cancelled a promise another task was waiting on'
+        check('shared', elapsed, 2 * timeout_ms / 1e3)
+    finally:
+        listener.close()
+        for sock in backlog:
+            sock.close()
+
+    def ping_pong(timeout):
+        a, b = socket.socketpair()
+        ping, pong = async_socket(sock=a), async_socket(sock=b)
+        ping.settimeout(timeout)
+        pong.settimeout(timeout)
+
+        def client():
+            for _ in range(round_trips):
+                yield ping.sendall(b'ping\n')
+                yield ping.readline()
+            ping.close()
+
+        def server():
+            while (yield pong.readline()):
+                yield pong.sendall(b'pong\n')
+            pong.close()
+
+        yield [client(), server()]
+
+    best = {}
+    for _ in range(3):
+        for timeout in (None, 10000):
+            best[timeout] = max(best.get(timeout, 0), round_trips / run_loop(partial(ping_pong, timeout)))
+    for timeout, rate in best.items():
+        print(f'timeout={timeout!s:<5}: {rate:>9,.0f} round trips/sec')
+
+
+@benchmark
+def cancellation(tasks=10000, requests=200, hedge_ms=5):
+    """Task.cancel(): отмена задач, ждущих таймеров (finally выполняются, колесо пустеет); hedged-запросы -
+    первый к зависшему серверу, через hedge_ms второй к рабочему, проигравший отменяется и закрывает соединение"""
+    result = {'finally': 0}
+
+    def sleeper():
+        try:
+            yield sleep(60000)
+        finally:
+            result['finally'] += 1
+
+    def cancel_sleepers():
+        spawned = [Context.event_loop.spawn(sleeper()) for _ in range(tasks)]
+        result['timers'] = Context.event_loop.snapshot()['timers']
+        start = time.perf_counter()
+        for task in spawned:
+            task.cancel()
+        result['elapsed'] = time.perf_counter() - start
+        result['cancelled'] = sum(isinstance(task._value, CancelledError) for task in spawned)
+        result['timers_left'] = Context.event_loop.snapshot()['timers']
+        yield sleep(0)
+
+    run_loop(cancel_sleepers)
+    print(f'{result["cancelled"]} of {tasks} sleeping tasks cancelled at '
+          f'{tasks / result["elapsed"]:,.0f}/sec, {result["finally"]} finally blocks ran, '
+          f'timers {result["timers"]} -> {result["timers_left"]}')
+
+    order = []
+
+    def loser(name):
+        try:
+            yield sleep(60000)
+        finally:
+            order.append(f'{name} finally')
+
+    def winner():
+        yield sleep(1)
+        return 'won'
+
+    def failing():
+        yield sleep(1)
+        raise ValueError('failed')
+
+    def siblings():
+        # проигравшие (задача и таймер) отменены, а их finally выполнены до того, как родитель продолжит
+        yield gather([loser('first_completed'), sleep(60000), winner()], first_completed=True)
+        order.append(('first_completed', Context.event_loop.snapshot()['timers']))
+        try:
+            yield gather([loser('fail-fast'), sleep(60000), failing()])
+        except ValueError:
+            order.append(('fail-fast', Context.event_loop.snapshot()['timers']))
+
+    run_loop(siblings)
+    print(f'gather losers before the parent continues: {order}')
+    assert order == ['first_completed finally', ('first_completed', 0), 'fail-fast finally', ('fail-fast', 0)], order
+
+    silent_addr, listener = start_silent_server()
+    addr, process = start_server()
+
+    def delayed(generator, ms):
+        yield sleep(ms)
+        return (yield generator)
+
+    def hedged(i):
+        stuck = Client(silent_addr, pool=False, cache=False, binary=False, timeout=None)
+        backup = Client(addr, pool=False, cache=False, timeout=None)
+        return (yield gather([stuck.get_user(i), delayed(backup.get_user(i), hedge_ms)], first_completed=True))
+
+    def main():
+        users = yield [hedged(i) for i in range(requests)]
+        result['users'] = sum(user is not None for user in users)
+        yield sleep(1)
+        result['stats'] = Context.event_loop.snapshot()
+
+    try:
+        elapsed = run_loop(main)
+    finally:
+        listener.close()
+        process.terminate()
+    stats = result['stats']
+    print(f'{result["users"]} of {requests} hedged requests answered in {elapsed:.2f}s, losers cancelled: '
+          f'{stats["fds"]} fds, {stats["timers"]} timers left')
+
+
+@benchmark
+def simulation(flows=2000, max_delay_ms=120_000, latency_ms=1, jitter_ms=2):
+    """Виртуальное время и сеть в памяти: flows задач get_user_balance, каждая спит до max_delay_ms; один seed -
+    один и тот же ход симуляции, другой - другой порядок. Таймаут клиента к молчащему серверу - без ожидания"""
+    quiet_handlers()
+
+    def simulate(seed):
+        random.seed(seed)
+        Handler.seed = seed
+        network = MemoryNetwork(latency=latency_ms, jitter=jitter_ms, seed=seed)
+        event_loop = EventLoop(virtual=True, seed=seed, network=network)
+        Context.set_event_loop(event_loop)
+        trace = []
+
+        def flow(addr, user_id):
+            yield sleep(random.randint(0, max_delay_ms))
+            try:
+                balance = yield get_user_balance(addr, user_id)
+            except Exception as exc:
+                balance = repr(exc)
+            trace.append((event_loop.time(), user_id, balance))
+
+        def main():
+            server = Server(('10.0.0.1', 80))
+            event_loop.spawn(server.serve())
+            yield [flow(server.getsockname(), i) for i in range(flows)]
+            server.stop(0)
+
+        start = time.perf_counter()
+        event_loop.run(main)
+        elapsed = time.perf_counter() - start
+        digest = hashlib.sha1(repr(trace).encode()).hexdigest()[:12]
+        print(f'seed {seed}: {len(trace)} flows, {event_loop.time() / SECOND:.1f}s virtual in {elapsed:.2f}s, '
+              f'{network.connections} connections, trace {digest}')
+
+    def silent():
+        # слушает, но не принимает: запрос ждет ответа до таймаута клиента
+        network = MemoryNetwork(latency=latency_ms)
+        event_loop = EventLoop(virtual=True, network=network)
+        Context.set_event_loop(event_loop)
+        listener = async_socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('10.0.0.2', 80))
+        listener.listen()
+        outcome = []
+
+        def main():
+            try:
+                yield Client(listener.getsockname(), timeout=10000).get_user(1)
+            except TimeoutError as exc:
+                outcome.append(exc)
+            outcome.append(event_loop.time())
+            listener.close()
+
+        start = time.perf_counter()
+        event_loop.run(main)
+        print(f'silent server: {outcome[0]!r} at {outcome[1] / SECOND:.3f}s virtual, '
+              f'{(time.perf_counter() - start) * 1000:.1f} ms real')
+
+    try:
+        for seed in (1, 1, 2):
+            simulate(seed)
+        silent()
+    finally:
+        Handler.seed = None
+        Handler.users, Handler.accounts = {}, {}
+        random.seed()
+
+
+class ListPromise(Context):
+    """Прежняя схема Promise: __dict__, два списка колбеков, выполнение через EventLoop._execute (проверки
+    трассировки - как были)"""
+    def __init__(self):
+        self._on_resolve = []
+        self._on_reject = []
+        self._resolved = False
+        self._rejected = False
+        self._value = None
+        self._canceller = None
+
+    def then(self, callback):
+        if promise_console.tracing:
+            promise_console.trace('.then(callback={})', callback)
+        if self._resolved:
+            self.event_loop._execute(callback, *self._value)
+        elif not self._rejected:
+            self._on_resolve.append(callback)
+        return self
+
+    def catch(self, callback):
+        if promise_console.tracing:
+            promise_console.trace('.catch(callback={})', callback)
+        if self._rejected:
+            self.event_loop._execute(callback, self._value)
+        elif not self._resolved:
+            self._on_reject.append(callback)
+        return self
+
+    def _resolve(self, *args):
+        tracing = promise_console.tracing
+        if tracing:
+            promise_console.trace('._resolve(args={})', args)
+        if self._resolved or self._rejected:
+            return
+        self._resolved = True
+        self._value = args
+        if tracing and self._on_resolve:
+            promise_console.trace('._resolve: {}', self._on_resolve)
+        for callback in self._on_resolve:
+            self.event_loop._execute(callback, *args)
+
+
+@benchmark
+def promises(n=200_000, pending=1_000_000, fan_in=10_000):
+    """Promise против прежней схемы (ListPromise): создание и выполнение в секунду, память на ожидающий промис
+    с then+catch при pending ожидающих; Promise.all на fan_in промисов"""
+    Context.set_event_loop(EventLoop())
+    noop = lambda *_: None  # noqa
+
+    def bare(cls):
+        for _ in range(n):
+            cls()._resolve(1)
+
+    def subscribed(cls):
+        for _ in range(n):
+            cls().then(noop).catch(noop)._resolve(1)
+
+    for cls in (ListPromise, Promise):
+        rates = [n / min(timeit.repeat(partial(case, cls), number=1, repeat=5)) for case in (bare, subscribed)]
+        tracemalloc.start()
+        held = [cls().then(noop).catch(noop) for _ in range(pending)]
+        size = tracemalloc.get_traced_memory()[0] / pending
+        tracemalloc.stop()
+        del held
+        print(f'{cls.__name__:<11}: create+resolve {rates[0]:>11,.0f}/sec, +then+catch {rates[1]:>11,.0f}/sec, '
+              f'{size:>5.0f} B per pending promise')
+
+    def all_of():
+        ps = [Promise() for _ in range(fan_in)]
+        pall = Promise.all(ps)
+        for i, p in enumerate(ps):
+            p._resolve(i)
+        assert pall._value[0][-1] == fan_in - 1
+
+    elapsed = min(timeit.repeat(all_of, number=1, repeat=5))
+    print(f'Promise.all({fan_in}): {elapsed * 1e3:.1f} ms, {elapsed / fan_in * 1e9:.0f} ns per promise')
+
+
+@benchmark
+def nesting(depths=(10, 100, 1000), calls=2000):
+    """Цепочка вложенных вызовов глубины depth: yield-делегирование через Task и рекурсивный unwind
+    против await в async def, где задача видит только промис в самом низу
+
+    Вложенный await - настоящая рекурсия на стеке интерпретатора: глубина цепочки корутин ограничена
+    sys.getrecursionlimit(), стек задачи - нет."""
+    def chain(depth):
+        if not depth:
+            yield sleep(0)
+            return 0
+        return (yield chain(depth - 1)) + 1
+
+    def driver(depth, done=None):
+        for _ in range(calls):
+            yield chain(depth)
+        if done is not None:
+            done.append(True)
+
+    async def async_chain(depth):
+        if not depth:
+            await sleep(0)
+            return 0
+        return await async_chain(depth - 1) + 1
+
+    async def async_driver(depth, done):
+        for _ in range(calls):
+            await async_chain(depth)
+        done.append(True)
+
+    def entry_point(name, depth, done):
+        if name == 'Task':
+            return partial(driver, depth, done)
+        if name == 'await':
+            return partial(async_driver, depth, done)
+
+        def on_done(to_generator):
+            done.append(to_generator)
+        return partial(legacy_unwind, driver(depth), on_done, on_done)
+
+    for depth in depths:
+        nested_calls = calls * (depth + 1)
+        for name in ('Task', 'unwind', 'await'):
+            done = []
+            # виртуальные часы: sleep(0) в конце цепочки не ждет тика колеса таймеров
+            elapsed = run_loop(entry_point(name, depth, done), virtual=True)
+            if not done or isinstance(done[0], BaseException):
+                # исключение из глубины рекурсии перехватывает EventLoop._execute
+                print(f'depth {depth:>4} {name:<6}: did not complete')
+                continue
+
+            # память - отдельным прогоном: tracemalloc замедляет каждое выделение
+            tracemalloc.start()
+            run_loop(entry_point(name, depth, []), virtual=True)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'depth {depth:>4} {name:<6}: {elapsed / nested_calls * 1e9:>8,.0f} ns/call, '
+                  f'peak {peak / 1024:>8,.0f} KB')
+
+
+class CopyingSocket(async_socket):
+    """Прежний sendall: после частичной отправки остаток копируется срезом data[n:]"""
+    def sendall(self, data):
+        p = Promise()
+
+        def _on_write_ready(error):
+            nonlocal data
+            if error:
+                return p._reject(error)
+            n = self._sock.send(data)
+            if n < len(data):
+                data = data[n:]
+                self._callbacks['sent'] = _on_write_ready
+            else:
+                p._resolve(None)
+
+        self._callbacks['sent'] = _on_write_ready
+        self._update_interest()
+        return p
+
+
+class CountingSocket(socket.socket):
+    """Считает системные вызовы send/sendmsg"""
+    calls = 0
+
+    def send(self, *args):
+        CountingSocket.calls += 1
+        return super().send(*args)
+
+    def sendmsg(self, *args):
+        CountingSocket.calls += 1
+        return super().sendmsg(*args)
+
+
+@benchmark
+def backpressure(messages=300_000, size=64):
+    """messages сообщений по size байт через socketpair
+
+    sendall - ожидание каждой записи; write - все сразу, без ожидания; write+drain - с ожиданием drain().
+    Сравниваются сообщения/сек, число вызовов send/sendmsg и пик буфера записи.
+    """
+    message = b'm' * (size - 1) + b'\n'
+
+    def main(mode, stats):
+        left, right = socket.socketpair()
+        sender = async_socket(sock=CountingSocket(fileno=left.detach()))
+        receiver = async_socket(sock=right)
+        peak = 0
+
+        def send():
+            nonlocal peak
+            for _ in range(messages):
+                if mode == 'sendall':
+                    yield sender.sendall(message)
+                    continue
+                sender.write(message)
+                peak = max(peak, sender.get_write_buffer_size())
+                if mode == 'write+drain':
+                    yield sender.drain()
+            yield sender.flush()
+            sender.close()
+
+        def receive():
+            buffer = bytearray(receiver.read_size)
+            received = 0
+            while True:
+                n = yield receiver.recv_into(buffer)
+                if not n:
+                    break
+                received += n
+            receiver.close()
+            assert received == messages * size, received
+
+        yield [send(), receive()]
+        stats['peak'] = peak
+
+    for mode in ('sendall', 'write', 'write+drain'):
+        stats = {}
+        CountingSocket.calls = 0
+        elapsed = run_loop(partial(main, mode, stats))
+        print(f'{mode:<11}: {messages / elapsed:>10,.0f} messages/sec, {CountingSocket.calls:>7} send calls, '
+              f'peak buffer {stats["peak"] / 1024:>8,.0f} KB')
+
+
+@benchmark
+def transfer(size=100 * 2 ** 20, chunk=2 ** 20):
+    """size байт через socketpair: копирующий sendall + recv против memoryview sendall/sendmsg + recv_into"""
+    payload = bytes(size)
+
+    def main(mode):
+        a, b = socket.socketpair()
+        sender = (CopyingSocket if mode == 'copy' else async_socket)(sock=a)
+        receiver = async_socket(sock=b)
+
+        def send():
+            if mode == 'sendmsg':
+                view = memoryview(payload)
+                yield sender.sendmsg(view[i:i + chunk] for i in range(0, size, chunk))
+            else:
+                yield sender.sendall(payload)
+            sender.close()
+
+        def receive():
+            received = 0
+            if mode == 'copy':
+                while True:
+                    data = yield receiver.recv(receiver.read_size)
+                    if not data:
+                        break
+                    received += len(data)
+            else:
+                buffer = bytearray(receiver.read_size)
+                while True:
+                    n = yield receiver.recv_into(buffer)
+                    if not n:
+                        break
+                    received += n
+            receiver.close()
+            assert received == size, received
+
+        yield [send(), receive()]
+
+    for mode in ('copy', 'sendall', 'sendmsg'):
+        elapsed = run_loop(partial(main, mode))
+        tracemalloc.start()
+        run_loop(partial(main, mode))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{mode:<7}: {size / elapsed / 2 ** 20:>8,.0f} MB/s, peak {peak / 2 ** 20:>6.1f} MB above the payload')
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f'--- {name}')
+        BENCHMARKS[name]()
@@ -0,0 +1,91 @@
+import collections
+
+from consts import MS
+from facade import Context
+
+from log import get_console
+
+console = get_console(format='<bold>ResponseCache</bold>{message}', name='ResponseCache')
+
+
+class ResponseCache(Context):
+    """Кэш ответов: LRU на max_size ключей с TTL у каждой записи и объединение одновременных запросов
+
+    Пока запрос по ключу выполняется, остальные get() того же ключа ждут его задачу (single-flight), а не идут
+    в сеть сами. Ошибка не кэшируется: ее получают все ожидавшие, следующий get() повторяет запрос.
+    Истекшая запись удаляется при обращении к ней или вытесняется как давно не использованная - без таймеров,
+    как и в ConnectionPool. Значение отдается всем по ссылке, изменять его нельзя.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # key -> (expires_at, value), в конце - самые свежие
+        self._inflight = {}  # key -> Task запроса
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key, ttl, load):
+        """Генератор -> значение key: из кэша, из уже идущего запроса или из нового load()
+
+        ttl - мс жизни записи; load - функция без аргументов, возвращающая генератор или промис значения.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > self.event_loop.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+            self.expired += 1
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return (yield task)
+
+        if console.enabled:
+            console('.get: miss {}', key)
+        self.misses += 1
+        task = self._inflight[key] = self.event_loop.spawn(self._load(load))
+        # подписка раньше ожидающих: запись появляется в кэше до того, как они продолжат работу
+        task.then(lambda value=None, *_: self._loaded(key, task, ttl, value))
+        task.catch(lambda _: self._loaded(key, task))
+        return (yield task)
+
+    @staticmethod
+    def _load(load):
+        return (yield load())
+
+    def _loaded(self, key, task, ttl=None, value=None):
+        # invalidate() во время запроса: ответ мог устареть - ожидавшие его получат, но в кэш он не попадет
+        if self._inflight.get(key) is not task:
+            return
+        del self._inflight[key]
+        if ttl is None:
+            return
+
+        self._entries[key] = (self.event_loop.time() + ttl * MS, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key=None):
+        """Удаляет запись key (None - все); ответ уже идущего запроса по ней не будет закэширован"""
+        if key is None:
+            self._entries.clear()
+            self._inflight.clear()
+            return
+        self._entries.pop(key, None)
+        self._inflight.pop(key, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+        }
@@ -1,4 +1,7 @@
 KB = 1024
+# часы цикла событий (utils.hrtime) - в наносекундах
+MS = 1_000_000
+SECOND = 1000 * MS
 IP = '127.0.0.1'
 PORT = 53210
 serv_addr = (IP, PORT)
@@ -1,66 +1,225 @@
-from promise import Promise
+import collections
+import selectors
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from metrics import LoopMetrics
+from promise import TASK_TYPES, CancelledError, Promise
 from taskqueue import TaskQueue
-from utils import hrtime, is_generator, unwind
+from task import Task
 
-from log import get_console, get_callable_representation
+from log import Repr, get_console
 
-console = get_console(format='<light-blue>EventLoop</light-blue>{message}')
+console = get_console(format='<light-blue>EventLoop</light-blue>{message}', name='EventLoop')
 
 
 class EventLoop:
-    def __init__(self):
-        self._queue = TaskQueue()
-        self._time = None
+    def __init__(self, metrics=True, slow_callback_ms=100, virtual=False, seed=None, network=None, poller=None):
+        """metrics - собирать LoopMetrics (см. snapshot()); slow_callback_ms - порог медленного колбека
+        poller - бэкенд опроса i/o: 'select', 'poll', 'epoll', 'selectors' (см. pollers.py), None - epoll, где есть
+
+        Симуляция: virtual - виртуальные часы, время прыгает к ближайшему таймеру, когда i/o ничего не готово;
+        seed - воспроизводимый порядок колбеков, готовых одновременно (см. TaskQueue);
+        network - memory.MemoryNetwork: async_socket цикла работают поверх нее, а не сокетов ОС.
+        """
+        self._queue = TaskQueue(virtual, seed, poller)
+        self.network = network
+        self.metrics = LoopMetrics(slow_callback_ms) if metrics else None
+        self._queue.metrics = self.metrics
+        # колбеки из других потоков (см. threadsafe_callback) и socketpair, которым они будят селектор
+        self._threadsafe = collections.deque()
+        self._waker = None
+        self._expected = 0
+        self._executor = None
 
     def run(self, entry_point, *args):
-        console(f'.run(entry_point={entry_point}, args={args}')
+        console('.run(entry_point={}, args={})', Repr(entry_point), args)
 
-        self._execute(entry_point, *args)
-
-        while not self._queue.is_empty():
-            fn, mask = self._queue.pop(self._time)  # *mask
-            self._execute(fn, mask)  # *mask
+        metrics = self.metrics
+        # задачи общие для всех циклов - хук ставит тот, который сейчас работает
+        Task.on_step = metrics.stepped.append if metrics is not None else None
 
+        queue = self._queue
+        execute = self._execute
+        # ресурсы цикла освобождаются и тогда, когда из партии вылетело KeyboardInterrupt/BaseException
+        completed = False
+        try:
+            # итерация - одна партия из queue.poll(): все истекшие таймеры и сокеты с событиями на момент опроса
+            if metrics is None:
+                execute(entry_point, *args)
+
+                while not queue.is_empty():
+                    for fn, mask in queue.poll():
+                        execute(fn, mask)  # *mask
+            else:
+                perf_counter_ns = time.perf_counter_ns
+                start = perf_counter_ns()
+                execute(entry_point, *args)
+                metrics.callback_done(entry_point, perf_counter_ns() - start)
+
+                run_batch = metrics.run_batch
+                while not queue.is_empty():
+                    run_batch(queue.poll(), execute)
+            completed = True
+        finally:
+            self._close(completed)
+
+    def _close(self, completed):
+        # прерванный цикл не ждет заданий пула, которые еще не начались
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=not completed)
+        if self._waker is not None:
+            self.unregister_fileobj(self._waker[0])
+            for sock in self._waker:
+                sock.close()
         self._queue.close()
 
+    def snapshot(self):
+        """Метрики цикла одним словарем: счетчики, гистограммы и текущие размеры очередей"""
+        snapshot = self.metrics.snapshot() if self.metrics is not None else {}
+        snapshot.update(self._queue.stats())
+        return snapshot
+
+    def spawn(self, generator):
+        """Запускает генератор (или корутину async def) отдельной задачей, возвращает Task - промис его результата"""
+        task = Task(generator)
+        task._step()
+        return task
+
+    def run_in_executor(self, fn, *args, executor=None):
+        """Промис результата fn(*args), выполненной в другом потоке, чтобы не блокировать цикл
+
+        executor - concurrent.futures.Executor, например ProcessPoolExecutor для CPU-bound работы на чистом Python
+        (fn и аргументы тогда передаются через pickle); по умолчанию - пул потоков цикла.
+        promise.cancel() отменяет задачу, если она еще не начала выполняться.
+        """
+        if console.tracing:
+            console.trace('.run_in_executor(fn={}, args={})', Repr(fn), args)
+
+        if executor is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(thread_name_prefix='EventLoop')
+            executor = self._executor
+
+        p = Promise()
+        future = executor.submit(fn, *args)
+        p._canceller = future.cancel
+        future.add_done_callback(self.threadsafe_callback(partial(self._settle, p)))
+        return p
+
+    @staticmethod
+    def _settle(p, future):
+        if future.cancelled():
+            p._reject(CancelledError())
+        elif future.exception() is not None:
+            p._reject(future.exception())
+        else:
+            p._resolve(future.result())
+
+    def threadsafe_callback(self, callback):
+        """-> функция одного аргумента, которую можно один раз вызвать из любого потока: callback(arg) выполнится
+        в цикле событий на ближайшей итерации. Пока она не вызвана, цикл не завершается.
+
+        Вызов кладет колбек в очередь и пишет байт в socketpair, зарегистрированный в TaskQueue, - селектор
+        просыпается так же, как от сетевого i/o.
+        """
+        if self._waker is None:
+            self._waker = socket.socketpair()
+            for sock in self._waker:
+                sock.setblocking(False)
+            self.register_fileobj(self._waker[0], self._on_wakeup)
+        if not self._expected:
+            self.modify_fileobj(self._waker[0], selectors.EVENT_READ)
+        self._expected += 1
+
+        def _threadsafe(arg=None):
+            self._threadsafe.append((callback, arg))
+            try:
+                self._waker[1].send(b'\0')
+            except OSError:
+                # буфер socketpair полон - цикл и так проснется
+                pass
+
+        return _threadsafe
+
+    def _on_wakeup(self, mask):
+        # сначала вычитываем socketpair, потом очередь: колбек, положенный после этого, принесет новый байт
+        try:
+            while self._waker[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self._threadsafe:
+            callback, arg = self._threadsafe.popleft()
+            self._expected -= 1
+            self._execute(callback, arg)
+
+        if not self._expected:
+            # ждать больше некого - socketpair не должен держать цикл
+            self.modify_fileobj(self._waker[0], 0)
+
+    def socket(self, *args):
+        """Новый неблокирующий сокет для async_socket: socket.socket(*args) или сокет network"""
+        if self.network is not None:
+            return self.network.socket(*args)
+        return socket.socket(*args)
+
+    def notify_fileobj(self, fileobj):
+        """Объект в памяти сообщает, что его готовность могла измениться"""
+        self._queue.notify(fileobj)
+
     def register_fileobj(self, fileobj, callback):
-        callback_str = get_callable_representation(callback)
-        console(f'.register_fileobj(fileobj={fileobj}, callback={callback_str})')
+        if console.enabled:
+            console('.register_fileobj(fileobj={}, callback={})', fileobj, Repr(callback))
 
         self._queue.register_fileobj(fileobj, callback)
 
+    def modify_fileobj(self, fileobj, events):
+        self._queue.modify_fileobj(fileobj, events)
+
     def unregister_fileobj(self, fileobj):
-        console(f'.unregister_fileobj(fileobj={fileobj}')
+        if console.enabled:
+            console('.unregister_fileobj(fileobj={})', fileobj)
 
         self._queue.unregister_fileobj(fileobj)
 
+    def time(self):
+        """Часы цикла, нс (utils.hrtime, виртуальные - с 0): обновляются раз за итерацию, внутри колбека время
+        не идет"""
+        return self._queue.now
+
     def set_timer(self, duration):
-        console(f'.set_timer(duration={duration})')
+        """Промис, выполняемый через duration нс от часов цикла; promise.cancel() снимает таймер"""
+        if console.tracing:
+            console.trace('.set_timer(duration={})', duration)
 
         p = Promise()
-        self._time = hrtime()
-
-        self._queue.register_timer(self._time + duration,
-                                   p._resolve)
+        timer = self._queue.register_timer(self._queue.now + duration, p._resolve)
+        # promise.cancel() снимает таймер из колеса
+        p._canceller = timer.cancel
         return p
 
-    def _execute(self, callback, *args):
-        callback_str = get_callable_representation(callback)
-        console(f'._execute(callback={callback_str}, args={args}')
+    def call_later(self, duration, callback):
+        """callback(None) через duration нс от часов цикла -> Timer с cancel(); как set_timer, но без промиса"""
+        if console.tracing:
+            console.trace('.call_later(duration={}, callback={})', duration, Repr(callback))
+
+        return self._queue.register_timer(self._queue.now + duration, callback)
 
-        # self._time = hrtime()  # по идее не нужно
+    def _execute(self, callback, *args):
+        if console.tracing:
+            console.trace('._execute(callback={}, args={})', Repr(callback), args)
 
         try:
             returned = callback(*args)
 
-            if is_generator(returned):
-                unwind(
-                    generator=returned,
-                    on_success=None,
-                    on_exceptions=lambda e: print('Uncaught rejection:', e),
-                )
+            if isinstance(returned, TASK_TYPES):
+                Task(returned)._step()
         except Exception as exc:
             print('Uncaught exception:', exc)
 
-        self._time = hrtime()
-        console(f'._execute end')
+        if console.tracing:
+            console.trace('._execute end')
@@ -1,11 +1,15 @@
 class Context:
     """Context class is an execution context, providing a placeholder for
      the event loop reference"""
+    # без __dict__ у самого Context: наследники с __slots__ (Promise) остаются компактными
+    __slots__ = ()
+
     class states:  # noqa
         INITIAL = 0
         CONNECTING = 1
         CONNECTED = 2
         CLOSED = 3
+        LISTENING = 4
 
     @classmethod
     def set_event_loop(cls, event_loop):
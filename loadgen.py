@@ -0,0 +1,315 @@
+"""Генератор нагрузки: concurrency одновременных сценариев get_user_balance к серверу server.py, отчет в JSON
+
+    python loadgen.py --concurrency 100 --duration 10 --distribution zipf --keys 10000 --payload 1
+    python loadgen.py --server process -o before.json   # сервер в отдельном процессе
+    python loadgen.py --poller poll -o after.json          # бэкенд опроса i/o цикла (см. pollers.py)
+
+Сценарий - main.get_user_balance без паузы и демонстрационной ошибки: пользователь, затем его счет, два запроса.
+payload > 1 - те же два шага запросами MGET на payload сущностей. Каждый из concurrency сценариев повторяется,
+пока не выйдет duration секунд (замкнутая нагрузка: следующий начинается, когда закончился предыдущий); первые
+warmup секунд в отчет не попадают.
+
+Сервер: 'inproc' - server.Server на том же цикле событий, fd/RSS/CPU в отчете - обе стороны вместе;
+'process' - в отдельном процессе, его fd/RSS/CPU читаются из /proc; addr - уже запущенный сервер, только клиент.
+Отчет - JSON с конфигурацией, пропускной способностью, перцентилями задержки сценария, пиковыми fd и RSS,
+CPU на запрос и метриками цикла (EventLoop.snapshot) - чтобы сравнивать изменения цикла событий прогон с прогоном.
+"""
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import time
+
+from consts import KB, MS
+from event_loop import EventLoop
+from facade import Context
+from main import Client
+from pollers import POLLERS
+from server import AsyncHandler, Handler, Server, serve
+from utils import hrtime, sleep
+
+DISTRIBUTIONS = ('uniform', 'zipf')
+SERVERS = ('inproc', 'process')
+
+
+class QuietHandler(AsyncHandler):
+    # лог каждого запроса на такой нагрузке измерял бы print, а не цикл
+    def log(self, message):
+        pass
+
+
+def key_sampler(distribution='uniform', keys=10000, s=1.1, seed=None):
+    """-> sample(k): k id пользователей из 1..keys; zipf - id 1 самый частый, вес k-го 1 / k ** s"""
+    rng = random.Random(seed)
+    population = range(1, keys + 1)
+    if distribution == 'uniform':
+        return lambda k: rng.choices(population, k=k)
+    if distribution == 'zipf':
+        cum_weights = list(itertools.accumulate(1 / k ** s for k in population))
+        return lambda k: rng.choices(population, cum_weights=cum_weights, k=k)
+    raise ValueError(f'unknown key distribution {distribution!r}, expected one of {DISTRIBUTIONS}')
+
+
+def process_stats(pid=None):
+    """Открытые fd, RSS в байтах и CPU (user + system) в секундах процесса pid, None - текущего
+
+    Читается /proc (Linux); без него - None вместо недоступных значений.
+    """
+    stats = {'fds': None, 'rss': None, 'cpu': time.process_time() if pid is None else None}
+    proc = f'/proc/{pid or "self"}'
+    try:
+        stats['fds'] = len(os.listdir(f'{proc}/fd'))
+        with open(f'{proc}/statm') as f:
+            stats['rss'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        if pid is not None:
+            # поля после имени процесса в скобках: utime и stime - 14-е и 15-е в тиках
+            with open(f'{proc}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            stats['cpu'] = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except OSError:
+        pass
+    return stats
+
+
+def percentiles(values, points=(0.5, 0.99, 0.999)):
+    """Перцентили по ближайшему рангу: {'p50': ..., 'p99': ..., 'p999': ...}"""
+    values = sorted(values)
+    result = {}
+    for point in points:
+        name = 'p' + f'{point * 100:g}'.replace('.', '')
+        result[name] = values[min(len(values) - 1, int(point * len(values)))] if values else None
+    return result
+
+
+def _serve(addr_queue, seed, poller):
+    Handler.seed = seed
+    event_loop = EventLoop(poller=poller)
+    Context.set_event_loop(event_loop)
+    event_loop.run(serve, ('127.0.0.1', 0), QuietHandler, KB, addr_queue.put)
+
+
+def start_server(seed=None, poller=None):
+    """server.serve в отдельном процессе. Returns: (addr, process)"""
+    addr_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(addr_queue, seed, poller), daemon=True)
+    process.start()
+    return addr_queue.get(), process
+
+
+class LoadGenerator(Context):
+    """Один прогон нагрузки на текущем цикле событий: run() - генератор для EventLoop.run, report() - итог"""
+    # как часто замерять fd и RSS, мс
+    sample_period = 100
+
+    def __init__(self, addr, concurrency=100, duration=10.0, warmup=1.0, distribution='uniform', keys=10000,
+                 s=1.1, payload=1, seed=None, binary=True, server_pid=None):
+        self.addr = addr
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+        self.payload = payload
+        self.binary = binary
+        self.server_pid = server_pid
+        self.sample = key_sampler(distribution, keys, s, seed)
+        self.latencies = []  # нс, сценарии, начатые после прогрева
+        self.errors = collections.Counter()
+        self.peak = {'client': {'fds': 0, 'rss': 0}, 'server': {'fds': 0, 'rss': 0}}
+        self._begin = self._end = None
+        self._start_stats = self._end_stats = None
+        self._stopped = False
+
+    def run(self):
+        start = hrtime()
+        self._begin = start + int(self.warmup * 1000 * MS)
+        self._end = self._begin + int(self.duration * 1000 * MS)
+        sleep(self.warmup * 1000).then(lambda *_: self._measure('_start_stats'))
+        sampler = self.event_loop.spawn(self._sampler())
+        try:
+            yield [self._flows() for _ in range(self.concurrency)]
+        finally:
+            self._stopped = True
+            sampler.cancel()
+        self._measure('_end_stats')
+
+    def _flows(self):
+        client = Client(self.addr, max_size=self.concurrency, cache=False, binary=self.binary)
+        while True:
+            start = hrtime()
+            if start >= self._end:
+                return
+            try:
+                yield self._flow(client, self.sample(self.payload))
+            except Exception as exc:
+                if start >= self._begin:
+                    self.errors[type(exc).__name__] += 1
+                continue
+            if start >= self._begin:
+                self.latencies.append(hrtime() - start)
+
+    @staticmethod
+    def _flow(client, ids):
+        if len(ids) == 1:
+            user = yield client.get_user(ids[0])
+            return (yield client.get_balance(user['account_id']))
+
+        users = yield client.mget('user', ids)
+        return (yield client.mget('account', [user['account_id'] for user in users]))
+
+    def _sampler(self):
+        while not self._stopped:
+            self._peak('client', process_stats())
+            if self.server_pid is not None:
+                self._peak('server', process_stats(self.server_pid))
+            yield sleep(self.sample_period)
+
+    def _peak(self, side, stats):
+        for name in ('fds', 'rss'):
+            if stats[name] is not None:
+                self.peak[side][name] = max(self.peak[side][name], stats[name])
+
+    def _measure(self, name):
+        stats = {'time': hrtime(), 'client': process_stats()}
+        if self.server_pid is not None:
+            stats['server'] = process_stats(self.server_pid)
+        setattr(self, name, stats)
+
+    def report(self):
+        """Итог прогона словарем для JSON; CPU на запрос - за время после прогрева"""
+        start, end = self._start_stats, self._end_stats
+        if start is None:
+            raise RuntimeError('load finished before warmup, increase duration')
+        elapsed = (end['time'] - start['time']) / (1000 * MS)
+        flows = len(self.latencies)
+        requests = flows * 2 * -(-self.payload // Client.mget_size)
+
+        def side(name):
+            if name not in start:
+                return None
+            cpu = None
+            if start[name]['cpu'] is not None and requests:
+                cpu = (end[name]['cpu'] - start[name]['cpu']) / requests * 1e6
+            return {'fds_max': self.peak[name]['fds'] or None, 'rss_max': self.peak[name]['rss'] or None,
+                    'cpu_per_request_us': cpu}
+
+        loop = self.event_loop.snapshot()
+        loop.pop('slow_callback_reports', None)
+        return {
+            'flows': flows,
+            'requests': requests,
+            'errors': dict(self.errors),
+            'elapsed': elapsed,
+            'throughput': {'flows_per_sec': flows / elapsed, 'requests_per_sec': requests / elapsed},
+            'latency_ms': {name: value / MS if value is not None else None
+                           for name, value in percentiles(self.latencies).items()},
+            'client': side('client'),
+            'server': side('server'),
+            'loop': loop,
+        }
+
+
+def run(concurrency=100, duration=10.0, warmup=1.0, distribution='uniform', keys=10000, s=1.1, payload=1,
+        server='inproc', addr=None, seed=1, binary=True, poller=None):
+    """Прогон нагрузки на новом цикле событий -> отчет (см. LoadGenerator.report) вместе с конфигурацией
+
+    poller - бэкенд опроса i/o циклов клиента и своего сервера (см. pollers.py)
+    """
+    config = {'concurrency': concurrency, 'duration': duration, 'warmup': warmup, 'distribution': distribution,
+              'keys': keys, 's': s, 'payload': payload, 'server': 'external' if addr else server,
+              'seed': seed, 'binary': binary, 'poller': poller}
+    event_loop = EventLoop(poller=poller)
+    Context.set_event_loop(event_loop)
+
+    process = listener = None
+    prev_seed = Handler.seed
+    if addr is None and server == 'process':
+        addr, process = start_server(seed, poller)
+    elif addr is None:
+        Handler.seed = seed
+        listener = Server(('127.0.0.1', 0), QuietHandler)
+        addr = listener.getsockname()
+
+    load = LoadGenerator(addr, concurrency, duration, warmup, distribution, keys, s, payload, seed, binary,
+                         server_pid=process.pid if process else None)
+
+    def main():
+        if listener is not None:
+            event_loop.spawn(listener.serve())
+        try:
+            yield load.run()
+        finally:
+            Client.get_pool(addr).close()
+            if listener is not None:
+                listener.stop(0)
+
+    try:
+        event_loop.run(main)
+    finally:
+        Handler.seed = prev_seed
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    return {
+        'config': config,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'at': time.time(),
+        **load.report(),
+    }
+
+
+def summary(report):
+    """Строка отчета для консоли"""
+    latency = report['latency_ms']
+    cpu = report['client']['cpu_per_request_us']
+    line = (f'{report["throughput"]["requests_per_sec"]:,.0f} requests/sec, latency p50 {latency["p50"]:.2f} ms '
+            f'p99 {latency["p99"]:.2f} ms p999 {latency["p999"]:.2f} ms, {sum(report["errors"].values())} errors, '
+            f'client: {report["client"]["fds_max"]} fds, {(report["client"]["rss_max"] or 0) / 2 ** 20:.0f} MB, '
+            f'{cpu or 0:.0f} us CPU/request')
+    if report['server']:
+        line += (f'; server: {report["server"]["fds_max"]} fds, {(report["server"]["rss_max"] or 0) / 2 ** 20:.0f}'
+                 f' MB, {report["server"]["cpu_per_request_us"] or 0:.0f} us CPU/request')
+    return line
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Нагрузка get_user_balance на сервер server.py, отчет в JSON')
+    parser.add_argument('--concurrency', type=int, default=100, help='одновременных сценариев')
+    parser.add_argument('--duration', type=float, default=10.0, help='секунд нагрузки после прогрева')
+    parser.add_argument('--warmup', type=float, default=1.0, help='секунд прогрева, не входят в отчет')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='uniform', help='распределение ключей')
+    parser.add_argument('--keys', type=int, default=10000, help='различных пользователей')
+    parser.add_argument('-s', type=float, default=1.1, help='показатель zipf')
+    parser.add_argument('--payload', type=int, default=1, help='сущностей на запрос (> 1 - MGET)')
+    parser.add_argument('--server', choices=SERVERS, default='inproc', help='где запустить сервер')
+    parser.add_argument('--addr', help='host:port уже запущенного сервера вместо своего')
+    parser.add_argument('--seed', type=int, default=1, help='seed ключей и данных сервера')
+    parser.add_argument('--poller', choices=sorted(POLLERS), help='бэкенд опроса i/o, по умолчанию epoll')
+    parser.add_argument('--json', dest='binary', action='store_false', help='без бинарного протокола')
+    parser.add_argument('-o', '--output', default='loadgen.json', help="файл отчета, '-' - stdout")
+    args = parser.parse_args(argv)
+    if args.addr:
+        host, port = args.addr.rsplit(':', 1)
+        args.addr = (socket.gethostbyname(host), int(port))
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    output = args.output
+    del args.output
+    report = run(**vars(args))
+    if output == '-':
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(summary(report))
+        print(f'report: {output}')
@@ -1,4 +1,5 @@
 import inspect
+import os
 import sys
 import types
 from functools import lru_cache
@@ -7,19 +8,112 @@ from loguru import logger
 
 logger.remove()
 
+# Уровни трассировки компонента:
+#   OFF   - ничего не пишем, горячие пути не форматируют сообщения вовсе
+#   DEBUG - обычные сообщения console(...)
+#   TRACE - плюс сообщения console.trace(...) из горячих путей (_execute, pop, Task, Promise, сокеты)
+# Уровни задаются переменной окружения TRACE: "DEBUG" или "*=OFF,EventLoop=TRACE,TaskQueue=DEBUG"
+LEVELS = {'OFF': 100, 'DEBUG': 10, 'TRACE': 5}
 
-@lru_cache(None)
-def get_console(format):
+_levels = {'*': 'OFF'}
+_consoles = {}
+_sink = sys.stdout
+
+
+def _parse_levels(spec):
+    for item in filter(None, (s.strip() for s in spec.split(','))):
+        component, _, level = item.rpartition('=')
+        set_level(level, component or '*')
+
+
+class Console:
+    """Трассировка одного компонента.
+
+    Проверка уровня делается до форматирования: горячие пути пишут
+    `if console.tracing: console.trace('...{}', arg)`, поэтому при выключенной
+    трассировке не строится ни f-строка, ни представление колбека.
+    Аргументы форматируются loguru лениво, только если сообщение будет выведено.
+    """
+    def __init__(self, name, format):
+        self.name = name
+        self.format = format
+        self._log = logger.bind(format=format)
+        self.enabled = False
+        self.tracing = False
+        self.set_level(_levels.get(name, _levels['*']))
+
+    def set_level(self, level):
+        no = LEVELS[level.upper()]
+        self.enabled = no <= LEVELS['DEBUG']
+        self.tracing = no <= LEVELS['TRACE']
+
+    def __call__(self, message, *args, **kwargs):
+        if self.enabled:
+            self._log.debug(message, *args, **kwargs)
+
+    def trace(self, message, *args, **kwargs):
+        if self.tracing:
+            self._log.trace(message, *args, **kwargs)
+
+
+def _add_sink(format):
     logger.add(
-        sys.stdout,  # open('/dev/null', 'w'),
-        level="INFO",
+        _sink,
+        level='TRACE',
         filter=lambda rec: rec['extra']['format'] == format,
         format=format,
     )
-    return logger.bind(format=format).info
+
+
+@lru_cache(None)
+def get_console(format, name=None):
+    _add_sink(format)
+    console = Console(name or format, format)
+    _consoles[console.name] = console
+    return console
+
+
+def set_level(level, component='*'):
+    """Переключает уровень трассировки компонента ('*' - всех, для которых уровень не задан явно)"""
+    LEVELS[level.upper()]  # KeyError на неизвестный уровень
+    _levels[component] = level
+    for name, console in _consoles.items():
+        if component == name or component == '*' and name not in _levels:
+            console.set_level(level)
+
+
+def set_sink(stream):
+    """Перенаправляет вывод всех консолей, например в os.devnull для бенчмарков"""
+    global _sink
+    _sink = stream
+    logger.remove()
+    for console in _consoles.values():
+        _add_sink(console.format)
+
+
+@lru_cache(None)
+def _get_source(code):
+    return inspect.getsource(code).strip()
 
 
 def get_callable_representation(obj):
     if isinstance(obj, types.FunctionType) and obj.__name__ == '<lambda>':
-        return inspect.getsource(obj).strip()
+        return _get_source(obj.__code__)
     return obj
+
+
+class Repr:
+    """Ленивое представление колбека - getsource вызывается только при выводе сообщения"""
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return str(get_callable_representation(self.obj))
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+
+_parse_levels(os.environ.get('TRACE', ''))
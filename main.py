@@ -2,70 +2,275 @@ import json
 import random
 import socket
 import sys
+import weakref
+from functools import partial
 
-from async_socket import async_socket
+from async_socket import IncompleteReadError, async_socket
+from batch import Batcher
+from cache import ResponseCache
+from consts import KB, MS
 from event_loop import EventLoop
 from facade import Context
+from pool import ConnectionPool
 from utils import sleep
+import wire
 
 from log import get_console
 
-console = get_console(format='<bold>main</bold>{message}')
+console = get_console(format='<bold>main</bold>{message}', name='main')
 
-client_console = get_console(format='<bold>Client</bold>{message}')
+client_console = get_console(format='<bold>Client</bold>{message}', name='Client')
 
 
 class Client:
-    def __init__(self, addr):
+    # пулы соединений, кэши и Batcher по циклу событий и адресу: Client создается на каждый get_user_balance
+    _pools = weakref.WeakKeyDictionary()
+    _caches = weakref.WeakKeyDictionary()
+    _batchers = weakref.WeakKeyDictionary()
+    # соединения, согласовавшие бинарный протокол
+    _binary = weakref.WeakSet()
+    # отказы от бинарного протокола по циклу событий: addr -> (EOF на HELLO подряд, до какого времени цикла (нс)
+    # не предлагать HELLO; 0 - предлагать)
+    _json_only = weakref.WeakKeyDictionary()
+    # сколько мс помнить отказ: обновленный сервер получит бинарный протокол без перезапуска клиента
+    json_only_ttl = 60000
+    # EOF вместо ответа на HELLO - отказ, только если повторился столько раз подряд: одиночный EOF - это и
+    # перезапуск воркера prefork, и оборванное соединение. Ответ-строка, отличная от ACCEPTED, - отказ сразу
+    hello_eof_limit = 2
+    # ответ длиннее разбирается в пуле потоков: json.loads большого ответа надолго занял бы цикл событий
+    decode_in_executor = 256 * KB
+    # TTL записей кэша по видам сущностей, мс: пользователь меняется редко, баланс - часто
+    ttl = {'user': 60000, 'account': 1000}
+    # id в одном запросе MGET: длина строки запроса ограничена Handler.max_request
+    mget_size = 1000
+
+    def __init__(self, addr, pool=True, max_size=10, idle_timeout=30000, cache=True, cache_size=1000,
+                 batch_window=None, binary=True, timeout=10000):
+        """cache - кэшировать ответы и объединять одновременные запросы одной сущности (см. ResponseCache)
+        batch_window - мс, за которые одиночные get_user/get_balance собираются в один MGET (см. Batcher);
+            несуществующая сущность тогда возвращается как None, а не ошибкой
+        binary - предлагать серверу бинарный протокол (wire.py): id в ответах - целые, несуществующая
+            сущность - None; JSON, если сервер протокол не знает
+        timeout - мс на каждую операцию сокета (см. async_socket.settimeout), None - ждать сервер сколько угодно;
+            зависший сервер - TimeoutError, соединение закрывается. У пула - значение первого Client этого адреса
+        """
         self.addr = addr
+        self.binary = binary
+        self.timeout = timeout
+        self._pool = self.get_pool(addr, max_size, idle_timeout, timeout) if pool else None
+        self._cache = self.get_cache(addr, cache_size) if cache else None
+        self._batcher = self.get_batcher(addr, batch_window) if batch_window is not None else None
+
+    @classmethod
+    def get_pool(cls, addr, max_size=10, idle_timeout=30000, timeout=None):
+        pools = cls._pools.setdefault(Context.event_loop, {})
+        if addr not in pools:
+            pools[addr] = ConnectionPool(addr, max_size, idle_timeout, timeout)
+        return pools[addr]
+
+    @classmethod
+    def close_pools(cls):
+        """Закрывает свободные соединения пулов текущего цикла событий - в конце точки входа, пока цикл жив"""
+        for pool in cls._pools.pop(Context.event_loop, {}).values():
+            pool.close()
+
+    @classmethod
+    def get_cache(cls, addr, max_size=1000):
+        caches = cls._caches.setdefault(Context.event_loop, {})
+        if addr not in caches:
+            caches[addr] = ResponseCache(max_size)
+        return caches[addr]
+
+    @classmethod
+    def get_batcher(cls, addr, window=1):
+        batchers = cls._batchers.setdefault(Context.event_loop, {})
+        if addr not in batchers:
+            batchers[addr] = Batcher(cls(addr, cache=False).mget, window, cls.mget_size)
+        return batchers[addr]
 
     def get_user(self, user_id):
-        client_console(f'.get_user(user_id={user_id})')
+        client_console('.get_user(user_id={})', user_id)
 
-        return self._get(f'GET user {user_id}\n')
+        return self._get_entity('user', user_id)
 
     def get_balance(self, account_id):
-        client_console(f'.get_balance(account_id={account_id})')
-
-        return self._get(f'GET account {account_id}\n')
+        client_console('.get_balance(account_id={})', account_id)
+
+        return self._get_entity('account', account_id)
+
+    def mget(self, kind, ids):
+        """Генератор -> список сущностей kind в порядке ids (None - нет такой)
+
+        Один запрос MGET на каждые mget_size id, запросы идут параллельно по соединениям пула.
+        """
+        ids = [str(entity_id) for entity_id in ids]
+        chunks = yield [self._mget(kind, ids[i:i + self.mget_size]) for i in range(0, len(ids), self.mget_size)]
+        return [record for chunk in chunks for record in chunk]
+
+    def invalidate(self, kind=None, entity_id=None):
+        """Сбрасывает закэшированную сущность; без entity_id - весь кэш"""
+        if self._cache is not None:
+            self._cache.invalidate(None if entity_id is None else (kind, str(entity_id)))
+
+    def _get_entity(self, kind, entity_id):
+        if self._batcher is not None:
+            load = partial(self._batcher.get, kind, str(entity_id))
+        else:
+            load = partial(self._get, 'GET', kind, [str(entity_id)])
+        if self._cache is None:
+            return load()
+        return self._cache.get((kind, str(entity_id)), self.ttl[kind], load)
+
+    def _mget(self, kind, ids):
+        client_console('._mget(kind={}, ids=<{}>)', kind, len(ids))
+
+        return (yield self._get('MGET', kind, ids))
+
+    def _get(self, method, kind, ids):
+        """Генератор: запрос method ('GET', 'MGET') сущностей kind по ids (строки) -> запись или список записей
+
+        Новое соединение сразу предлагает бинарный протокол: wire.HELLO уходит вместе с первым запросом, без
+        лишнего круга. Сервер, который его не знает, отвечает отказом или закрывает соединение, и запрос
+        повторяется на новом соединении; после отказа адрес json_only_ttl мс работает на JSON (см. _hello_replied).
+        """
+        client_console('._get(method={}, kind={}, ids=<{}>)', method, kind, len(ids))
+
+        while True:
+            client_console('_get: start connetion')
+
+            sock, reused = yield self._connect()
+
+            client_console('._get: connect successful')
+
+            hello = self.binary and not reused and self._offer_binary()
+            binary = hello or sock in self._binary
+            reusable = False
+            try:
+                if binary:
+                    req = wire.encode_request(method, kind, ids)
+                else:
+                    req = f'{method} {kind} {" ".join(ids)}\n'.encode('utf8')
+                if hello:
+                    req = wire.HELLO + req
+
+                if client_console.enabled:
+                    client_console('._get: start sending {}', req)
+
+                yield sock.sendall(req)
+
+                client_console('._get: sended, yield response')
+
+                if hello:
+                    reply = yield sock.readline()
+                    self._hello_replied(reply)
+                    if reply != wire.ACCEPTED:
+                        continue
+                    self._binary.add(sock)
+
+                if binary:
+                    resp = yield self._read_binary(kind, len(ids), sock)
+                    if method == 'GET':
+                        resp = resp[0]
+                elif method == 'GET':
+                    resp = yield self._read_line(sock)
+                else:
+                    resp = yield self._read_records(len(ids), sock)
+                reusable = True
+                return resp
+            except ConnectionError:
+                # соединение из пула могло быть закрыто сервером, пока простаивало - пробуем новое
+                if not reused:
+                    raise
+            finally:
+                client_console('_get: releasing socket')
+
+                self._release(sock, reusable)
+
+    def _offer_binary(self):
+        """Предлагать ли серверу HELLO: он не отказывался от бинарного протокола или отказ устарел"""
+        states = self._json_only.get(Context.event_loop)
+        state = states and states.get(self.addr)
+        if not state or not state[1]:
+            return True
+        if state[1] <= Context.event_loop.time():
+            del states[self.addr]
+            return True
+        return False
+
+    def _hello_replied(self, reply):
+        """Учитывает ответ сервера на HELLO: ACCEPTED, строка отказа или EOF (пустой/неполный ответ)"""
+        event_loop = Context.event_loop
+        states = self._json_only.setdefault(event_loop, {})
+        if reply == wire.ACCEPTED:
+            states.pop(self.addr, None)
+            return
+
+        eofs = states[self.addr][0] + 1 if self.addr in states else 1
+        if reply.endswith(b'\n') or eofs >= self.hello_eof_limit:
+            if client_console.enabled:
+                client_console('._get: {} refused binary protocol: {}', self.addr, reply)
+            states[self.addr] = (eofs, event_loop.time() + self.json_only_ttl * MS)
+        else:
+            states[self.addr] = (eofs, 0)
+
+    def _read_line(self, sock):
+        resp = yield sock.readline()
+        if not resp.endswith(b'\n'):
+            raise ConnectionError('connection closed by server')
+
+        if client_console.enabled:
+            client_console('._get: requested response={}, returning', resp)
+        if len(resp) > self.decode_in_executor:
+            return (yield Context.event_loop.run_in_executor(json.loads, resp))
+        return json.loads(resp)
+
+    @staticmethod
+    def _read_records(count, sock):
+        # ответ MGET - count кадров, по одному на id
+        records = []
+        try:
+            for _ in range(count):
+                records.append(json.loads((yield sock.readframe())))
+        except IncompleteReadError:
+            raise ConnectionError('connection closed by server')
+        return records
+
+    @staticmethod
+    def _read_binary(kind, count, sock):
+        # записи wire приходят кадрами, пока не наберется count
+        records = []
+        try:
+            while len(records) < count:
+                records += wire.decode_records(kind, (yield sock.readframe()))
+        except IncompleteReadError:
+            raise ConnectionError('connection closed by server')
+        return records
 
-    def _get(self, req):
-        client_console(f'._get(req={req!r})')
+    def _connect(self):
+        if self._pool:
+            return (yield self._pool.acquire())
 
         sock = async_socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        client_console('_get: start connetion')
-
+        sock.settimeout(self.timeout)
         yield sock.connect(self.addr)
+        return sock, False
 
-        client_console('._get: connect successful')
-
-        try:
-            client_console(f'._get: start sending {req.encode("utf8")}')
-
-            yield sock.sendall(req.encode('utf8'))
-
-            client_console(f'._get: sended, yield response')
-
-            resp = yield sock.recv(1024)
-
-            client_console(f'._get: requested response={resp}, returning')
-            return json.loads(resp)
-        finally:
-            client_console('_get: closing socket')
-
+    def _release(self, sock, reusable):
+        if self._pool:
+            self._pool.release(sock, reusable)
+        else:
             sock.close()
 
 
 def get_user_balance(serv_addr, user_id):
-    console(f'.get_user_balance(serv_addr={serv_addr}, user_id={user_id})')
+    console('.get_user_balance(serv_addr={}, user_id={})', serv_addr, user_id)
     console('.get_user_balance sleeping')
 
     yield sleep(random.randint(0, 1000))
 
     client = Client(serv_addr)
 
-    console(f'.get_user_balance: yield from client.get_user(user_id={user_id})')
+    console('.get_user_balance: yield from client.get_user(user_id={})', user_id)
 
     user = yield client.get_user(user_id)
     if user_id % 5 == 0:
@@ -73,7 +278,7 @@ def get_user_balance(serv_addr, user_id):
 
         raise Exception('It is OK to throw here')
 
-    console(f'.get_user_balance: yield from client.get_balance({user["account_id"]})')
+    console('.get_user_balance: yield from client.get_balance({})', user['account_id'])
 
     acc = yield client.get_balance(user['account_id'])
 
@@ -83,20 +288,21 @@ def get_user_balance(serv_addr, user_id):
 
 
 def print_balance(serv_addr, user_id):
-    console(f'.print_balance(serv_addr={serv_addr}, user_id={user_id})')
+    console('.print_balance(serv_addr={}, user_id={})', serv_addr, user_id)
 
     try:
-        console(f'.print_balance: yield get_user_balance({serv_addr}, {user_id})')
+        console('.print_balance: yield get_user_balance({}, {})', serv_addr, user_id)
 
         balance = yield get_user_balance(serv_addr, user_id)
         print(balance)
         # sys.exit()  # debug
+        return balance
     except Exception as exc:
         print('Catched:', exc)
 
 
 def main1(serv_addr):
-    console(f'.main1({serv_addr}')
+    console('.main1({})', serv_addr)
 
     def on_sleep():
         console('.main1.on_sleep()')
@@ -111,8 +317,13 @@ def main1(serv_addr):
     tasks = []
     for i in range(10):
         tasks.append(print_balance(serv_addr, i))
-    # использование здесь yield from позволило бы избавиться от wait_all, и блок else в unwind
-    yield tasks
+    try:
+        # список ждется через task.gather, каждый генератор - отдельная задача, результаты в исходном порядке
+        balances = yield tasks
+        print(f'{sum(b is not None for b in balances)} of {len(balances)} balances received')
+    finally:
+        # keep-alive соединения пула иначе остались бы открытыми после run()
+        Client.close_pools()
 
 
 def main2(*args):
@@ -0,0 +1,256 @@
+"""Сеть в памяти для симуляций: сокеты без fd, которые async_socket использует вместо сокетов ОС
+
+    network = MemoryNetwork(latency=1, jitter=1, seed=1)
+    event_loop = EventLoop(virtual=True, seed=1, network=network)
+
+Client, ConnectionPool и Server работают поверх нее без изменений: async_socket берет сокет у EventLoop.socket.
+Подключение, данные и закрытие доходят через latency мс (плюс случайные до jitter мс из Random(seed)) таймерами
+цикла и в порядке отправки. Отправитель ждет, пока у получателя больше buffer_size непрочитанных байт.
+"""
+import collections
+import errno
+import os
+import random
+import selectors
+import socket
+from functools import partial
+
+from consts import KB, MS
+from facade import Context
+
+
+class MemoryNetwork(Context):
+    def __init__(self, latency=0, jitter=0, seed=None, buffer_size=256 * KB):
+        self.latency = latency
+        self.jitter = jitter
+        self.buffer_size = buffer_size
+        self._random = random.Random(seed)
+        self._listeners = {}  # addr -> слушающий MemorySocket
+        self._ports = 0
+        # принятых соединений и доставленных байт за все время
+        self.connections = 0
+        self.delivered = 0
+
+    def socket(self, family=socket.AF_INET, type=socket.SOCK_STREAM, *_):
+        return MemorySocket(self, family, type)
+
+    def _port(self, host):
+        # эфемерные порты по порядку, как и все в симуляции - воспроизводимо
+        while True:
+            port = 49152 + self._ports % 16384
+            self._ports += 1
+            if (host, port) not in self._listeners:
+                return port
+
+    def _deliver(self, sender, callback, *args):
+        """callback(*args) через задержку сети; для одного отправителя - строго в порядке вызовов"""
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        outbox = sender._outbox
+        if not delay and not outbox:
+            callback(*args)
+            return
+
+        now = self.event_loop.time()
+        deadline = now + int(delay * MS)
+        if outbox:
+            # jitter не должен переставить куски одного потока
+            deadline = max(deadline, outbox[-1][0])
+        outbox.append((deadline, callback, args))
+        self.event_loop.call_later(deadline - now, partial(self._flush, sender))
+
+    def _flush(self, sender, _=None):
+        # таймеры одного тика могут сработать в любом порядке (TaskQueue с seed) - доставляется все, чей срок
+        # наступил, с головы очереди
+        outbox = sender._outbox
+        now = self.event_loop.time()
+        while outbox and outbox[0][0] <= now:
+            _, callback, args = outbox.popleft()
+            callback(*args)
+
+
+class MemorySocket(Context):
+    """Потоковый сокет MemoryNetwork: та часть интерфейса socket.socket, которой пользуется async_socket
+
+    Вместо fd - poll_events(): TaskQueue держит такой объект вне селектора и сам проверяет его готовность.
+    """
+    def __init__(self, network, family=socket.AF_INET, type=socket.SOCK_STREAM):
+        self.network = network
+        self.family = family
+        self.type = type
+        self._state = 'new'  # 'connecting', 'connected', 'refused', 'listening', 'closed'
+        self._addr = None
+        self._peer_addr = None
+        self._peer = None
+        self._error = 0
+        self._rx = bytearray()
+        self._eof = False  # собеседник закрыл соединение, и все, что он отправил, уже доставлено
+        self._in_flight = 0  # отправлено, но еще не доставлено
+        self._backlog = collections.deque()  # установленные соединения для accept
+        self._outbox = collections.deque()  # (deadline, callback, args) - см. MemoryNetwork._deliver
+
+    def __repr__(self):
+        return f'<MemorySocket {self._state} {self._addr} -> {self._peer_addr}>'
+
+    def poll_events(self):
+        state = self._state
+        if state == 'connected':
+            events = 0
+            if self._rx or self._eof:
+                events |= selectors.EVENT_READ
+            if self._space() > 0 or self._peer._state == 'closed':
+                events |= selectors.EVENT_WRITE
+            return events
+        if state == 'listening':
+            return selectors.EVENT_READ if self._backlog else 0
+        if state == 'refused':
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return 0
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockopt(self, level, option, *_):
+        if option == socket.SO_ERROR:
+            error, self._error = self._error, 0
+            return error
+        return 0
+
+    def getsockname(self):
+        return self._addr or ('0.0.0.0', 0)
+
+    def getpeername(self):
+        if self._peer_addr is None:
+            raise OSError(errno.ENOTCONN, os.strerror(errno.ENOTCONN))
+        return self._peer_addr
+
+    def bind(self, addr):
+        host, port = addr[:2]
+        if not port:
+            port = self.network._port(host)
+        elif (host, port) in self.network._listeners:
+            raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+        self._addr = (host, port)
+
+    def listen(self, backlog=128):
+        if self._addr is None:
+            self.bind(('0.0.0.0', 0))
+        if self.network._listeners.setdefault(self._addr, self) is not self:
+            raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+        self._state = 'listening'
+
+    def accept(self):
+        if self._state != 'listening':
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        if not self._backlog:
+            raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        sock = self._backlog.popleft()
+        return sock, sock._peer_addr
+
+    def connect_ex(self, addr):
+        if self._state != 'new':
+            return errno.EISCONN
+        self._peer_addr = tuple(addr[:2])
+        if self._addr is None:
+            self._addr = (self._peer_addr[0], self.network._port(self._peer_addr[0]))
+        self._state = 'connecting'
+        self.network._deliver(self, self._establish)
+        return errno.EINPROGRESS
+
+    def _establish(self):
+        if self._state != 'connecting':
+            return
+        listener = self.network._listeners.get(self._peer_addr)
+        if listener is None:
+            self._error = errno.ECONNREFUSED
+            self._state = 'refused'
+        else:
+            server = MemorySocket(self.network, self.family, self.type)
+            server._state = self._state = 'connected'
+            server._addr, server._peer_addr = self._peer_addr, self._addr
+            server._peer, self._peer = self, server
+            listener._backlog.append(server)
+            self.network.connections += 1
+            self.event_loop.notify_fileobj(listener)
+        self.event_loop.notify_fileobj(self)
+
+    def recv(self, n):
+        if self._rx:
+            data = bytes(self._rx[:n])
+            del self._rx[:n]
+            self._consumed()
+            return data
+        return self._nothing(b'')
+
+    def recv_into(self, buffer, nbytes=0):
+        if self._rx:
+            view = memoryview(buffer).cast('B')
+            n = min(len(self._rx), nbytes or len(view))
+            view[:n] = self._rx[:n]
+            del self._rx[:n]
+            self._consumed()
+            return n
+        return self._nothing(0)
+
+    def send(self, data):
+        return self.sendmsg((data,))
+
+    def sendmsg(self, buffers):
+        if self._state != 'connected':
+            raise OSError(errno.ENOTCONN, os.strerror(errno.ENOTCONN))
+        if self._peer._state == 'closed':
+            raise BrokenPipeError(errno.EPIPE, os.strerror(errno.EPIPE))
+
+        space = self._space()
+        if space <= 0:
+            raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        chunk = bytearray()
+        for data in buffers:
+            chunk += memoryview(data).cast('B')[:space - len(chunk)]
+            if len(chunk) >= space:
+                break
+        if chunk:
+            self._in_flight += len(chunk)
+            self.network._deliver(self, self._peer._receive, bytes(chunk), self)
+        return len(chunk)
+
+    def close(self):
+        state, self._state = self._state, 'closed'
+        if state == 'closed':
+            return
+        if state == 'listening':
+            del self.network._listeners[self._addr]
+            # соединения, которые никто не принял, закрываются - их клиенты получат EOF
+            while self._backlog:
+                self._backlog.popleft().close()
+        elif self._peer is not None:
+            # EOF доходит после всех отправленных данных
+            self.network._deliver(self, self._peer._hangup)
+        self._rx.clear()
+
+    def _space(self):
+        return self.network.buffer_size - self._in_flight - len(self._peer._rx)
+
+    def _nothing(self, eof):
+        if self._eof or self._state == 'closed':
+            return eof
+        raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+
+    def _consumed(self):
+        # у отправителя могло освободиться место
+        if self._peer is not None:
+            self.event_loop.notify_fileobj(self._peer)
+
+    def _receive(self, data, sender):
+        sender._in_flight -= len(data)
+        if self._state == 'closed':
+            return
+        self._rx += data
+        self.network.delivered += len(data)
+        self.event_loop.notify_fileobj(self)
+
+    def _hangup(self):
+        self._eof = True
+        self.event_loop.notify_fileobj(self)
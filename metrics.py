@@ -0,0 +1,179 @@
+import collections
+import math
+import time
+
+from log import Repr, get_console
+
+console = get_console(format='<bold>LoopMetrics</bold>{message}', name='LoopMetrics')
+
+
+class Histogram:
+    """Гистограмма неотрицательных целых (мкс, глубина очереди) с корзинами по степеням двойки
+
+    Добавление - bit_length и инкремент элемента списка, поэтому ее можно не выключать.
+    Перцентили приблизительные: верхняя граница корзины, в которую попал перцентиль.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        # buckets[i] - значения с bit_length() == i, т.е. [2**(i-1), 2**i)
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(2 ** i - 1 if i else 0, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+            # верхняя граница корзины -> число значений
+            'buckets': {2 ** i - 1 if i else 0: n for i, n in enumerate(self.buckets) if n},
+        }
+
+
+def format_slow_report(report):
+    """Отчет о медленном колбеке (элемент slow_callbacks) строками: колбек, затем задачи и их стеки"""
+    lines = [f'{report["callback"]} took {report["duration_ms"]:.1f} ms']
+    for task, stack in report['tasks'].items():
+        lines.append(f'  {task}')
+        lines.extend(f'    {line}' for line in stack)
+    if report['tasks_total'] > len(report['tasks']):
+        lines.append(f'  ... and {report["tasks_total"] - len(report["tasks"])} more tasks')
+    return '\n'.join(lines)
+
+
+class LoopMetrics:
+    """Счетчики и гистограммы цикла событий
+
+    Гистограммы в мкс: iteration - сколько цикл был занят колбеками между двумя опросами селектора
+    (задержка реакции на i/o), select - сколько цикл ждал в селекторе, callback - длительность одного колбека;
+    ready - глубина очереди готовых колбеков после опроса.
+    Колбек дольше slow_callback_ms мс попадает в slow_callbacks вместе со стеками генераторов задач,
+    которые он продвинул (см. Task.format_stack); None - не отслеживать. Отчет пишется в консоль LoopMetrics
+    на уровне DEBUG (TRACE="LoopMetrics=DEBUG"), по умолчанию он только копится в snapshot().
+    """
+    def __init__(self, slow_callback_ms=100, max_reports=100, max_tasks=10):
+        self.slow_callback_ms = slow_callback_ms
+        self.max_tasks = max_tasks
+        self.iteration = Histogram()
+        self.select = Histogram()
+        self.callback = Histogram()
+        self.ready = Histogram()
+        self.polls = 0
+        self.wakeups = 0  # опросы, вернувшие события (остальные - по таймауту)
+        self.events = 0
+        self.slow_callbacks = collections.deque(maxlen=max_reports)
+        self.slow_count = 0
+        # задачи, продвинутые текущим колбеком: Task.on_step
+        self.stepped = []
+        self._last_poll = None
+
+    def polled(self, start, end, events, ready):
+        """Опрос селектора (или ожидание таймера) с start по end нс вернул events событий"""
+        if self._last_poll is not None:
+            self.iteration.add((start - self._last_poll) // 1000)
+        self._last_poll = end
+        self.select.add((end - start) // 1000)
+        self.ready.add(ready)
+        self.polls += 1
+        if events:
+            self.wakeups += 1
+            self.events += events
+
+    def callback_done(self, callback, elapsed):
+        # вызывается на каждый колбек - Histogram.add развернут на месте
+        us = elapsed // 1000
+        histogram = self.callback
+        histogram.buckets[us.bit_length()] += 1
+        histogram.count += 1
+        histogram.total += us
+        if us > histogram.max:
+            histogram.max = us
+        stepped = self.stepped
+        if self.slow_callback_ms is not None and us >= self.slow_callback_ms * 1000:
+            self._report_slow(callback, us, stepped)
+        if stepped:
+            stepped.clear()
+
+    def run_batch(self, batch, execute):
+        """Выполняет партию [(callback, mask)] через execute, замеряя каждый колбек
+
+        То же, что callback_done на каждый колбек, но без вызова метода: гистограмма обновляется на месте,
+        сумма и максимум партии копятся в локальных переменных, а конец колбека - начало следующего (одно
+        чтение часов на колбек).
+        """
+        perf_counter_ns = time.perf_counter_ns
+        histogram = self.callback
+        buckets = histogram.buckets
+        stepped = self.stepped
+        slow_us = self.slow_callback_ms * 1000 if self.slow_callback_ms is not None else math.inf
+        total = top = 0
+        start = perf_counter_ns()
+        for fn, mask in batch:
+            execute(fn, mask)
+            end = perf_counter_ns()
+            us = (end - start) // 1000
+            start = end
+            buckets[us.bit_length()] += 1
+            total += us
+            if us > top:
+                top = us
+            if us >= slow_us:
+                self._report_slow(fn, us, stepped)
+            if stepped:
+                stepped.clear()
+        histogram.count += len(batch)
+        histogram.total += total
+        if top > histogram.max:
+            histogram.max = top
+
+    def _report_slow(self, callback, us, stepped):
+        self.slow_count += 1
+        tasks = list({id(task): task for task in stepped}.values())
+        report = {
+            'callback': str(Repr(callback)),
+            'duration_ms': us / 1000,
+            'at': time.time(),
+            # колбек мог продвинуть тысячи задач (старт gather) - хватит первых
+            'tasks': {repr(task): task.format_stack() for task in tasks[:self.max_tasks]},
+            'tasks_total': len(tasks),
+        }
+        self.slow_callbacks.append(report)
+
+        if console.enabled:
+            console(' slow callback {}', format_slow_report(report))
+
+    def snapshot(self):
+        return {
+            'polls': self.polls,
+            'wakeups': self.wakeups,
+            'events': self.events,
+            'callbacks': self.callback.count,
+            'slow_callbacks': self.slow_count,
+            'iteration': self.iteration.snapshot(),
+            'select': self.select.snapshot(),
+            'callback': self.callback.snapshot(),
+            'ready_depth': self.ready.snapshot(),
+            'slow_callback_reports': list(self.slow_callbacks),
+        }
@@ -0,0 +1,129 @@
+"""Опрос i/o для TaskQueue: сменные бэкенды с одним интерфейсом
+
+    register(fd, events, callback) / modify(fd, events, callback) / unregister(fd)
+    poll(timeout) -> [(callback, mask)]  # timeout в секундах, None - ждать сколько угодно
+    len(poller) - сколько fd опрашивается
+
+events и mask - selectors.EVENT_READ | selectors.EVENT_WRITE. Бэкенды:
+
+    'select', 'poll' - selectors.SelectSelector / PollSelector: опрос за O(числа fd), у select - fd < FD_SETSIZE
+    'selectors'      - selectors.DefaultSelector (на Linux - EpollSelector), как TaskQueue опрашивал раньше
+    'epoll'          - select.epoll напрямую, level-triggered: fd -> (callback, events) в одном dict, без
+                       SelectorKey и fileobj; по умолчанию, где есть epoll
+
+Ошибки опроса (EBADF от закрытого, но не снятого с регистрации fd и т.п.) не глушатся - это ошибки программы.
+"""
+import math
+import select
+import selectors
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+if hasattr(select, 'epoll'):
+    EPOLLIN, EPOLLOUT = select.EPOLLIN, select.EPOLLOUT
+
+
+class SelectorPoller:
+    """Бэкенд поверх selectors: fd регистрируются числами, callback - data ключа"""
+    def __init__(self, selector_cls=selectors.DefaultSelector):
+        self._selector = selector_cls()
+
+    def __len__(self):
+        return len(self._selector.get_map())
+
+    def register(self, fd, events, callback):
+        self._selector.register(fd, events, callback)
+
+    def modify(self, fd, events, callback):
+        self._selector.modify(fd, events, callback)
+
+    def unregister(self, fd):
+        self._selector.unregister(fd)
+
+    def poll(self, timeout):
+        return [(key.data, mask) for key, mask in self._selector.select(timeout)]
+
+    def close(self):
+        self._selector.close()
+
+
+class EpollPoller:
+    """select.epoll без selectors: результат epoll_wait сразу превращается в партию [(callback, mask)]
+
+    Только level-triggered: async_socket не дочитывает сокет до EAGAIN, а ждет следующего события, и с EPOLLET
+    недочитанные данные больше не будили бы цикл.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+        # fd -> (callback, events)
+        self._handlers = {}
+
+    def __len__(self):
+        return len(self._handlers)
+
+    @staticmethod
+    def _flags(events):
+        flags = 0
+        if events & EVENT_READ:
+            flags |= EPOLLIN
+        if events & EVENT_WRITE:
+            flags |= EPOLLOUT
+        return flags
+
+    def register(self, fd, events, callback):
+        self._epoll.register(fd, self._flags(events))
+        self._handlers[fd] = (callback, events)
+
+    def modify(self, fd, events, callback):
+        self._epoll.modify(fd, self._flags(events))
+        self._handlers[fd] = (callback, events)
+
+    def unregister(self, fd):
+        del self._handlers[fd]
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        elif timeout > 0:
+            # разрешение epoll - 1 мс: округление вниз разбудило бы раньше дедлайна, и цикл опрашивал бы вхолостую
+            timeout = math.ceil(timeout * 1e3) * 1e-3
+
+        handlers = self._handlers
+        batch = []
+        append = batch.append
+        for fd, flags in self._epoll.poll(timeout, max(len(handlers), 1)):
+            callback, events = handlers[fd]
+            if flags == EPOLLIN:
+                mask = events & EVENT_READ
+            elif flags == EPOLLOUT:
+                mask = events & EVENT_WRITE
+            else:
+                # EPOLLERR и EPOLLHUP будят и чтение, и запись - как в selectors.EpollSelector
+                mask = ((flags & ~EPOLLOUT and EVENT_READ) | (flags & ~EPOLLIN and EVENT_WRITE)) & events
+            if mask:
+                append((callback, mask))
+        return batch
+
+    def close(self):
+        self._epoll.close()
+
+
+POLLERS = {
+    'select': lambda: SelectorPoller(selectors.SelectSelector),
+    'selectors': SelectorPoller,
+    'epoll': EpollPoller,
+}
+if hasattr(selectors, 'PollSelector'):
+    POLLERS['poll'] = lambda: SelectorPoller(selectors.PollSelector)
+if not hasattr(select, 'epoll'):
+    del POLLERS['epoll']
+
+
+def make_poller(name=None):
+    """Бэкенд по имени из POLLERS; None - epoll, где он есть, иначе selectors.DefaultSelector"""
+    if name is None:
+        return EpollPoller() if 'epoll' in POLLERS else SelectorPoller()
+    if name not in POLLERS:
+        raise ValueError(f'unknown poller {name!r}, expected one of {sorted(POLLERS)}')
+    return POLLERS[name]()
@@ -0,0 +1,95 @@
+import collections
+import socket
+
+from async_socket import async_socket
+from consts import MS
+from facade import Context
+from promise import Promise
+
+from log import get_console
+
+console = get_console(format='<bold>ConnectionPool</bold>{message}', name='ConnectionPool')
+
+
+class ConnectionPool(Context):
+    """Пул keep-alive соединений к одному адресу
+
+    Не больше max_size открытых соединений (свободных и занятых), остальные acquire() ждут в очереди.
+    Свободное соединение старше idle_timeout мс закрывается при следующем обращении к пулу, а не по таймеру:
+    таймер держал бы цикл событий живым, а свободный сокет без интереса к событиям его не держит.
+    timeout - таймаут операций новых соединений, мс (см. async_socket.settimeout).
+    """
+    def __init__(self, addr, max_size=10, idle_timeout=30000, timeout=None):
+        self.addr = addr
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = collections.deque()  # (sock, released_at), справа - самые свежие
+        self._size = 0
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        """Генератор -> (async_socket, reused): свободное соединение или новое, если пул не заполнен"""
+        self._close_expired()
+
+        if self._idle:
+            sock, _ = self._idle.pop()
+            if console.enabled:
+                console('.acquire: reuse {}', sock)
+            return sock, True
+
+        if self._size >= self.max_size:
+            waiter = Promise()
+            self._waiters.append(waiter)
+            sock = yield waiter
+            if sock is not None:
+                return sock, True
+            # соединение закрыли - его место в пуле передано нам
+        else:
+            self._size += 1
+
+        sock = async_socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            yield sock.connect(self.addr)
+        except Exception:
+            self._discard(sock)
+            raise
+        return sock, False
+
+    def release(self, sock, reusable=True):
+        """Возвращает соединение в пул; reusable=False - соединение в неизвестном состоянии, закрыть"""
+        if not reusable or sock._state != self.states.CONNECTED:
+            self._discard(sock)
+            return
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not (waiter._resolved or waiter._rejected):
+                waiter._resolve(sock)
+                return
+
+        self._idle.append((sock, self.event_loop.time()))
+
+    def close(self):
+        while self._idle:
+            sock, _ = self._idle.popleft()
+            self._discard(sock)
+
+    def _discard(self, sock):
+        if sock._state != self.states.CLOSED:
+            sock.close()
+        self._size -= 1
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not (waiter._resolved or waiter._rejected):
+                self._size += 1
+                waiter._resolve(None)
+                return
+
+    def _close_expired(self):
+        deadline = self.event_loop.time() - self.idle_timeout * MS
+        while self._idle and self._idle[0][1] < deadline:
+            sock, _ = self._idle.popleft()
+            self._discard(sock)
@@ -0,0 +1,208 @@
+import json
+import os
+import random
+import signal
+import socket
+import traceback
+
+from async_socket import async_socket
+from consts import KB
+from event_loop import EventLoop
+from facade import Context
+from server import AsyncHandler, Handler, Server
+
+
+class Supervisor:
+    """Pre-fork: N процессов-воркеров, каждый со своим EventLoop, слушают общий порт через SO_REUSEPORT
+
+    Один EventLoop занимает одно ядро - воркеры масштабируют сервер на несколько ядер, соединения между ними
+    раздает ядро ОС. Супервизор сам соединений не обслуживает: запускает воркеров, перезапускает упавших и
+    управляет ими через socketpair (строки 'stats' и 'stop'). Закрытие socketpair - тоже 'stop', поэтому
+    воркеры не переживают супервизор.
+
+    Сигналы run(): SIGHUP - restart(), SIGUSR1 - напечатать stats(), SIGINT/SIGTERM - stop(),
+    повторный - завершить воркеров, не дожидаясь grace.
+
+    Состояние users/accounts у каждого воркера свое, согласованы они через общий Handler.seed.
+    """
+    signals = {signal.SIGHUP, signal.SIGINT, signal.SIGTERM, signal.SIGCHLD, signal.SIGUSR1}
+
+    def __init__(self, addr, workers=None, handler_cls=AsyncHandler, backlog=KB, grace=5000, seed=None):
+        """workers - по умолчанию по числу ядер; grace - мс на завершение открытых соединений при остановке"""
+        self.addr = addr
+        self.workers = workers or os.cpu_count()
+        self.handler_cls = handler_cls
+        self.backlog = backlog
+        self.grace = grace
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        # pid -> (socketpair, его makefile): управление воркером
+        self._channels = {}
+        # воркеры, которым отправлен 'stop': их выход - не падение
+        self._retiring = set()
+        self._stopping = False
+        self._reserved = None
+
+    def start(self):
+        """Запускает воркеров и возвращается, когда все они слушают порт"""
+        if self._reserved is not None:
+            return
+
+        # сигналы ждет run() через sigwait; SIGCHLD, пришедший до него, тоже не должен потеряться
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.signals)
+
+        # Порт занимается один раз и держится до конца: для порта 0 все воркеры и все их поколения после
+        # restart() должны слушать один и тот же. Сокет не слушает, поэтому соединений не получает.
+        self._reserved = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._reserved.bind(self.addr)
+        self.addr = self._reserved.getsockname()
+
+        for _ in range(self.workers):
+            self._spawn()
+
+    def run(self):
+        """start() и обработка сигналов, пока живы воркеры"""
+        self.start()
+        try:
+            while self._channels:
+                signum = signal.sigwait(self.signals)
+                if signum == signal.SIGCHLD:
+                    self._reap()
+                elif signum == signal.SIGHUP:
+                    self.restart()
+                elif signum == signal.SIGUSR1:
+                    print(json.dumps(self.stats()))
+                elif self._stopping:
+                    for pid in self._channels:
+                        os.kill(pid, signal.SIGTERM)
+                else:
+                    self.stop()
+        finally:
+            self._reserved.close()
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+
+    def restart(self):
+        """Плавный перезапуск: новое поколение воркеров начинает принимать соединения, затем старое перестает
+        и дорабатывает открытые (Server.stop)
+
+        Соединения, которые ядро уже поставило в очередь accept старого воркера, тот принимает до закрытия
+        сокета и отвечает на их первый запрос; следующие соединения ядро раздает новому поколению.
+        """
+        old = [pid for pid in self._channels if pid not in self._retiring]
+        for _ in range(self.workers):
+            self._spawn()
+        for pid in old:
+            self._retire(pid)
+
+    def stop(self):
+        """Останавливает всех воркеров плавно; run() вернется, когда они завершатся"""
+        self._stopping = True
+        for pid in list(self._channels):
+            self._retire(pid)
+
+    def stats(self):
+        """Статистика работающих воркеров и суммы по ним: {'workers': [...], 'requests': ..., ...}"""
+        workers = []
+        for pid, (channel, rfile) in self._channels.items():
+            if pid in self._retiring:
+                continue
+            try:
+                channel.sendall(b'stats\n')
+                workers.append(json.loads(rfile.readline()))
+            except (OSError, ValueError):
+                # воркер упал - его перезапустит _reap
+                continue
+
+        total = {'workers': workers}
+        for key in ('accepted', 'connections', 'requests', 'callbacks', 'slow_callbacks'):
+            total[key] = sum(worker[key] for worker in workers)
+        return total
+
+    def _spawn(self):
+        channel, child_channel = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                # чужие концы socketpair воркеру не нужны: их закрытие должен видеть только супервизор
+                channel.close()
+                for other, rfile in self._channels.values():
+                    rfile.close()
+                    other.close()
+                self._reserved.close()
+                self._work(child_channel)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+
+        child_channel.close()
+        channel.settimeout(self.grace / 1000)
+        rfile = channel.makefile('rb')
+        self._channels[pid] = (channel, rfile)
+        # воркер отвечает 'ready', когда его сокет уже слушает
+        if rfile.readline() != b'ready\n':
+            raise ChildProcessError(f'worker {pid} failed to start')
+
+    def _retire(self, pid):
+        self._retiring.add(pid)
+        try:
+            self._channels[pid][0].sendall(b'stop\n')
+        except OSError:
+            pass
+
+    def _reap(self):
+        for pid in list(self._channels):
+            try:
+                exited, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                exited, status = pid, None
+            if not exited:
+                continue
+
+            channel, rfile = self._channels.pop(pid)
+            rfile.close()
+            channel.close()
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+            elif not self._stopping:
+                print(f'worker {pid} exited with status {status}, restarting')
+                self._spawn()
+
+    def _work(self, channel):
+        # Ctrl+C получает вся группа процессов - останавливает воркеров супервизор
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for signum in self.signals - {signal.SIGINT}:
+            signal.signal(signum, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, self.signals)
+        Handler.seed = self.seed
+
+        event_loop = EventLoop()
+        Context.set_event_loop(event_loop)
+        event_loop.run(worker, self.addr, channel, self.handler_cls, self.backlog, self.grace)
+
+
+def worker(addr, channel, handler_cls=AsyncHandler, backlog=KB, grace=5000):
+    """Генератор воркера: Server на addr с SO_REUSEPORT и команды супервизора из channel"""
+    server = Server(addr, handler_cls, backlog, reuse_port=True)
+    control = async_socket(sock=channel)
+    Context.event_loop.spawn(server.serve())
+
+    try:
+        yield control.sendall(b'ready\n')
+        while True:
+            command = yield control.readline()
+            if command != b'stats\n':
+                # 'stop' или EOF - супервизора больше нет
+                break
+
+            stats = dict(server.stats(), pid=os.getpid())
+            snapshot = Context.event_loop.snapshot()
+            for key in ('polls', 'events', 'callbacks', 'slow_callbacks'):
+                stats[key] = snapshot.get(key, 0)
+            yield control.sendall(json.dumps(stats).encode('utf8') + b'\n')
+    finally:
+        server.stop(grace)
+        control.close()
@@ -1,107 +1,210 @@
+import types
+
 from facade import Context
 
-from log import get_callable_representation, get_console
+from log import Repr, get_console
+
+console = get_console(format='<b><fg #F92672>Promise</fg #F92672></b>{message}', name='Promise')
+
+
+# что запускается задачей (Task): генераторы и корутины async def
+TASK_TYPES = (types.GeneratorType, types.CoroutineType)
+
+
+class CancelledError(Exception):
+    """Ожидание промиса отменено через Promise.cancel()"""
+
 
-console = get_console(format='<b><fg #F92672>Promise</fg #F92672></b>{message}')
+def _invoke(callback, args):
+    """callback(*args) как колбек цикла: ошибка печатается, а не бросается тому, кто выполнил промис,
+    генератор, который вернул колбек, запускается задачей"""
+    try:
+        returned = callback(*args)
+    except Exception as exc:
+        print('Uncaught exception:', exc)
+        return
+    if returned is not None and isinstance(returned, TASK_TYPES):
+        Context.event_loop.spawn(returned)
 
 
 class Promise(Context):
-    """Способ привязки нескольких колбеков к вызову _resolve"""
+    """Способ привязки нескольких колбеков к вызову _resolve
+
+    Подписчик - продолжение, пара (on_resolve, on_reject), любой из колбеков может быть None. Первое продолжение
+    хранится в самом промисе, список _more появляется только со вторым подписчиком: ожидание задачи и
+    p.then(a).catch(b) обходятся без списков. Колбеки вызываются напрямую, без EventLoop._execute.
+
+    await promise в корутине async def - то же, что yield promise в генераторе задачи.
+    """
+    __slots__ = ('_resolved', '_rejected', '_value', '_on_resolve', '_on_reject', '_more', '_canceller')
+
     def __init__(self):
-        self._on_resolve = []
-        self._on_reject = []
         self._resolved = False
         self._rejected = False
         self._value = None
-
-
-    # вроде это пока не используется
-    # @classmethod
-    # def all(cls, promises):
-    #     console(f'.all({promises})')
-    #
-    #     pall = cls()
-    #     counter = len(promises)
-    #
-    #     if counter == 0:
-    #         pall._resolve()
-    #         return pall
-    #
-    #     results = [None] * counter
-    #
-    #     def _on_single_resolved(i):
-    #         def _callback(*args):
-    #             nonlocal counter
-    #
-    #             results[i] = args
-    #             counter -= 1
-    #             if counter == 0:
-    #                 pall._resolve(results)
-    #
-    #         return _callback
-    #
-    #     for idx, p in enumerate(promises):
-    #         p.then(_on_single_resolved(idx))
-    #         p.catch(pall._reject)
-    #
-    #     return pall
+        # первое продолжение
+        self._on_resolve = None
+        self._on_reject = None
+        # остальные продолжения [(on_resolve, on_reject)] в порядке подписки
+        self._more = None
+        # источник промиса (таймер, сокет) может задать, как отменить ожидаемую операцию
+        self._canceller = None
+
+    @classmethod
+    def all(cls, promises):
+        """Промис списка значений promises в исходном порядке, отклоняется первой же ошибкой
+
+        Значение промиса - первый аргумент его _resolve, как у yield промиса в задаче. Всем промисам - одно и то же
+        продолжение: результаты собираются из самих промисов, когда выполнится последний.
+        cancel() отменяет невыполненные промисы, которых больше никто не ждет.
+        """
+        promises = list(promises)
+        pall = cls()
+        remaining = len(promises)
+        if not remaining:
+            pall._resolve([])
+            return pall
+
+        def _one(*_):
+            nonlocal remaining
+            remaining -= 1
+            if not remaining:
+                pall._resolve([p._value[0] if p._value else None for p in promises])
+
+        def _cancel():
+            for p in promises:
+                if not (p._resolved or p._rejected or p._unsubscribe(_one, reject)):
+                    p.cancel()
+
+        reject = pall._reject
+        pall._canceller = _cancel
+        for p in promises:
+            p._subscribe(_one, reject)
+        return pall
+
+    def __await__(self):
+        # уже выполненный промис отдает значение сразу, без круга через задачу
+        if self._resolved:
+            return self._value[0] if self._value else None
+        if self._rejected:
+            raise self._value
+        return (yield self)
 
     def then(self, callback):
-        callback_str = get_callable_representation(callback)
-        console(f'.then(callback={callback_str})')
+        if console.tracing:
+            console.trace('.then(callback={})', Repr(callback))
 
-        if self._resolved:
-            console(f'.then: self._resolved -> el._execute({callback_str}, *{self._value})')
+        return self._subscribe(callback, None)
 
-            self.event_loop._execute(callback, *self._value)
-        elif not self._rejected:
-            console(f'.then: not self._rejected -> append {callback_str} to self._on_resolve')
+    def catch(self, callback):
+        if console.tracing:
+            console.trace('.catch(callback={})', Repr(callback))
 
-            self._on_resolve.append(callback)
-        return self
+        return self._subscribe(None, callback)
 
-    def catch(self, callback):
-        callback_str = get_callable_representation(callback)
-        console(f'.catch(callback={callback_str}')
+    def cancel(self):
+        """Отменяет операцию источника и отклоняет промис с CancelledError
 
-        if self._rejected:
-            console(f'.catch: self._rejected -> el._execute({callback_str}, *{self._value}')
+        Returns: bool - False, если промис уже выполнен или отклонен
+        """
+        if self._resolved or self._rejected:
+            return False
 
-            self.event_loop._execute(callback, self._value)
-        elif not self._resolved:
-            console(f'.catch: not self._resolved -> append {callback_str} to self._on_reject')
+        if self._canceller:
+            self._canceller()
+        self._reject(CancelledError())
+        return True
 
-            self._on_reject.append(callback)
+    def _subscribe(self, on_resolve, on_reject):
+        """Добавляет продолжение; у выполненного (отклоненного) промиса нужный колбек вызывается сразу"""
+        if self._resolved:
+            if on_resolve is not None:
+                _invoke(on_resolve, self._value)
+        elif self._rejected:
+            if on_reject is not None:
+                _invoke(on_reject, (self._value,))
+        elif (self._more is None and (on_resolve is None or self._on_resolve is None)
+                and (on_reject is None or self._on_reject is None)):
+            # первое продолжение свободно целиком или в нужной половине (p.then(a).catch(b))
+            if on_resolve is not None:
+                self._on_resolve = on_resolve
+            if on_reject is not None:
+                self._on_reject = on_reject
+        elif self._more is None:
+            self._more = [(on_resolve, on_reject)]
+        else:
+            self._more.append((on_resolve, on_reject))
         return self
 
+    def _subscribed(self, rejects=False):
+        """Есть ли у промиса подписчики; rejects - только обработчики ошибки"""
+        if rejects:
+            return self._on_reject is not None or any(on_reject is not None for _, on_reject in self._more or ())
+        return self._on_resolve is not None or self._on_reject is not None or bool(self._more)
+
+    def _unsubscribe(self, on_resolve, on_reject):
+        """Снимает колбеки, добавленные then/catch/_subscribe; -> остались ли у промиса другие подписчики"""
+        if self._on_resolve == on_resolve:
+            self._on_resolve = None
+        if self._on_reject == on_reject:
+            self._on_reject = None
+        if self._more:
+            self._more = [(None if resolve == on_resolve else resolve, None if reject == on_reject else reject)
+                          for resolve, reject in self._more]
+            self._more = [pair for pair in self._more if pair != (None, None)] or None
+        return self._subscribed()
+
     def _resolve(self, *args):
-        console(f'._resolve(args={args})')
+        tracing = console.tracing
+        if tracing:
+            console.trace('._resolve(args={})', args)
 
         if self._resolved or self._rejected:
-            console(f"._resolve: {'resolved' if self._resolved else 'rejected'} -> return")
+            if tracing:
+                console.trace("._resolve: {} -> return", 'resolved' if self._resolved else 'rejected')
 
             return
 
         self._resolved = True
         self._value = args
+        if self._on_resolve is None and self._on_reject is None and self._more is None:
+            return
+
+        # продолжения больше не нужны: выполненный промис не держит ни их, ни то, на что они ссылаются
+        callback, more = self._on_resolve, self._more
+        self._on_resolve = self._on_reject = self._more = None
 
-        if self._on_resolve:  # debug
-            console(f'._resolve: el._execute\n\t{self._on_resolve}')
+        if tracing:
+            console.trace('._resolve: run\n\t{}\n\t{}', Repr(callback), more)
 
-        for callback in self._on_resolve:
-            self.event_loop._execute(callback, *args)
+        if callback is not None:
+            _invoke(callback, args)
+        if more:
+            for callback, _ in more:
+                if callback is not None:
+                    _invoke(callback, args)
 
     def _reject(self, error):
+        tracing = console.tracing
         if self._resolved or self._rejected:
-            console(f"._reject: {'resolved' if self._resolved else 'rejected'} -> return")
+            if tracing:
+                console.trace("._reject: {} -> return", 'resolved' if self._resolved else 'rejected')
 
             return
 
         self._rejected = True
         self._value = error
 
-        if self._on_reject:  # debug
-            console(f'._reject: run\n\t{self._on_reject}\n\t\t with error={error}')
+        callback, more = self._on_reject, self._more
+        self._on_resolve = self._on_reject = self._more = None
+
+        if tracing:
+            console.trace('._reject: run\n\t{}\n\t{}\n\t\t with error={}', Repr(callback), more, error)
 
-        for callback in self._on_reject:
-            callback(error)
+        args = (error,)
+        if callback is not None:
+            _invoke(callback, args)
+        if more:
+            for _, callback in more:
+                if callback is not None:
+                    _invoke(callback, args)
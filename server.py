@@ -1,59 +1,342 @@
 import json
 import random
-from socketserver import BaseRequestHandler, TCPServer
-from uuid import uuid4
+import socket
+import sys
+import threading
+from socketserver import BaseRequestHandler, TCPServer, ThreadingTCPServer
 
+from async_socket import FRAME_HEADER, IncompleteReadError, async_socket
 from consts import KB, serv_addr
+from event_loop import EventLoop
+from facade import Context
+from utils import sleep
+import wire
 
 
 class Handler(BaseRequestHandler):
     users = {}
     accounts = {}
+    # KeepAliveServer обслуживает соединения в потоках
+    lock = threading.Lock()
+    # keep-alive: обслуживать в одном соединении сколько угодно запросов, разделенных '\n'
+    keep_alive = False
+    # строка MGET с тысячами id длиннее KB
+    max_request = 64 * KB
+    # ответ на MGET отправляется кусками по столько байт, не дожидаясь сборки целиком
+    flush_size = 64 * KB
+    # Процессы prefork (см. prefork.py) не делят users/accounts. С общим seed запись - чистая функция (seed, id):
+    # имя и баланс из Random(seed, id), счет пользователя с тем же id, - и любой воркер отвечает одинаково,
+    # в какой бы из них ни попало соединение. Без seed - случайные значения и счета по порядку создания.
+    seed = None
 
     def handle(self):
-        client = f'client {self.client_address}'
-        req = self.request.recv(KB)
-        if not req:
-            print(f'{client} unexpectedly disconnected')
-            return
+        # буферизованное чтение строками: запрос может прийти по частям или вместе со следующим
+        with self.request.makefile('rb') as rfile:
+            req = rfile.readline(self.max_request)
+            if not req:
+                self.log(f'{self.client} unexpectedly disconnected')
+                return
+
+            # после wire.HELLO запросы и ответы - кадры бинарного протокола
+            binary = False
+            while req:
+                if req == wire.HELLO and not binary:
+                    binary = True
+                    self.request.sendall(wire.ACCEPTED)
+                else:
+                    self.handle_request(req, binary)
+                    if not self.keep_alive:
+                        return
+                req = wire.read_frame(rfile, self.max_request) if binary else rfile.readline(self.max_request)
+
+    @property
+    def client(self):
+        return f'client {self.client_address}'
+
+    def handle_request(self, req, binary=False):
+        self.log(f'{self.client} < {req}')
+        for resp in self.respond(req, binary):
+            self.log(f'{self.client} > {self.brief(resp)}')
+            self.request.sendall(resp)
 
-        print(f'{client} < {req}')
+    @classmethod
+    def parse(cls, req):
+        """Строка запроса -> (method, entity_kind, ids): 'GET <kind> <id>' или 'MGET <kind> <id> <id> ...'"""
         req = req.decode('utf8')
         if req[-1] != '\n':
             raise Exception('Max request length exceeded')
 
-        method, entity_kind, entity_id = req[:-1].split(' ', 3)
-        if (method != 'GET'
+        method, entity_kind, *ids = req[:-1].split(' ')
+        if (method not in ('GET', 'MGET')
                 or entity_kind not in ('user', 'account')
-                or not entity_id.isdigit()):
+                or not ids
+                or method == 'GET' and len(ids) != 1
+                or not all(entity_id.isdigit() for entity_id in ids)):
             raise Exception('Bad request')
+        return method, entity_kind, ids
 
-        if entity_kind == 'user':
-            user = self.users.get(entity_id) or {'id': entity_id}
-            self.users[entity_id] = user
-
-            if 'name' not in user:
-                user['name'] = str(uuid4()).split('-')[0]
-
-            if 'account_id' not in user:
-                account_id = str(len(self.accounts) + 1)
-                account = {'id': account_id,
-                           'balance': random.randint(0, 100)}
-                self.accounts[account_id] = account
-                user['account_id'] = account_id
-            self.send(user)
+    @classmethod
+    def respond(cls, req, binary=False):
+        """Генератор байтов ответа на запрос
+
+        GET - строка JSON. MGET - по кадру (FRAME_HEADER + JSON) на каждый id в порядке запроса, null для
+        несуществующих; кадры отдаются кусками по flush_size байт, пока собираются следующие.
+        binary - req это тело кадра wire.py, ответ - кадры записей wire (несуществующая сущность и на GET).
+        """
+        if binary:
+            method, entity_kind, ids = wire.decode_request(req)
+            entities = (cls.lookup(entity_kind, entity_id, missing_ok=True) for entity_id in ids)
+            yield from wire.encode_records(entity_kind, entities, cls.flush_size)
             return
 
+        method, entity_kind, ids = cls.parse(req)
+        if method == 'GET':
+            yield cls.encode(cls.lookup(entity_kind, ids[0]))
+            return
+
+        chunk = bytearray()
+        for entity_id in ids:
+            record = json.dumps(cls.lookup(entity_kind, entity_id, missing_ok=True)).encode('utf8')
+            chunk += FRAME_HEADER.pack(len(record))
+            chunk += record
+            if len(chunk) >= cls.flush_size:
+                yield chunk
+                chunk = bytearray()
+        if chunk:
+            yield chunk
+
+    @classmethod
+    def lookup(cls, entity_kind, entity_id, missing_ok=False):
+        """Сущность по id; пользователь создается при первом обращении, несуществующий счет - KeyError
+        или None при missing_ok"""
+        if entity_kind == 'user':
+            with cls.lock:
+                user = cls.users.get(entity_id) or {'id': entity_id}
+                cls.users[entity_id] = user
+
+                if 'name' not in user:
+                    user['name'] = f'{cls._random("user", entity_id).getrandbits(32):08x}'
+
+                if 'account_id' not in user:
+                    account_id = entity_id if cls.seed is not None else str(len(cls.accounts) + 1)
+                    cls.accounts[account_id] = cls._account(account_id)
+                    user['account_id'] = account_id
+            return user
+
         if entity_kind == 'account':
-            account = self.accounts[entity_id]
-            self.send(account)
+            if cls.seed is not None and entity_id not in cls.accounts:
+                # пользователя создал другой воркер - счет выводится из того же seed
+                with cls.lock:
+                    return cls.accounts.setdefault(entity_id, cls._account(entity_id))
+            if missing_ok:
+                return cls.accounts.get(entity_id)
+            return cls.accounts[entity_id]
 
-    def send(self, data):
-        resp = json.dumps(data).encode('utf8')
-        print(f'client {self.client_address} > {resp}')
-        self.request.sendall(resp)
+    @classmethod
+    def _account(cls, account_id):
+        return {'id': account_id, 'balance': cls._random('account', account_id).randint(0, 100)}
+
+    @classmethod
+    def _random(cls, kind, entity_id):
+        if cls.seed is None:
+            return random
+        return random.Random(f'{cls.seed}:{kind}:{entity_id}')
+
+    @staticmethod
+    def encode(data):
+        # '\n' разделяет ответы в keep-alive соединении
+        return json.dumps(data).encode('utf8') + b'\n'
+
+    @staticmethod
+    def brief(resp):
+        # кусок ответа MGET в лог целиком не пишется
+        return resp if len(resp) <= 256 else f'<{len(resp)} bytes>'
+
+    def log(self, message):
+        print(message)
+
+
+class KeepAliveHandler(Handler):
+    keep_alive = True
+
+
+class KeepAliveServer(ThreadingTCPServer):
+    """Keep-alive соединение занимает обработчик надолго - каждому соединению свой поток"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class AsyncHandler(Context):
+    """Keep-alive соединение, обслуживаемое задачей на EventLoop, логика запросов - Handler.respond"""
+    # запросов обслужено в этом процессе
+    served = 0
+
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.client = f'client {client_address}'
+        self.busy = False  # запрос прочитан, ответ еще не отправлен
+        self.closing = False
+        self.requests = 0  # обслужено в этом соединении
+
+    def handle(self):
+        binary = False
+        try:
+            while not self.closing or not self.requests:
+                if binary:
+                    try:
+                        req = yield self.sock.readframe(limit=Handler.max_request)
+                    except IncompleteReadError as exc:
+                        if exc.partial:
+                            raise
+                        return
+                else:
+                    req = yield self.sock.readline(limit=Handler.max_request)
+                    if not req:
+                        return
+                    if req == wire.HELLO:
+                        binary = True
+                        yield self.sock.sendall(wire.ACCEPTED)
+                        continue
+
+                self.busy = True
+                self.log(f'{self.client} < {req}')
+                for resp in Handler.respond(req, binary):
+                    self.log(f'{self.client} > {Handler.brief(resp)}')
+                    yield self.sock.sendall(resp)
+                self.busy = False
+                self.requests += 1
+                AsyncHandler.served += 1
+        except Exception as exc:
+            # закрытое в close() соединение отклоняет ожидающий readline - это не ошибка
+            if not self.closing:
+                self.log(f'{self.client} error: {exc!r}')
+        finally:
+            self.sock.close()
+
+    def close(self):
+        """Плавное закрытие: простаивающее соединение закрывается сразу, занятое - после отправки ответа
+
+        Новое соединение, еще без запросов, сначала отвечает на первый: клиент отправил его, не дожидаясь
+        ничего от сервера, и повторять на новом соединении не станет. Молчащее закроет grace сервера.
+        """
+        self.closing = True
+        if not self.busy and self.requests:
+            self.sock.close()
+
+    def abort(self):
+        self.closing = True
+        self.sock.close()
+
+    def log(self, message):
+        print(message)
+
+
+class Server(Context):
+    """Слушающий сокет на EventLoop: serve() принимает соединения, stop() останавливает сервер плавно
+
+    Каждое принятое соединение - отдельная задача handler_cls(sock, client_address).handle(); для stop()
+    обработчик должен уметь close() (плавно) и abort() (сразу), как AsyncHandler.
+    reuse_port - SO_REUSEPORT: так слушают общий порт воркеры prefork.
+    """
+    def __init__(self, addr, handler_cls=AsyncHandler, backlog=KB, reuse_port=False):
+        self.handler_cls = handler_cls
+        self.listener = async_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(addr, reuse_port=reuse_port)
+        self.listener.listen(backlog)
+        self.handlers = set()
+        self.accepted = 0
+        self.stopping = False
+        self._grace = None
+
+    def getsockname(self):
+        return self.listener.getsockname()
+
+    def serve(self):
+        try:
+            while True:
+                try:
+                    sock, client_address = yield self.listener.accept()
+                except ConnectionError:
+                    # stop() закрыл слушающий сокет
+                    if self.stopping:
+                        return
+                    raise
+
+                self._handle(sock, client_address)
+        finally:
+            self.listener.close()
+
+    def stop(self, grace=5000):
+        """Перестает принимать соединения и закрывает открытые: простаивающие сразу, занятые - после ответа,
+        а не успевшие за grace мс - принудительно. Цикл событий завершится, когда закроется последнее.
+
+        Соединения, которые ядро уже поставило в очередь listen, закрытие сокета сбросило бы (RST), хотя клиент
+        мог успеть отправить запрос. Поэтому они принимаются до закрытия и, как и остальные новые, отвечают
+        на первый запрос (см. AsyncHandler.close). С SO_REUSEPORT следующие соединения ядро отдает соседям.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        while True:
+            accepted = self.listener.accept_nowait()
+            if accepted is None:
+                break
+            self._handle(*accepted)
+        self.listener.close()
+
+        for handler in list(self.handlers):
+            handler.close()
+        if self.handlers:
+            self._grace = sleep(grace)
+            self._grace.then(self._abort)
+
+    def stats(self):
+        return {'accepted': self.accepted, 'connections': len(self.handlers), 'requests': AsyncHandler.served}
+
+    def _handle(self, sock, client_address):
+        self.accepted += 1
+        handler = self.handler_cls(sock, client_address)
+        self.handlers.add(handler)
+        task = self.event_loop.spawn(handler.handle())
+        task.then(lambda *_, handler=handler: self._finished(handler))
+        task.catch(lambda _, handler=handler: self._finished(handler))
+
+    def _finished(self, handler):
+        self.handlers.discard(handler)
+        if self._grace is not None and not self.handlers:
+            # таймер не должен держать цикл, когда закрывать уже нечего
+            self._grace.cancel()
+
+    def _abort(self, *_):
+        for handler in list(self.handlers):
+            handler.abort()
+
+
+def serve(addr, handler_cls=AsyncHandler, backlog=KB, on_listen=None, reuse_port=False):
+    """Генератор сервера на EventLoop, см. Server
+
+    on_listen(addr) вызывается, когда сокет уже слушает (для порта 0 - с выбранным портом).
+    """
+    server = Server(addr, handler_cls, backlog, reuse_port)
+    if on_listen:
+        on_listen(server.getsockname())
+    yield server.serve()
 
 
 if __name__ == '__main__':
-    with TCPServer(serv_addr, Handler) as server:
-        server.serve_forever()
+    if '--no-keep-alive' in sys.argv:
+        with TCPServer(serv_addr, Handler) as server:
+            server.serve_forever()
+    elif '--threads' in sys.argv:
+        with KeepAliveServer(serv_addr, KeepAliveHandler) as server:
+            server.serve_forever()
+    elif '--workers' in sys.argv:
+        # python server.py --workers N: N процессов на общем порту, 0 - по числу ядер
+        from prefork import Supervisor
+
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+        Supervisor(serv_addr, workers or None).run()
+    else:
+        event_loop = EventLoop()
+        Context.set_event_loop(event_loop)
+        event_loop.run(serve, serv_addr)
@@ -0,0 +1,268 @@
+import types
+
+from promise import TASK_TYPES, CancelledError, Promise
+
+from log import Repr, get_console
+
+console = get_console(format='<light-yellow>Task</light-yellow>{message}', name='Task')
+
+
+class Task(Promise):
+    """Исполняет генератор и все генераторы, которые он yield'ит, без рекурсии
+
+    Вместо цепочки partial(unwind, ...) на каждый yield задача держит стек генераторов: yield генератора кладет
+    его на стек, return снимает и отправляет значение генератору ниже, исключение бросается в него же.
+    Если верхний генератор yield'ит промис, задача подписывается на него и выходит из _step; выполнение
+    промиса продолжает тот же плоский цикл. Уже выполненные промисы обрабатываются сразу, без подписки.
+
+    Корутины async def исполняются так же: корутина на стеке - один элемент, вложенные await проходят внутри
+    интерпретатора, и задача видит только промис в самом низу цепочки (см. Promise.__await__). Генератор может
+    yield'ить корутину, а корутина ждать генератор через await utils.wait(generator).
+
+    Task сам является промисом результата корневого генератора, cancel() останавливает задачу.
+    """
+    __slots__ = ('_stack', '_waiting', '_must_cancel')
+    # вызывается с задачей перед каждым продвижением стека (LoopMetrics.stepped.append)
+    on_step = None
+
+    def __init__(self, generator):
+        super().__init__()
+        self._stack = [generator]
+        self._waiting = None  # промис, на котором стоит верхний генератор
+        self._must_cancel = False  # cancel() во время собственного шага
+
+    def __repr__(self):
+        return f'<Task {self._stack[0] if self._stack else "done"} depth={len(self._stack)}>'
+
+    def format_stack(self):
+        """Стек генераторов задачи от корневого к верхнему: 'имя (файл:строка)', строка - текущий yield
+
+        У корутин в стек попадает и цепочка их await.
+        """
+        lines = []
+        for generator in self._stack:
+            while generator is not None:
+                if isinstance(generator, types.CoroutineType):
+                    code, frame, awaited = generator.cr_code, generator.cr_frame, generator.cr_await
+                else:
+                    code, frame, awaited = generator.gi_code, generator.gi_frame, generator.gi_yieldfrom
+                lineno = frame.f_lineno if frame else code.co_firstlineno
+                lines.append(f'{code.co_name} ({code.co_filename}:{lineno})')
+                generator = awaited if isinstance(awaited, TASK_TYPES) else None
+        return lines
+
+    def cancel(self):
+        """Останавливает задачу: CancelledError бросается в верхний генератор стека и раскручивает его как
+        обычное исключение - except и finally (например sock.close()) выполняются
+
+        Промис, которого ждала задача, отменяется, если его больше никто не ждет: таймер снимается с колеса,
+        операция сокета - с селектора, дочерние задачи списка (gather) отменяются. Общий промис (запрос кэша,
+        пакет Batcher) остается тем, кто его еще ждет. Задача, отменившая сама себя, получит CancelledError на
+        ближайшем ожидании. Генератор может перехватить CancelledError и продолжить работу.
+
+        Returns: bool - False, если задача уже завершилась
+        """
+        if self._resolved or self._rejected:
+            return False
+
+        waiting = self._waiting
+        if waiting is None:
+            # задача сейчас выполняется - ожидание прервется, как только она до него дойдет
+            self._must_cancel = True
+            return True
+
+        if console.enabled:
+            console('.cancel: {} waiting for {}', self, waiting)
+        self._waiting = None
+        if not waiting._unsubscribe(self._send, self._throw):
+            waiting.cancel()
+        self._step(None, CancelledError())
+        return True
+
+    def _step(self, value=None, error=None):
+        if self.on_step is not None:
+            self.on_step(self)
+
+        tracing = console.tracing
+        stack = self._stack
+        self._waiting = None
+
+        while stack:
+            generator = stack[-1]
+            if tracing:
+                console.trace('._step(gen={}, value={}, error={!r})', generator, value, error)
+
+            try:
+                # пробуем пнуть генератор
+                if error is None:
+                    returned = generator.send(value)
+                else:
+                    returned = generator.throw(error)
+            except StopIteration as stop:
+                stack.pop()
+                value, error = stop.value, None
+                continue
+            except Exception as exc:
+                stack.pop()
+                value, error = None, exc
+                continue
+
+            value = error = None
+
+            if isinstance(returned, TASK_TYPES):
+                stack.append(returned)
+                continue
+
+            if not isinstance(returned, Promise):
+                try:
+                    returned = gather(returned)
+                except Exception as exc:
+                    error = exc
+                    continue
+
+            if returned._resolved:
+                value = returned._value[0] if returned._value else None
+            elif returned._rejected:
+                error = returned._value
+            elif self._must_cancel:
+                self._must_cancel = False
+                if not returned._subscribed():
+                    returned.cancel()
+                error = CancelledError()
+            else:
+                if tracing:
+                    console.trace('._step: waiting for {}', returned)
+                self._waiting = returned
+                returned._subscribe(self._send, self._throw)
+                return
+
+        if error is None:
+            self._resolve(value)
+            return
+
+        if not self._subscribed(rejects=True) and not isinstance(error, CancelledError):
+            # на задачу никто не подписан - ошибку некому обработать; отмену обрабатывать не нужно
+            print('Uncaught rejection:', error)
+        self._reject(error)
+
+    def _send(self, value=None, *_):
+        self._step(value)
+
+    def _throw(self, error):
+        self._step(None, error)
+
+
+def gather(awaitables, return_exceptions=False, first_completed=False, max_concurrency=None):
+    """Промис со списком результатов awaitables (генераторы/промисы) в исходном порядке
+
+    Args:
+        awaitables: генераторы и корутины запускаются отдельными задачами, промисы просто ожидаются
+        return_exceptions: ошибка ребенка кладется в результаты вместо отклонения общего промиса
+        first_completed: выполнить промис результатом первого завершившегося (ошибкой - отклонить)
+        max_concurrency: сколько генераторов выполняется одновременно, остальные стартуют по мере
+            завершения предыдущих
+
+    Без return_exceptions промис отклоняется первой же ошибкой: новые генераторы не стартуют, выполняющиеся
+    отменяются. С first_completed остальные дети отменяются, как только результат есть (hedged-запросы:
+    проигравший сразу освобождает соединение). Дети отменяются до того, как выполнится общий промис: к
+    продолжению родителя их finally уже выполнены. cancel() общего промиса отменяет все выполняющиеся задачи и ожидаемые промисы, как
+    Task.cancel: промис отменяется, только если его больше никто не ждет.
+    """
+    if console.tracing:
+        console.trace('gather({}, return_exceptions={}, first_completed={}, max_concurrency={})',
+                      Repr(awaitables), return_exceptions, first_completed, max_concurrency)
+
+    awaitables = list(awaitables)
+    pall = Promise()
+    results = [None] * len(awaitables)
+    remaining = len(awaitables)
+    running = 0
+    filling = False
+    pending = iter(enumerate(awaitables))
+    finished = False
+    tasks = {}  # i -> выполняющаяся задача генератора
+    promises = {}  # i -> (ожидаемый промис, on_resolve, on_reject)
+
+    if not remaining:
+        pall._resolve(None if first_completed else results)
+        return pall
+
+    def _done(i, value, error):
+        nonlocal remaining, running
+        running -= 1
+        remaining -= 1
+        tasks.pop(i, None)
+        promises.pop(i, None)
+        if finished or pall._resolved or pall._rejected:
+            return
+
+        if error is not None and not return_exceptions:
+            _finish(pall._reject, error)
+            return
+
+        result = value if error is None else error
+        if first_completed:
+            _finish(pall._resolve, result)
+            return
+
+        results[i] = result
+        if remaining == 0:
+            pall._resolve(results)
+        else:
+            _fill()
+
+    def _start(i, c):
+        if isinstance(c, TASK_TYPES):
+            task = tasks[i] = Task(c)
+            task.then(lambda value=None, *_: _done(i, value, None)).catch(lambda error: _done(i, None, error))
+            task._step()
+        elif isinstance(c, Promise):
+            on_resolve = lambda value=None, *_: _done(i, value, None)  # noqa
+            on_reject = lambda error: _done(i, None, error)  # noqa
+            # до подписки: выполненный промис вызовет _done сразу
+            promises[i] = (c, on_resolve, on_reject)
+            c._subscribe(on_resolve, on_reject)
+        else:
+            _done(i, None, Exception('Only promise or generator can be yielded to event loop'))
+
+    def _fill():
+        # дети, завершившиеся синхронно, не должны запускать следующих рекурсивно
+        nonlocal running, filling
+        if filling:
+            return
+        filling = True
+        while not (pall._resolved or pall._rejected) and (max_concurrency is None or running < max_concurrency):
+            item = next(pending, None)
+            if item is None:
+                break
+            running += 1
+            _start(*item)
+        filling = False
+
+    def _finish(settle=None, *args):
+        # сначала отмена оставшихся детей, потом settle(*args): ошибки отмененных детей pall уже не трогают
+        nonlocal finished
+        finished = True
+        _cancel()
+        if settle is not None:
+            settle(*args)
+
+    def _cancel():
+        nonlocal pending
+        # новые генераторы не стартуют, выполняющиеся отменяются
+        pending = iter(())
+        for task in list(tasks.values()):
+            task.cancel()
+        # общий промис (запрос кэша, пакет Batcher) остается тем, кто его еще ждет
+        for p, on_resolve, on_reject in list(promises.values()):
+            if not p._unsubscribe(on_resolve, on_reject):
+                p.cancel()
+        promises.clear()
+
+    pall._canceller = _finish
+    _fill()
+    return pall
+
+
+# список, yield'нутый генератором, ждется так же
+wait_all = gather
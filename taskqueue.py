@@ -1,137 +1,209 @@
-import collections
-import heapq
-import selectors
+import random
 import time
 
-from log import get_callable_representation, get_console
+from consts import MS, SECOND
 
-console = get_console(format='TaskQueue{message}')
+from log import Repr, get_console
+from pollers import make_poller
+from timers import TimerWheel
+from utils import hrtime
+
+console = get_console(format='TaskQueue{message}', name='TaskQueue')
 
 
 class TaskQueue:
-    """Фасад для двух суб-очередей"""
-    def __init__(self):
+    """Фасад для двух суб-очередей
+
+    virtual - виртуальные часы: i/o проверяется без ожидания, и если ничего не готово, часы прыгают сразу к
+    ближайшему таймеру. Часы начинаются с 0 и идут только так: минуты sleep() проходят за один опрос.
+    seed - партия каждой итерации перемешивается Random(seed): другой порядок колбеков, готовых одновременно,
+    но один и тот же при том же seed.
+
+    Кроме сокетов ОС регистрируются файловые объекты в памяти (memory.MemorySocket): у них нет fd, готовность
+    они сообщают сами через poll_events(), а о ее возможном изменении - через notify().
+
+    poller - бэкенд опроса i/o по имени из pollers.POLLERS ('select', 'poll', 'epoll', 'selectors'),
+    None - epoll, где он есть.
+    """
+    def __init__(self, virtual=False, seed=None, poller=None):
         # мультиплексирование i/o
-        self._selector = selectors.DefaultSelector()
-        self._timers = []
-        self._timer_no = 0
-        self._ready = collections.deque()
+        self._poller = make_poller(poller)
+        self.virtual = virtual
+        self._random = random.Random(seed) if seed is not None else None
+        # часы цикла (hrtime, нс): читаются один раз за итерацию, после опроса селектора, а не на каждый колбек
+        self.now = 0 if virtual else hrtime()
+        # разрешение колеса - 1 мс
+        self._timers = TimerWheel(resolution=MS, now=self.now)
+        # партия текущей итерации, см. poll()
+        self._ready = []
+        # fileobj -> [callback, events, fd]: зарегистрированные объекты, в т.ч. без интереса (в поллере их нет);
+        # fd запоминается при регистрации - к снятию с регистрации сокет может быть уже закрыт
+        self._fileobjs = {}
+        # объекты в памяти, которые могут быть готовы: изменившиеся (notify) и готовые на прошлой итерации;
+        # dict, а не set - порядок проверки (и партии) не зависит от адресов объектов
+        self._candidates = {}
+        # LoopMetrics, если цикл событий собирает метрики
+        self.metrics = None
 
     def register_timer(self, tick, callback):
-        callback_str = get_callable_representation(callback)
-        console(f'.register_timer(tick={tick}, callback={callback_str})')
+        """Returns: Timer - хендл с cancel()"""
+        if console.tracing:
+            console.trace('.register_timer(tick={}, callback={})', tick, Repr(callback))
 
-        timer = (tick, self._timer_no, callback)
-        heapq.heappush(self._timers, timer)
-        self._timer_no += 1
+        return self._timers.add(tick, callback)
 
-    def register_fileobj(self, fileobj, callback):
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        # Зарегистрировать файловый объект для выбора, отслеживая его на предмет событий ввода-вывода.
-        # fileobj — это файловый объект, который нужно отслеживать. Это может быть целочисленный файловый дескриптор или объект с методом fileno(). events — это побитовая маска отслеживаемых событий. data — непрозрачный объект.
-        # Это возвращает новый экземпляр SelectorKey или вызывает ValueError в случае недопустимой маски события или дескриптора файла, или KeyError, если объект файла уже зарегистрирован
-        self._selector.register(fileobj, events, callback)
+    def register_fileobj(self, fileobj, callback, events=0):
+        """Регистрирует файловый объект, в селектор он попадает только когда появляется интерес к событиям
 
-    def unregister_fileobj(self, fileobj):
-        # Это возвращает связанный экземпляр SelectorKey или вызывает KeyError, если fileobj не зарегистрирован.
-        self._selector.unregister(fileobj)
-
-    def pop(self, tick):
-        """Возвращает следующий готовый к выполению callback
-        Если нечего запускать - просто спит
-
-        На каждой итерации цикл событий пытается синхронно извлечь следующий обратный вызов из очереди. Если в данный
-        момент нет обратного вызова для выполнения, pop() блокирует основной поток. Когда обратный вызов готов, цикл
-        обработки событий выполняет его. Выполнение обратного вызова всегда происходит синхронно. Каждое выполнение
-        обратного вызова запускает новый стек вызовов, который длится до полного синхронного вызова в дереве вызовов с
-        корнем в исходном обратном вызове. Это также объясняет, почему ошибки должны доставляться как параметры
-        обратного вызова, а не выбрасываться. Создание исключения влияет только на текущий стек вызовов, в то время
-        как стек вызовов получателя может находиться в другом дереве. И в любой момент времени существует только один
-        стек вызовов. т.е. если исключение, выброшенное функцией, не было перехвачено в текущем стеке вызовов, оно
-        появится непосредственно в методе EventLoop._execute().
-
-        Выполнение текущего обратного вызова регистрирует новые обратные вызовы в очереди. И цикл повторяется.
+        Постоянная подписка на EVENT_WRITE для подключенного сокета заставляет select() возвращаться сразу на
+        каждой итерации (сокет почти всегда доступен для записи) - цикл крутится вхолостую.
         """
-        console(f'.pop(tick={tick})')
+        fd = None if hasattr(fileobj, 'poll_events') else fileobj.fileno()
+        self._fileobjs[fileobj] = [callback, 0, fd]
+        self.modify_fileobj(fileobj, events)
+
+    def modify_fileobj(self, fileobj, events):
+        """Меняет маску отслеживаемых событий: register/modify/unregister в поллере по необходимости"""
+        entry = self._fileobjs[fileobj]
+        callback, current, fd = entry
+        if events == current:
+            return
+
+        if console.tracing:
+            console.trace('.modify_fileobj(fileobj={}, events={} -> {})', fileobj, current, events)
+
+        if fd is None:
+            # объект в памяти в поллер не попадает: его готовность проверяет poll()
+            entry[1] = events
+            self._candidates[fileobj] = None
+            return
+
+        # Зарегистрировать fd для опроса, отслеживая его на предмет событий ввода-вывода.
+        # ValueError в случае недопустимой маски события или дескриптора файла, KeyError/FileExistsError, если fd уже зарегистрирован
+        if not current:
+            self._poller.register(fd, events, callback)
+        elif not events:
+            self._poller.unregister(fd)
+        else:
+            self._poller.modify(fd, events, callback)
+        entry[1] = events
 
-        if self._ready:
-            queue_element = self._ready.popleft()
-            console(f'.pop: TaskQueue._ready not empty -> return {queue_element}')
-            return queue_element
+    def unregister_fileobj(self, fileobj):
+        # KeyError, если fileobj не зарегистрирован
+        _, events, fd = self._fileobjs.pop(fileobj)
+        if fd is None:
+            self._candidates.pop(fileobj, None)
+        elif events:
+            self._poller.unregister(fd)
+
+    def notify(self, fileobj):
+        """Готовность объекта в памяти могла измениться - проверить его на следующем poll()"""
+        if fileobj in self._fileobjs:
+            self._candidates[fileobj] = None
+
+    def _poll_memory(self):
+        # уровень, как у select: готовый объект остается кандидатом, пока его события не обработают
+        ready = []
+        for fileobj in list(self._candidates):
+            callback, events, _ = self._fileobjs[fileobj]
+            mask = fileobj.poll_events() & events
+            if mask:
+                ready.append((callback, mask))
+            else:
+                del self._candidates[fileobj]
+        return ready
+
+    def poll(self):
+        """Одна итерация цикла: опрос i/o и таймеров -> партия [(callback, mask)], которую надо выполнить целиком
+
+        Селектор опрашивается с таймаутом до ближайшего таймера, затем в партию попадают все истекшие таймеры
+        и все сокеты с событиями. Колбеки, которые станут готовы во время выполнения партии, попадут только
+        в следующую: поток событий i/o не может отодвинуть таймеры дальше, чем на одну итерацию.
+        Пустая партия - проснулись на каскаде колеса, а не на таймере.
+
+        Выполнение обратного вызова всегда происходит синхронно. Каждое выполнение обратного вызова запускает новый
+        стек вызовов, который длится до полного синхронного вызова в дереве вызовов с корнем в исходном обратном
+        вызове. Это также объясняет, почему ошибки должны доставляться как параметры обратного вызова, а не
+        выбрасываться. Создание исключения влияет только на текущий стек вызовов, в то время как стек вызовов
+        получателя может находиться в другом дереве. И в любой момент времени существует только один стек вызовов.
+        т.е. если исключение, выброшенное функцией, не было перехвачено в текущем стеке вызовов, оно появится
+        непосредственно в методе EventLoop._execute().
+
+        Ожидание таймера - это таймаут селектора, отдельного sleep нет.
+        """
+        tracing = console.tracing
+        memory = self._poll_memory() if self._candidates else []
+        # готовые объекты в памяти ждать нечего - поллер только проверяется
+        timeout = 0 if memory or self.virtual else self.get_timeout()
+        if tracing:
+            console.trace('.poll: timeout={}', timeout)
 
-        timeout = self.get_timeout(tick)
-        console(f' timeout={timeout}')
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter_ns()
 
         # при операциях на зареганых сокетах - возникает event соответствующей
         # маской и данными
         events = self.select(timeout)
-        console(f'.pop: events={events}')
-
-        if events:
-            console('.pop appending events to _ready')
-        else:
-            console('.pop No events')
-
-        for key, mask in events:
-            callback = key.data
-            self._ready.append((callback, mask))
-
-        if events:
-            console(f'._ready={self._ready}')
-
-        # нет готовых, но есть таймеры -> спим до ближайшего и возвращаем его
-        if not self._ready and self._timers:
-            idle = (self._timers[0][0] - tick)
-
-            cleaned_timers = [(tick, timer_no, get_callable_representation(callback))
-                              for tick, timer_no, callback
-                              in self._timers]
-            console(f'._ready is empty, _timers={cleaned_timers}')
-
-            # если до следующего события срабатывающего по таймеру времени меньше чем тика оно считается следующим, иначе засыпаем
-            if idle > 0:
-                console(f'.pop sleeping for {idle / 10e6}')
-
-                time.sleep(idle / 10e6)
-
-                console(f'.pop recursive call TaskQueue.pop')
-                queue_element = self.pop(tick + idle)
-
-                console(f'.pop returning {queue_element}')
-                return queue_element
-
-        # if ближайший таймер в пределах тика
-        while self._timers and self._timers[0][0] <= tick:
-            *_, callback = heapq.heappop(self._timers)
-            self._ready.append((callback, None))
-
-        queue_element = self._ready.popleft()
-        console(f'.pop returning {queue_element}')
-        return queue_element
+        if not self.virtual:
+            self.now = hrtime()
+        elif not (events or memory):
+            deadline = self._timers.next_deadline()
+            if deadline is not None:
+                # ждать нечего, кроме таймеров - время сразу идет к ближайшему
+                self.now = max(self.now, deadline)
+            elif self._poller:
+                # остались только сокеты ОС: их ответа ждем по-настоящему, виртуальное время при этом стоит
+                events = self.select(None)
+
+        # сначала таймеры: их дедлайн наступил раньше, чем пришли события, которых ждал селектор
+        batch = [(callback, None) for callback in self._timers.expire(self.now)]
+        batch.extend(events)
+        batch.extend(memory)
+        if self._random is not None:
+            self._random.shuffle(batch)
+        self._ready = batch
+
+        if metrics is not None:
+            metrics.polled(start, time.perf_counter_ns(), len(events), len(batch))
+        if tracing:
+            console.trace('.poll: batch={}', batch)
+        return batch
 
     def select(self, timeout):
-        console(f'.select(timeout={timeout})')
-
-        try:
-            """Берем первый готовый сокет"""
-
-            # console('TaskQueue.select trying get event by timeout')
-            events = self._selector.select(timeout)
-        except OSError:
-            # console(f'Qeue.select error - sleeping for {timeout}')
-            if timeout > 0:
-                time.sleep(timeout)
-            events = tuple()
-
-        return events
-
-    def get_timeout(self, tick):
-        console(f'TaskQueue.get_timeout(tick={tick})')
-        return (self._timers[0][0] - tick) / 10e6 if self._timers else None
+        if console.tracing:
+            console.trace('.select(timeout={})', timeout)
+
+        # Берем готовые сокеты: [(callback, mask)]; ошибка поллера (например закрытый, но не снятый с регистрации
+        # fd) - ошибка программы, и спать вместо нее нельзя
+        return self._poller.poll(timeout)
+
+    def stats(self):
+        """Текущие размеры: последняя партия poll() (выполненная или выполняемая), ожидающие таймеры,
+        зарегистрированные и опрашиваемые fd"""
+        return {
+            'last_batch': len(self._ready),
+            'timers': len(self._timers),
+            'fds': len(self._fileobjs),
+            'fds_polled': sum(1 for _, events, _ in self._fileobjs.values() if events),
+        }
+
+    def get_timeout(self):
+        """Секунды до ближайшего дедлайна колеса (None - таймеров нет, ждать только i/o)"""
+        deadline = self._timers.next_deadline()
+        if deadline is None:
+            return None
+        # часы могли устареть за время колбеков после прошлого опроса - перечитываем, чтобы не проспать
+        if not self.virtual:
+            self.now = hrtime()
+        return max(0, deadline - self.now) / SECOND
 
     def is_empty(self):
-        # .get_map Возвращает сопоставление файловых объектов с ключами селектора.
-        return not (self._ready or self._timers or self._selector.get_map())
+        # len(poller) - число опрашиваемых fd.
+        # Объекты без интереса к событиям в поллере не числятся и цикл не держат - от них нечего ждать.
+        # Объект в памяти становится готов только от колбека или таймера: если готовых нет, а таймеров и сокетов
+        # ОС не осталось, его ожидание ничто уже не выполнит - цикл завершается, а не висит
+        return not (self._timers or self._poller or (self._candidates and self._poll_memory()))
 
     def close(self):
-        self._selector.close()
\ No newline at end of file
+        self._poller.close()
\ No newline at end of file
@@ -0,0 +1,185 @@
+import math
+
+BITS = 8
+SLOTS = 1 << BITS
+MASK = SLOTS - 1
+LEVELS = 4
+
+
+class Timer:
+    """Хендл таймера в колесе, cancel() снимает его за O(1)"""
+    __slots__ = ('deadline', 'callback', '_wheel', '_level', '_slot')
+
+    def __init__(self, deadline, callback, wheel):
+        self.deadline = deadline  # в тиках колеса
+        self.callback = callback
+        self._wheel = wheel
+        # _level и _slot выставляет TimerWheel._place
+
+    @property
+    def pending(self):
+        return self._slot is not None
+
+    def cancel(self):
+        """Возвращает False, если таймер уже сработал или отменен"""
+        if self._slot is None:
+            return False
+        del self._slot[self]
+        self._slot = None
+        self._wheel._counts[self._level] -= 1
+        self._wheel._count -= 1
+        return True
+
+
+class TimerWheel:
+    """Иерархическое колесо таймеров (Varghese & Lauck)
+
+    LEVELS уровней по SLOTS слотов, слот уровня L покрывает SLOTS ** L тиков. Таймер кладется в слот по
+    расстоянию до дедлайна, при проходе границы уровня слот следующего уровня раскидывается (cascade) вниз.
+    Слот - dict, поэтому вставка и отмена O(1), а отмененный таймер сразу освобождает память, в отличие от
+    кучи с ленивым удалением.
+
+    Время снаружи - в единицах часов цикла, resolution - сколько таких единиц в одном тике колеса.
+    Таймер срабатывает на первом expire() не раньше своего дедлайна, опоздание из-за колеса - меньше тика.
+    """
+    def __init__(self, resolution, now=0):
+        self._resolution = resolution
+        self._tick = int(now // resolution)  # последний обработанный тик
+        self._now = now  # время последнего expire()
+        self._wheel = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        # таймеры с уже наступившим дедлайном, срабатывают на ближайшем expire(); в _counts идут последними
+        self._due = {}
+        self._counts = [0] * (LEVELS + 1)
+        self._count = 0
+        # тик, раньше которого expire() нечего делать (кэш next_deadline), None - неизвестен
+        self._next = None
+
+    def __len__(self):
+        return self._count
+
+    def add(self, deadline, callback):
+        if deadline <= self._now:
+            # уже наступил (sleep(0)) - сработает на ближайшем expire(), а не на границе следующего тика
+            tick = self._tick
+        else:
+            # тик округляется вверх: таймер не срабатывает раньше дедлайна
+            tick = int(-(-deadline // self._resolution))
+        timer = Timer(tick, callback, self)
+        if not self._count:
+            # колесо пусто: ближайшим станет слот этого таймера (типично для таймаутов, снимаемых до срабатывания)
+            self._next = math.inf
+        self._place(timer)
+        self._count += 1
+        return timer
+
+    def _place(self, timer):
+        delta = timer.deadline - self._tick
+        if delta <= 0:
+            slot, level = self._due, LEVELS
+        else:
+            level = (delta.bit_length() - 1) // BITS
+            if level < LEVELS:
+                shift = BITS * level
+                visit = timer.deadline >> shift
+            else:
+                # дальше горизонта колеса - в последний слот верхнего уровня, при каскаде переложится
+                level = LEVELS - 1
+                shift = BITS * level
+                visit = (self._tick >> shift) + MASK
+            slot = self._wheel[level][visit & MASK]
+            # колесо дойдет до слота на тике visit << shift: раньше него expire() пропускать нельзя
+            if self._next is not None and visit << shift < self._next:
+                self._next = visit << shift
+
+        slot[timer] = None
+        self._counts[level] += 1
+        timer._level = level
+        timer._slot = slot
+
+    def expire(self, now):
+        """Продвигает колесо до момента now, возвращает колбеки сработавших таймеров в порядке дедлайнов"""
+        expired = []
+        self._now = now
+        if self._due:
+            self._fire(self._due, expired)
+
+        target = int(now // self._resolution)
+        if self._next is not None and target < self._next:
+            # до ближайшего непустого слота ни срабатываний, ни каскадов - тики можно не проходить
+            self._tick = max(self._tick, target)
+            return expired
+
+        self._next = None
+        while self._tick < target:
+            if not self._count:
+                self._tick = target
+                break
+
+            if not self._counts[0]:
+                # нижние уровни пусты - прыгаем сразу к границе ближайшего непустого, где будет каскад
+                level = 1
+                while not self._counts[level]:
+                    level += 1
+                shift = BITS * level
+                boundary = ((self._tick >> shift) + 1) << shift
+                if boundary > target:
+                    self._tick = target
+                    break
+                self._tick = boundary - 1
+
+            tick = self._tick = self._tick + 1
+            level = 0
+            while level < LEVELS - 1 and not (tick >> (BITS * level)) & MASK:
+                level += 1
+                self._cascade(level, (tick >> (BITS * level)) & MASK)
+
+            if self._due:
+                # каскад мог переложить таймер с дедлайном ровно в этот тик
+                self._fire(self._due, expired)
+            self._fire(self._wheel[0][tick & MASK], expired)
+
+        return expired
+
+    def _cascade(self, level, index):
+        slot = self._wheel[level]
+        timers, slot[index] = slot[index], {}
+        self._counts[level] -= len(timers)
+        for timer in timers:
+            self._place(timer)
+
+    def _fire(self, slot, expired):
+        for timer in slot:
+            timer._slot = None
+            expired.append(timer.callback)
+            self._counts[timer._level] -= 1
+        self._count -= len(slot)
+        slot.clear()
+
+    def next_deadline(self):
+        """Ближайший момент, когда колесу нужен expire(), или None если таймеров нет
+
+        Для верхних уровней это время каскада, т.е. нижняя оценка дедлайна.
+        """
+        if not self._count:
+            return None
+        if self._due:
+            return self._tick * self._resolution
+        if self._next is not None:
+            return self._next * self._resolution
+
+        nearest = None
+        for level in range(LEVELS):
+            if not self._counts[level]:
+                continue
+            shift = BITS * level
+            base = self._tick >> shift
+            slots = self._wheel[level]
+            for step in range(1, SLOTS + 1):
+                if slots[(base + step) & MASK]:
+                    tick = (base + step) << shift
+                    if nearest is None or tick < nearest:
+                        nearest = tick
+                    break
+        # отмена таймеров кэш не сбрасывает: он остается нижней оценкой, лишнее пробуждение пересчитает его
+        self._next = nearest
+        return nearest * self._resolution
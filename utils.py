@@ -1,106 +1,85 @@
 import time
 import types
-from functools import partial
 
+from consts import MS
 from facade import Context
-from promise import Promise
+from promise import TASK_TYPES, Promise
+from task import Task, gather, wait_all  # noqa
 
-from log import get_console, get_callable_representation
+from log import get_console
 
-console = get_console(format='{message}')
+console = get_console(format='{message}', name='utils')
 
-unwind_console = get_console(format='<light-yellow>unwind</light-yellow>{message}')
 
+def is_generator(val):
+    return isinstance(val, types.GeneratorType)
 
-def unwind(generator, on_success, on_exceptions, to_generator=None, method='send'):
-    """Подписывается на события с помощью промисов, затем возвращает состояние обратно генератору, либо возвращает из него значение"""
-    unwind_console(f'(gen={generator}, on_success={get_callable_representation(on_success)}, fail={get_callable_representation(on_exceptions)}, to_generator={to_generator}, method={method})')
-
-    try:
-        # пробуем пнуть герератор
-        returned = getattr(generator, method)(to_generator)
-        unwind_console(f': complete send to generator, returned={returned}')
-
-    except StopIteration as stop:
-        unwind_console(f': StopIteration, return {get_callable_representation(on_success)}({stop.value})')
-
-        return on_success(to_generator=stop.value) if on_success else None
-    except Exception as exc:
-        unwind_console(f': Exception, return {get_callable_representation(on_exceptions)}({exc})')
-
-        return on_exceptions(to_generator=exc)
-
-    if is_generator(returned):
-        # generator вернул другой генератор
-
-        unwind_console(f': to_generator is_generator')
 
-        unwind(
-            returned,
-            on_success=partial(unwind, generator, on_success, on_exceptions),
-            on_exceptions=partial(unwind, generator, on_success, on_exceptions, method='throw'),
-        )
-    elif is_promise(returned):
-        unwind_console(': to_generator is_promise')
+def is_runnable(val):
+    """Генератор или корутина async def - то, что выполняется задачей"""
+    return isinstance(val, TASK_TYPES)
 
-        returned.then(
-            partial(unwind, generator, on_success, on_exceptions)
-        ).catch(
-            partial(unwind, generator, on_success, on_exceptions, method='throw')
-        )
-    else:
-        unwind_console(': else')
 
-        wait_all(
-            returned,
-            partial(unwind, generator, on_success, on_exceptions),
-            partial(unwind, generator, on_success, on_exceptions, method='throw'),
-        )
+def is_promise(val):
+    return isinstance(val, Promise)
 
 
-def wait_all(awaitables, on_success, fail):
-    """Ждем всех, когда последний выполнится - затем снова пинаем генератор """
+def hrtime():
+    """high-resolution monotonic time, нс: не прыгает назад и вперед при подстройке системных часов (NTP)"""
+    return time.monotonic_ns()
 
-    counter = len(awaitables)
 
-    def _do_resolve(to_generator):  # to_generator чтобы консистетно с остальными on_success
-        """последний _do_resolve запустит on_success(results)"""
-        nonlocal counter
-        counter -= 1
-        if counter == 0:
-            on_success(None)
+@types.coroutine
+def wait(awaitable):
+    """await wait(awaitable) в корутине async def - то же, что yield awaitable в генераторе задачи
 
+    Так из async def вызываются функции-генераторы (client.get_user(1)) и ждутся списки (gather): генератор
+    выполняется на стеке той же задачи, без отдельной Task. Промисы и корутины ждутся обычным await.
+    """
+    return (yield awaitable)
 
-    for i, c in enumerate(awaitables):
-        if is_generator(c):
-            unwind(c, on_success=_do_resolve, on_exceptions=fail)
-            continue
 
-        if is_promise(c):
-            c.then(
-                _do_resolve
-            ).catch(
-                fail
-            )
-            continue
+def sleep(duration) -> Promise:
+    """Промис, выполняемый через duration мс; promise.cancel() снимает таймер"""
+    if console.tracing:
+        console.trace('sleep({})', duration)
 
-        raise Exception('Only promise or generator can be yielded to event loop')
+    return Context.event_loop.set_timer(int(duration * MS))
 
 
-def is_generator(val):
-    return isinstance(val, types.GeneratorType)
+def with_timeout(awaitable, timeout) -> Promise:
+    """Промис результата awaitable (генератор, корутина или промис), отклоняемый TimeoutError, если за timeout мс
+    его нет
 
+    Генератор (корутина) запускается отдельной задачей. По истечении срока ожидаемое отменяется через cancel(): операция
+    сокета снимается с селектора (connect - закрывает сокет), таймер - с колеса. Как и в Task.cancel, отменяется
+    только промис, который больше никто не ждет: общий (запрос кэша, пакет Batcher) остается остальным. Выполненное
+    вовремя снимает таймер срока, и цикл событий его не ждет.
+    """
+    if console.tracing:
+        console.trace('with_timeout({}, {})', awaitable, timeout)
 
-def is_promise(val):
-    return isinstance(val, Promise)
+    if is_runnable(awaitable):
+        awaitable = Context.event_loop.spawn(awaitable)
 
+    p = Promise()
 
-def hrtime():
-    """high-resolution real time"""
-    return int(time.time() * 10e6)
+    def _expired(_):
+        if awaitable._resolved or awaitable._rejected:
+            return
+        # ждущие продолжат работу уже после отмены; CancelledError от нее до p не доходит - колбеки сняты
+        if not awaitable._unsubscribe(_resolved, _rejected):
+            awaitable.cancel()
+        p._reject(TimeoutError(f'timed out after {timeout} ms'))
 
+    def _resolved(*value):
+        timer.cancel()
+        p._resolve(*value)
 
-def sleep(duration) -> Promise:
-    console(f'sleep({duration})')
+    def _rejected(error):
+        timer.cancel()
+        p._reject(error)
 
-    return Context.event_loop.set_timer(duration * 10e3)
+    timer = Context.event_loop.call_later(int(timeout * MS), _expired)
+    awaitable.then(_resolved).catch(_rejected)
+    return p
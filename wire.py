@@ -0,0 +1,98 @@
+"""Бинарный протокол user/account - альтернатива строкам JSON, выбирается на соединении
+
+Клиент начинает соединение строкой HELLO, сервер отвечает ACCEPTED, и дальше запросы и ответы - кадры
+async_socket (FRAME_HEADER + тело). Сервер без бинарного протокола на HELLO отвечает строкой ошибки или
+закрывает соединение; клиент повторяет запрос в JSON на новом соединении. После настоящего отказа - строки
+или hello_eof_limit закрытий подряд - клиенты этого цикла событий json_only_ttl мс не предлагают адресу HELLO
+(см. Client._hello_replied); одиночный обрыв соединения протокол не отключает.
+
+Запрос - REQUEST (метод, вид сущности) и id как uint64 подряд. Ответ - записи фиксированной длины (USER, ACCOUNT)
+в порядке id, первое поле - есть ли такая сущность. Длинный ответ идет несколькими кадрами.
+"""
+import struct
+
+from async_socket import FRAME_HEADER
+
+HELLO = b'PROTO binary\n'
+ACCEPTED = b'OK binary\n'
+
+METHODS = {'GET': 1, 'MGET': 2}
+KINDS = {'user': 1, 'account': 2}
+_METHOD_NAMES = {code: name for name, code in METHODS.items()}
+_KIND_NAMES = {code: name for name, code in KINDS.items()}
+
+REQUEST = struct.Struct('!BB')
+ID = struct.Struct('!Q')
+USER = struct.Struct('!?Q8sQ')  # found, id, name (8 символов ascii), account_id
+ACCOUNT = struct.Struct('!?Qi')  # found, id, balance
+RECORDS = {'user': USER, 'account': ACCOUNT}
+
+
+def encode_request(method, kind, ids):
+    """-> кадр запроса; ids - целые или строки из цифр"""
+    body = REQUEST.pack(METHODS[method], KINDS[kind]) + struct.pack(f'!{len(ids)}Q', *map(int, ids))
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+def decode_request(body):
+    """Тело кадра -> (method, kind, ids) как у Handler.parse"""
+    count, rest = divmod(len(body) - REQUEST.size, ID.size)
+    if count < 1 or rest:
+        raise Exception('Bad request')
+
+    method, kind = REQUEST.unpack_from(body)
+    method, kind = _METHOD_NAMES.get(method), _KIND_NAMES.get(kind)
+    if method is None or kind is None or method == 'GET' and count != 1:
+        raise Exception('Bad request')
+    return method, kind, [str(entity_id) for entity_id in struct.unpack_from(f'!{count}Q', body, REQUEST.size)]
+
+
+def _pack_user(user):
+    return USER.pack(True, int(user['id']), user['name'].encode('ascii'), int(user['account_id']))
+
+
+def _pack_account(account):
+    return ACCOUNT.pack(True, int(account['id']), account['balance'])
+
+
+_PACK = {'user': _pack_user, 'account': _pack_account}
+_MISSING = {'user': USER.pack(False, 0, b'', 0), 'account': ACCOUNT.pack(False, 0, 0)}
+
+
+def encode_records(kind, entities, flush_size):
+    """Генератор кадров с записями entities (None - нет такой), по кадру на flush_size байт"""
+    pack, missing = _PACK[kind], _MISSING[kind]
+    limit = FRAME_HEADER.size + max(1, flush_size // RECORDS[kind].size) * RECORDS[kind].size
+
+    # место под заголовок в начале кадра, длина вписывается перед отправкой
+    frame = bytearray(FRAME_HEADER.size)
+    for entity in entities:
+        frame += missing if entity is None else pack(entity)
+        if len(frame) >= limit:
+            FRAME_HEADER.pack_into(frame, 0, len(frame) - FRAME_HEADER.size)
+            yield frame
+            frame = bytearray(FRAME_HEADER.size)
+    if len(frame) > FRAME_HEADER.size:
+        FRAME_HEADER.pack_into(frame, 0, len(frame) - FRAME_HEADER.size)
+        yield frame
+
+
+def decode_records(kind, body):
+    """Тело кадра ответа -> список записей (dict с целыми id; None - нет такой)"""
+    if kind == 'user':
+        return [{'id': entity_id, 'name': name.rstrip(b'\0').decode('ascii'), 'account_id': account_id}
+                if found else None
+                for found, entity_id, name, account_id in USER.iter_unpack(body)]
+    return [{'id': entity_id, 'balance': balance} if found else None
+            for found, entity_id, balance in ACCOUNT.iter_unpack(body)]
+
+
+def read_frame(rfile, limit):
+    """Тело кадра из блокирующего файла сокета (Handler), b'' - соединение закрыто"""
+    header = rfile.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return b''
+    size, = FRAME_HEADER.unpack(header)
+    if size > limit:
+        raise Exception('Max request length exceeded')
+    return rfile.read(size)